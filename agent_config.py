@@ -0,0 +1,164 @@
+"""
+The ngrok agent configuration (agent.yml): several tunnels, validated, rendered
+deterministically and only written when it actually changes.
+"""
+import hashlib
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+import yaml
+
+from atomicfile import write_atomic
+
+
+CONFIG_NAME = "agent.yml"
+CONFIG_VERSION = "3"
+PROTOCOLS = ("tcp", "http", "tls")
+TUNNEL_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+HOST_PORT = re.compile(r"^[A-Za-z0-9.-]+:\d{1,5}$")
+
+SSH_PORT = 22
+RDP_PORT = 3389
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Tunnel:
+    name: str
+    addr: str
+    proto: str = "tcp"
+    remote_addr: Optional[str] = None
+
+    def validate(self):
+        if not TUNNEL_NAME.match(self.name or ""):
+            raise ConfigError(f"Tunnel name {self.name!r} may only contain letters, digits, '-' and '_'")
+        if self.proto not in PROTOCOLS:
+            raise ConfigError(f"Tunnel {self.name}: proto must be one of {', '.join(PROTOCOLS)}, not {self.proto!r}")
+        port = self.addr.rsplit(":", 1)[-1]
+        if not port.isdigit() or not 0 < int(port) < 65536 or (":" in self.addr and not HOST_PORT.match(self.addr)):
+            raise ConfigError(f"Tunnel {self.name}: addr must be a port or host:port, not {self.addr!r}")
+        if self.remote_addr is not None:
+            if self.proto != "tcp":
+                raise ConfigError(f"Tunnel {self.name}: remote_addr only applies to tcp tunnels")
+            if not HOST_PORT.match(self.remote_addr):
+                raise ConfigError(f"Tunnel {self.name}: remote_addr must be host:port, not {self.remote_addr!r}")
+
+    def to_dict(self):
+        data = {"proto": self.proto, "addr": int(self.addr) if self.addr.isdigit() else self.addr}
+        if self.remote_addr:
+            data["remote_addr"] = self.remote_addr
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a tunnel from a settings mapping: name, port or addr, and optionally proto and remote_addr."""
+        if not isinstance(data, dict):
+            raise ConfigError(f"A tunnel must be a mapping, not {data!r}")
+        unknown = set(data) - {"name", "addr", "port", "proto", "remote_addr"}
+        if unknown:
+            raise ConfigError(f"Unknown tunnel setting(s): {', '.join(sorted(unknown))}")
+        addr = data.get("addr", data.get("port"))
+        if addr is None:
+            raise ConfigError(f"Tunnel {data.get('name')!r} needs a port or addr")
+        tunnel = cls(str(data.get("name", "")), str(addr), str(data.get("proto", "tcp")), data.get("remote_addr"))
+        tunnel.validate()
+        return tunnel
+
+
+def ssh_tunnel(remote_addr):
+    return Tunnel("ssh", str(SSH_PORT), "tcp", remote_addr)
+
+
+def rdp_tunnel(remote_addr):
+    return Tunnel("rdp", str(RDP_PORT), "tcp", remote_addr)
+
+
+@dataclass(frozen=True)
+class AgentConfig:
+    authtoken: str
+    tunnels: Tuple[Tunnel, ...] = field(default_factory=tuple)
+
+    def validate(self):
+        if not isinstance(self.authtoken, str) or not self.authtoken.strip():
+            raise ConfigError("The agent config needs an auth token")
+        if not self.tunnels:
+            raise ConfigError("The agent config needs at least one tunnel")
+        names = set()
+        for tunnel in self.tunnels:
+            tunnel.validate()
+            if tunnel.name in names:
+                raise ConfigError(f"Tunnel name {tunnel.name!r} is used twice")
+            names.add(tunnel.name)
+        return self
+
+    def to_dict(self):
+        return {
+            "version": CONFIG_VERSION,
+            "agent": {"authtoken": self.authtoken},
+            "tunnels": {tunnel.name: tunnel.to_dict() for tunnel in self.tunnels},
+        }
+
+    def render(self):
+        """The same config always renders to the same bytes: keys sorted, block style."""
+        self.validate()
+        return yaml.safe_dump(self.to_dict(), default_flow_style=False, sort_keys=True).encode("utf-8")
+
+    def digest(self):
+        return hashlib.sha256(self.render()).hexdigest()
+
+
+@dataclass(frozen=True)
+class ConfigWriteResult:
+    path: str
+    changed: bool
+    restart_required: bool
+    digest: str
+
+
+def write_config(path, config):
+    """
+    Write config to path unless the file already holds exactly these bytes.
+
+    restart_required is False when the file's settings were already the same
+    (even if it was only re-rendered in canonical form), so a running agent is
+    left alone.
+    """
+    rendered = config.render()
+    digest = hashlib.sha256(rendered).hexdigest()
+    try:
+        with open(path, "rb") as f:
+            existing = f.read()
+    except FileNotFoundError:
+        existing = None
+
+    if existing is not None and hashlib.sha256(existing).hexdigest() == digest:
+        return ConfigWriteResult(path, changed=False, restart_required=False, digest=digest)
+
+    try:
+        same_settings = existing is not None and yaml.safe_load(existing) == config.to_dict()
+    except yaml.YAMLError:
+        same_settings = False
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    write_atomic(path, rendered)
+    return ConfigWriteResult(path, changed=True, restart_required=not same_settings, digest=digest)
+
+
+def read_settings(path):
+    """The settings in an agent config file, or None when it is missing or not a YAML mapping."""
+    try:
+        with open(path, "rb") as f:
+            settings = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError):
+        return None
+    return settings if isinstance(settings, dict) else None
+
+
+def settings_digest(settings):
+    """Hash of the settings themselves, so files that differ only in formatting compare equal."""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode("utf-8")).hexdigest()
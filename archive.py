@@ -0,0 +1,134 @@
+import io
+import mmap
+import os
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from atomicfile import fsync_directory
+
+
+CHUNK_SIZE = 1024 * 1024
+# Below this much uncompressed data a thread pool costs more than it saves
+PARALLEL_THRESHOLD = 8 * 1024 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class _MappedFile(io.RawIOBase):
+    """Seekable read-only file over a memory map, which zipfile can read from."""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._buffer)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def readinto(self, target):
+        count = max(0, min(len(target), len(self._buffer) - self._position))
+        target[:count] = self._buffer[self._position:self._position + count]
+        self._position += count
+        return count
+
+
+def _select(archive, members):
+    """Resolve members (names, a predicate or None for everything) to ZipInfos."""
+    infos = [info for info in archive.infolist() if not info.is_dir()]
+    if members is None:
+        return infos
+    if callable(members):
+        return [info for info in infos if members(info.filename)]
+    by_name = {info.filename: info for info in infos}
+    missing = [name for name in members if name not in by_name]
+    if missing:
+        raise ArchiveError(f"Archive does not contain {', '.join(missing)}")
+    return [by_name[name] for name in members]
+
+
+def _target_path(dest_dir, name):
+    # Refuse absolute paths and ".." so an archive cannot write outside dest_dir
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or ".." in parts or os.path.isabs(name) or ":" in parts[0]:
+        raise ArchiveError(f"Refusing to extract unsafe path {name!r}")
+    return os.path.join(dest_dir, *parts)
+
+
+def _extract_one(archive, info, path):
+    """Write one member next to its target, check its CRC, then move it into place."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    crc = 0
+    size = 0
+    try:
+        with archive.open(info) as source, open(tmp_path, "wb") as target:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                target.write(chunk)
+            target.flush()
+            os.fsync(target.fileno())
+        if crc != info.CRC or size != info.file_size:
+            raise ArchiveError(f"CRC check failed for {info.filename}")
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+def extract_members(zip_source, dest_dir, members=None, workers=4):
+    """
+    Extract members of a zip archive into dest_dir and return the written paths.
+
+    zip_source is a path, read through a memory map, or a buffer already in
+    memory (such as a view into an installer bundle), so nothing is copied
+    besides the extracted files themselves. Each file is written under a
+    temporary name, CRC-checked and renamed into place, so dest_dir never holds
+    a truncated file. Archives with a lot of data are extracted by several
+    threads.
+    """
+    if not isinstance(zip_source, (str, bytes, os.PathLike)):
+        return _extract_buffer(zip_source, "archive", dest_dir, members, workers)
+    try:
+        with open(zip_source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return _extract_buffer(buffer, zip_source, dest_dir, members, workers)
+    except ValueError as e:
+        # mmap raises ValueError for an empty file
+        raise ArchiveError(f"Could not extract {zip_source}: {e}")
+
+
+def _extract_buffer(buffer, label, dest_dir, members, workers):
+    try:
+        with zipfile.ZipFile(_MappedFile(buffer)) as archive:
+            infos = _select(archive, members)
+            targets = [(info, _target_path(dest_dir, info.filename)) for info in infos]
+            total = sum(info.file_size for info in infos)
+            if len(targets) > 1 and total >= PARALLEL_THRESHOLD and workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    paths = list(pool.map(lambda target: _extract_one(archive, *target), targets))
+            else:
+                paths = [_extract_one(archive, info, path) for info, path in targets]
+    except (ValueError, zipfile.BadZipFile) as e:
+        # zipfile raises BadZipFile for bad headers and CRCs
+        raise ArchiveError(f"Could not extract {label}: {e}")
+
+    for directory in sorted({os.path.dirname(path) for path in paths}):
+        fsync_directory(directory)
+    return paths
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from events import log
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get("ProgramData", os.path.expanduser("~")), "Procesure", "cache")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+LOCK_TIMEOUT = 120
+LOCK_STALE_AFTER = 600
+# A held lock that may be held for long (a download) is touched this often so it never looks stale
+LOCK_HEARTBEAT = 60
+
+
+class CacheLockTimeout(Exception):
+    pass
+
+
+class CacheLock:
+    """
+    Cross-process lock backed by an exclusively created file.
+
+    A lock file older than LOCK_STALE_AFTER seconds is assumed to belong to a
+    crashed installer and is broken. With heartbeat set the holder touches the
+    file every LOCK_HEARTBEAT seconds, so a lock held for longer than that (a
+    slow download) stays valid for as long as its owner runs. A timeout of
+    None waits until the lock is released or goes stale.
+    """
+
+    def __init__(self, path, timeout=LOCK_TIMEOUT, heartbeat=False):
+        self.path = path
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self._stop = None
+        self._thread = None
+
+    def __enter__(self):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        delay = 0.01
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode("ascii"))
+                os.close(fd)
+                if self.heartbeat:
+                    self._stop = threading.Event()
+                    self._thread = threading.Thread(target=self._touch, daemon=True)
+                    self._thread.start()
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.path) > LOCK_STALE_AFTER:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                if deadline is not None and time.monotonic() > deadline:
+                    raise CacheLockTimeout(f"Timed out waiting for {self.path}")
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _touch(self):
+        while not self._stop.wait(LOCK_HEARTBEAT):
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+
+def sha256_of(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache:
+    """
+    Content-addressed store for downloaded installer artifacts.
+
+    Blobs live in objects/<sha256>; index.json maps each URL to the hash, size
+    and modification time of its content plus the last access time used for LRU
+    eviction. Every index update happens under a cross-process lock and is
+    written atomically, so several installers may share one cache directory.
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, "objects")
+        self.index_path = os.path.join(root, "index.json")
+        self.lock_path = os.path.join(root, "index.lock")
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+    def object_path(self, sha256):
+        return os.path.join(self.objects_dir, sha256)
+
+    def lock(self):
+        return CacheLock(self.lock_path)
+
+    def get(self, url, sha256=None, opened=False):
+        """
+        Return the path of the cached content for url, or None on a miss or corrupt entry.
+
+        With opened set the content is returned as a file opened for reading
+        instead. It is opened under the index lock, so another installer's put
+        cannot evict it in between; a bare path carries no such guarantee.
+        """
+        with self.lock():
+            index = self._read_index()
+            entry = index.get(url)
+            if entry is None or (sha256 and entry["sha256"] != sha256.lower()):
+                return None
+            path = self.object_path(entry["sha256"])
+            if not self._verify(path, entry):
+                log(f"Cached copy of {url} is corrupt, discarding it.")
+                del index[url]
+                self._remove_unreferenced(index, entry["sha256"])
+                self._write_index(index)
+                return None
+            entry["last_access"] = time.time()
+            self._write_index(index)
+            return open(path, "rb") if opened else path
+
+    def entries(self):
+        """Return a snapshot of the index: url -> {sha256, size, mtime_ns, last_access}."""
+        with self.lock():
+            return self._read_index()
+
+    def put(self, url, source_path, sha256=None, opened=False):
+        """Move a downloaded file into the cache and return its cached path (or, opened, the open file)."""
+        actual = sha256_of(source_path)
+        if sha256 and actual != sha256.lower():
+            raise ValueError(f"SHA-256 mismatch for {url}: expected {sha256}, got {actual}")
+        size = os.path.getsize(source_path)
+        path = self.object_path(actual)
+        with self.lock():
+            if os.path.exists(path):
+                os.remove(source_path)
+            else:
+                os.replace(source_path, path)
+            index = self._read_index()
+            index[url] = {"sha256": actual, "size": size, "mtime_ns": os.stat(path).st_mtime_ns,
+                          "last_access": time.time()}
+            self._evict(index, keep=actual)
+            self._write_index(index)
+            return open(path, "rb") if opened else path
+
+    def fetch(self, url, download, sha256=None, opened=False):
+        """
+        Return a cached path for url, calling download(dest_path) only on a miss.
+        With opened set an open file is returned instead, as for get.
+
+        Downloads of the same URL are serialised by a per-URL lock, so a second
+        installer waits for the first, however long its download takes, and
+        then reads its result from the cache.
+        The temporary name is stable per URL so an interrupted download can be
+        resumed from its partial file by the next run.
+        """
+        cached = self.get(url, sha256, opened)
+        if cached is not None:
+            log(f"Using cached copy of {url}")
+            return cached
+
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        with CacheLock(os.path.join(self.root, f"download-{key}.lock"), timeout=None, heartbeat=True):
+            cached = self.get(url, sha256, opened)
+            if cached is not None:
+                return cached
+            tmp_path = os.path.join(self.root, f"download-{key}.tmp")
+            download(tmp_path)
+            return self.put(url, tmp_path, sha256, opened)
+
+    def _verify(self, path, entry):
+        """Check an object against its entry, hashing it only when its size or modification time changed."""
+        try:
+            stat = os.stat(path)
+            if stat.st_size != entry["size"]:
+                return False
+            if stat.st_mtime_ns == entry.get("mtime_ns"):
+                return True
+            if sha256_of(path) != entry["sha256"]:
+                return False
+        except OSError:
+            return False
+        entry["mtime_ns"] = stat.st_mtime_ns
+        return True
+
+    def _evict(self, index, keep):
+        """Drop least recently used entries until the cache fits in max_bytes."""
+        sizes = {}
+        for entry in index.values():
+            sizes[entry["sha256"]] = entry["size"]
+        total = sum(sizes.values())
+        for url, entry in sorted(index.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if entry["sha256"] == keep:
+                continue
+            del index[url]
+            if self._remove_unreferenced(index, entry["sha256"]):
+                total -= entry["size"]
+
+    def _remove_unreferenced(self, index, sha256):
+        if any(entry["sha256"] == sha256 for entry in index.values()):
+            return False
+        try:
+            os.remove(self.object_path(sha256))
+        except OSError:
+            pass
+        return True
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            log("Artifact cache index is corrupt, starting with an empty cache.")
+            return {}
+
+    def _write_index(self, index):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
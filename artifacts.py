@@ -0,0 +1,139 @@
+import mmap
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+
+from archive import ArchiveError
+from artifact_cache import ArtifactCache, DEFAULT_CACHE_DIR
+from bundle import BundleError
+from download import DownloadError, download_file, print_progress
+from events import log
+from mirror import MirrorError, get_mirror
+
+
+Artifact = namedtuple("Artifact", ["name", "url", "sha256"])
+
+NGROK = Artifact(
+    name="ngrok",
+    url="https://bin.equinox.io/c/bNyj1mQVY4c/ngrok-stable-windows-amd64.zip",
+    sha256=None,
+)
+OPENSSH = Artifact(
+    name="openssh",
+    url="https://github.com/PowerShell/Win32-OpenSSH/releases/download/V8.6.0.0p1-Beta/OpenSSH-Win64.zip",
+    sha256=None,
+)
+
+# Deployments pin the archives they expect, e.g. PROCESURE_NGROK_SHA256
+PIN_ENV = "PROCESURE_{name}_SHA256"
+
+_cache = None
+_bundle = None
+_url_overrides = {}
+
+
+def get_cache():
+    """Return the shared artifact cache, honouring PROCESURE_CACHE_DIR."""
+    global _cache
+    if _cache is None:
+        _cache = ArtifactCache(os.environ.get("PROCESURE_CACHE_DIR", DEFAULT_CACHE_DIR))
+    return _cache
+
+
+def set_cache(cache):
+    """Replace the shared artifact cache; None re-reads PROCESURE_CACHE_DIR on next use."""
+    global _cache
+    _cache = cache
+
+
+def set_bundle(bundle):
+    """Read artifacts from an opened Bundle before anything else (None: no bundle). Returns the previous one."""
+    global _bundle
+    previous, _bundle = _bundle, bundle
+    return previous
+
+
+def override_url(artifact, url):
+    """Fetch an artifact from another URL (None restores the default)."""
+    if url is None:
+        _url_overrides.pop(artifact.name, None)
+    else:
+        _url_overrides[artifact.name] = url
+
+
+def resolve(artifact):
+    """Return the artifact with any URL override and pinned hash (PIN_ENV) applied."""
+    url = _url_overrides.get(artifact.name)
+    if url:
+        artifact = artifact._replace(url=url)
+    pinned = os.environ.get(PIN_ENV.format(name=artifact.name.upper()), "").strip().lower()
+    return artifact._replace(sha256=pinned) if pinned else artifact
+
+
+def download_artifact(artifact, dest):
+    """
+    Default downloader: stream the artifact into dest, from the LAN mirror when
+    there is one and the artifact has a pinned hash. Without a pin the only hash
+    to check against would be the one the mirror advertises, and any host
+    answering discovery could serve its own binary.
+    """
+    mirror = get_mirror()
+    if mirror is not None and not artifact.sha256:
+        log(f"{artifact.name} has no pinned hash, downloading it from {artifact.url} instead of the mirror.")
+    elif mirror is not None:
+        try:
+            mirror.download(artifact, dest, progress=print_progress(f"Downloading {artifact.name} from the mirror"))
+            return
+        except (MirrorError, DownloadError, OSError) as e:
+            log(f"Mirror {mirror.base_url} unavailable ({e}), downloading {artifact.name} from {artifact.url}")
+    download_file(
+        artifact.url,
+        dest,
+        sha256=artifact.sha256,
+        progress=print_progress(f"Downloading {artifact.name}"),
+    )
+
+
+def fetch_artifact(artifact, download=None, opened=False):
+    """
+    Return the local path of an artifact, downloading it only when it is not cached.
+
+    A custom download(dest) callable may use resolve(artifact).url. With opened
+    set the cached file is returned open for reading, see ArtifactCache.get.
+    """
+    artifact = resolve(artifact)
+    download = download or (lambda dest: download_artifact(artifact, dest))
+    return get_cache().fetch(artifact.url, download, artifact.sha256, opened)
+
+
+@contextmanager
+def open_artifact(artifact):
+    """
+    Yield an artifact for extract_members: a view into the installer bundle when
+    it carries the artifact, otherwise a memory map of the cached (or downloaded)
+    file, which stays readable even if another installer evicts it meanwhile.
+    A bundle copy that fails its hash check falls back to the download.
+    """
+    artifact = resolve(artifact)
+    bundle = _bundle
+    view = None
+    if bundle is not None and artifact.name in bundle:
+        try:
+            view = bundle.view(artifact.name, artifact.sha256)
+            log(f"Using {artifact.name} from the installer bundle.")
+        except BundleError as e:
+            log(f"{e}, downloading {artifact.name} instead.")
+    if view is None:
+        with fetch_artifact(artifact, opened=True) as f:
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                # mmap raises ValueError for an empty file
+                raise ArchiveError(f"Could not read the cached {artifact.name} archive: {e}")
+            with buffer:
+                yield buffer
+        return
+    try:
+        yield view
+    finally:
+        view.release()
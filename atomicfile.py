@@ -0,0 +1,40 @@
+import os
+
+
+def fsync_directory(path):
+    """Make a rename inside path durable. Windows cannot open directories, and does not need to."""
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path, data, prepare=None):
+    """
+    Replace path with data (bytes, or str written as UTF-8) so that readers and crashes only ever
+    see the old or the new content, never a partial write. prepare, when given, is called with
+    the temporary file's path before it replaces path (to set its permissions, for instance).
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if prepare is not None:
+            prepare(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    fsync_directory(directory)
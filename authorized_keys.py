@@ -0,0 +1,380 @@
+"""
+Keeps an authorized_keys file in line with a set of key sources.
+
+Keys are read from files, directories of key files and URLs, normalised and
+de-duplicated by fingerprint, and only the difference is applied to the
+target: keys missing from it are appended, keys the sync added earlier that
+no source lists any more (or that a revocation list names) are taken out,
+and every other line - comments and keys added by hand - is kept as it is.
+The keys the sync manages are remembered in a small state file next to the
+target; when neither the sources nor the target changed since the last
+sync, nothing is parsed at all.
+
+    python authorized_keys.py sync keys/ https://keys.example.com/team.keys
+    python authorized_keys.py sync keys/ --revoked revoked.keys --target authorized_keys
+    python authorized_keys.py fingerprint authorized_keys
+"""
+import argparse
+import base64
+import binascii
+import getpass
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import namedtuple
+
+import requests
+
+from atomicfile import write_atomic
+from events import log
+from fetch import get_fetcher
+from process import run_command
+
+
+KEY_TYPES = frozenset({
+    "ssh-ed25519",
+    "ssh-rsa",
+    "ssh-dss",
+    "ecdsa-sha2-nistp256",
+    "ecdsa-sha2-nistp384",
+    "ecdsa-sha2-nistp521",
+    "sk-ssh-ed25519@openssh.com",
+    "sk-ecdsa-sha2-nistp256@openssh.com",
+})
+STATE_SUFFIX = ".procesure.json"
+STATE_VERSION = 1
+# Leading options such as from="10.0.0.0/8",no-pty: quoted values may contain spaces
+OPTIONS = re.compile(r'(?:[^\s"]|"(?:\\.|[^"\\])*")+')
+# Local accounts and groups by SID, so icacls works on localised Windows
+ADMINISTRATORS_SID = "*S-1-5-32-544"
+SYSTEM_SID = "*S-1-5-18"
+
+
+class KeyParseError(ValueError):
+    pass
+
+
+class KeySourceError(Exception):
+    pass
+
+
+class AuthorizedKey(namedtuple("AuthorizedKey", ["keytype", "blob", "comment", "options", "fingerprint"])):
+    """One public key in canonical form; keys are the same key when their fingerprints are equal."""
+
+    def line(self):
+        fields = [self.options, self.keytype, self.blob, self.comment]
+        return " ".join(field for field in fields if field)
+
+
+def fingerprint(raw):
+    """OpenSSH's SHA256 fingerprint of a decoded key blob."""
+    return "SHA256:" + base64.b64encode(hashlib.sha256(raw).digest()).decode("ascii").rstrip("=")
+
+
+def parse_key(line):
+    """Parse one authorized_keys line; None for blanks and comments, KeyParseError when malformed."""
+    line = original = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    options = ""
+    if line.split(None, 1)[0] not in KEY_TYPES:
+        match = OPTIONS.match(line)
+        if match is None:
+            # An unbalanced quote at the start of the options
+            raise KeyParseError(f"not a public key: {original[:40]!r}")
+        options, line = match.group(0), line[match.end():].lstrip()
+    fields = line.split(None, 2)
+    if len(fields) < 2 or fields[0] not in KEY_TYPES:
+        raise KeyParseError(f"not a public key: {original[:40]!r}")
+    keytype, blob = fields[0], fields[1]
+    try:
+        raw = base64.b64decode(blob, validate=True)
+    except binascii.Error:
+        raise KeyParseError(f"{keytype} key with invalid base64")
+    # The blob starts with its own key type; a mismatch means a corrupted or mislabelled key
+    length = int.from_bytes(raw[:4], "big")
+    if raw[4:4 + length] != keytype.encode("ascii"):
+        raise KeyParseError(f"{keytype} key whose data is not a {keytype} key")
+    comment = fields[2].strip() if len(fields) > 2 else ""
+    return AuthorizedKey(keytype, base64.b64encode(raw).decode("ascii"), comment, options, fingerprint(raw))
+
+
+def index_keys(texts):
+    """
+    Parse and de-duplicate the keys in texts in one pass. Returns ({fingerprint:
+    AuthorizedKey}, number of malformed lines); the first copy of a key wins.
+    """
+    index = {}
+    invalid = 0
+    for text in texts:
+        for line in text.splitlines():
+            try:
+                key = parse_key(line)
+            except KeyParseError as e:
+                invalid += 1
+                if invalid <= 5:
+                    log(f"Skipping malformed key: {e}")
+                continue
+            if key is not None and key.fingerprint not in index:
+                index[key.fingerprint] = key
+    return index, invalid
+
+
+def split_sources(value):
+    """Key sources from a setting: a list, or one string with sources separated by ';' or newlines."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = re.split(r"[;\n]", value)
+    return [source.strip() for source in value if source and source.strip()]
+
+
+def read_source(source, fetcher=None):
+    """The text of a key source: a file, every file in a directory, or an http(s) URL."""
+    try:
+        if re.match(r"^https?://", source, re.I):
+            response = (fetcher or get_fetcher()).get(source)
+            response.raise_for_status()
+            return response.text
+        if os.path.isdir(source):
+            names = sorted(name for name in os.listdir(source) if not name.startswith("."))
+            paths = [os.path.join(source, name) for name in names]
+            return "\n".join(_read_text(path) for path in paths if os.path.isfile(path))
+        return _read_text(source)
+    except (OSError, requests.RequestException) as e:
+        raise KeySourceError(f"Could not read SSH keys from {source}: {e}")
+
+
+def _read_text(path):
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8-sig", "replace")
+
+
+class AclPolicy:
+    """Sets the permissions of an authorized_keys file; applied before it replaces the old file."""
+
+    def apply(self, path):
+        raise NotImplementedError
+
+
+class NoAcl(AclPolicy):
+    def apply(self, path):
+        pass
+
+
+class ModeAcl(AclPolicy):
+    """POSIX permissions; sshd refuses key files that others can write."""
+
+    def __init__(self, mode=0o600):
+        self.mode = mode
+
+    def apply(self, path):
+        os.chmod(path, self.mode)
+
+
+class IcaclsAcl(AclPolicy):
+    """
+    Replaces the file's inherited permissions with full control for `grants`
+    only, which is what sshd on Windows requires of key files.
+    """
+
+    def __init__(self, grants):
+        self.grants = list(grants)
+
+    def apply(self, path):
+        args = ["icacls", path, "/inheritance:r"]
+        for grant in self.grants:
+            args += ["/grant:r", f"{grant}:F"]
+        run_command(args, check=True, stream=False)
+
+
+def default_target():
+    """The key file sshd on Windows reads for members of the Administrators group."""
+    program_data = os.environ.get("ProgramData", r"C:\ProgramData")
+    return os.path.join(program_data, "ssh", "administrators_authorized_keys")
+
+
+def default_acl(target):
+    if os.name != "nt":
+        return ModeAcl()
+    if os.path.basename(target).lower() == "administrators_authorized_keys":
+        return IcaclsAcl([ADMINISTRATORS_SID, SYSTEM_SID])
+    return IcaclsAcl([getpass.getuser(), ADMINISTRATORS_SID, SYSTEM_SID])
+
+
+class KeySyncResult(namedtuple("KeySyncResult", ["added", "removed", "updated", "total", "invalid", "written"])):
+    """Fingerprints added, removed and rewritten (changed options or comment) by a sync."""
+
+    @property
+    def changed(self):
+        return bool(self.added or self.removed or self.updated)
+
+    def summary(self):
+        return (f"{len(self.added)} added, {len(self.removed)} removed, {len(self.updated)} updated, "
+                f"{self.total} key(s) in total")
+
+
+def _read_state(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) and state.get("version") == STATE_VERSION else {}
+
+
+def _digest(parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _read_all(sources, fetcher):
+    texts, failed = [], []
+    for source in split_sources(sources):
+        try:
+            texts.append(read_source(source, fetcher))
+        except KeySourceError as e:
+            log(str(e))
+            failed.append(source)
+    return texts, failed
+
+
+def sync_authorized_keys(target, sources, revoked=(), acl=None, state_path=None, fetcher=None):
+    """
+    Apply the keys from sources (and the revocations in revoked) to target and
+    return a KeySyncResult. The target is rewritten atomically, with acl (the
+    platform default when None) applied first, and only when a key changed.
+
+    While any source cannot be read, keys are only added: nothing is removed
+    because it seems to have disappeared from a source.
+    """
+    acl = acl or default_acl(target)
+    state_path = state_path or target + STATE_SUFFIX
+    state = _read_state(state_path)
+
+    texts, failed = _read_all(sources, fetcher)
+    revoked_texts, revoked_failed = _read_all(revoked, fetcher)
+    failed += revoked_failed
+    sources_digest = None if failed else _digest(texts + ["revoked"] + revoked_texts)
+    try:
+        with open(target, "rb") as f:
+            current = f.read()
+    except FileNotFoundError:
+        current = None
+    target_digest = hashlib.sha256(current).hexdigest() if current is not None else None
+
+    # Fast path: the same sources applied to the same file give the same result
+    if sources_digest is not None and state.get("sources_sha256") == sources_digest \
+            and state.get("target_sha256") == target_digest:
+        return KeySyncResult([], [], [], state.get("total", 0), 0, False)
+
+    desired, invalid = index_keys(texts)
+    revoked_keys, _ = index_keys(revoked_texts)
+    for key_fingerprint in revoked_keys:
+        desired.pop(key_fingerprint, None)
+    managed = set(state.get("managed") or ())
+
+    text = current.decode("utf-8-sig", "replace") if current is not None else ""
+    newline = "\r\n" if "\r\n" in text[:text.find("\n") + 1] else "\n"
+    lines = []
+    present = set()
+    removed, updated = [], []
+    # Lines that are exactly a wanted key in canonical form need no parsing
+    canonical = {key.line(): fp for fp, key in desired.items()}
+    for line in text.splitlines(keepends=True):
+        fp = canonical.get(line.strip())
+        if fp is None:
+            try:
+                key = parse_key(line)
+            except KeyParseError:
+                key = None
+            if key is None:
+                lines.append(line)
+                continue
+            fp = key.fingerprint
+        if fp in present or fp in revoked_keys or (not failed and fp in managed and fp not in desired):
+            # Duplicates of a key already in the file are dropped along with revoked keys
+            removed.append(fp)
+            continue
+        present.add(fp)
+        wanted = desired.get(fp)
+        if fp in managed and wanted is not None and wanted.line() != line.strip():
+            lines.append(wanted.line() + newline)
+            updated.append(fp)
+        else:
+            lines.append(line)
+
+    added = [fp for fp in desired if fp not in present]
+    if added and lines and not lines[-1].endswith("\n"):
+        lines[-1] += newline
+    lines.extend(desired[fp].line() + newline for fp in added)
+
+    result = KeySyncResult(added, removed, updated, len(present) + len(added), invalid, False)
+    data = "".join(lines).encode("utf-8")
+    if result.changed:
+        write_atomic(target, data, prepare=acl.apply)
+        result = result._replace(written=True)
+        target_digest = hashlib.sha256(data).hexdigest()
+
+    final = present | set(added)
+    state = {
+        "version": STATE_VERSION,
+        "managed": sorted((managed | set(added)) & final),
+        "sources_sha256": sources_digest,
+        "target_sha256": target_digest,
+        "total": result.total,
+    }
+    try:
+        write_atomic(state_path, json.dumps(state))
+    except OSError as e:
+        # Without the state the next sync only takes longer, and removes nothing it did not add
+        log(f"Could not record the synced SSH keys in {state_path}: {e}")
+    return result
+
+
+def target_changed(target, state_path=None):
+    """Whether target differs from what the last sync left there (True when no sync has run)."""
+    state = _read_state(state_path or target + STATE_SUFFIX)
+    try:
+        with open(target, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        digest = None
+    return not state or state.get("target_sha256") != digest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    sync_parser = commands.add_parser("sync", help="apply keys from files, directories and URLs to a key file")
+    sync_parser.add_argument("sources", nargs="+")
+    sync_parser.add_argument("--target", default=default_target(), help=f"key file (default: {default_target()})")
+    sync_parser.add_argument("--revoked", action="append", default=[], help="file, directory or URL of revoked keys")
+    fingerprint_parser = commands.add_parser("fingerprint", help="list the fingerprints of the keys in a file")
+    fingerprint_parser.add_argument("path")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "sync":
+            result = sync_authorized_keys(args.target, args.sources, args.revoked)
+            print(f"{args.target}: {result.summary()}")
+        else:
+            keys, invalid = index_keys([read_source(args.path)])
+            for key in keys.values():
+                print(f"{key.fingerprint}  {key.keytype}  {key.comment}")
+            if invalid:
+                print(f"{invalid} malformed line(s)", file=sys.stderr)
+    except (OSError, KeySourceError, subprocess.SubprocessError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,977 @@
+"""
+Installer benchmarks that run on any machine, without a Windows host.
+
+    python benchmark.py download --size-mb 64
+    python benchmark.py startup
+    python benchmark.py fleet --hosts 500
+    python benchmark.py gui-log --lines 10000
+    python benchmark.py e2e [--save-baseline]
+    python benchmark.py fetch --requests 200
+    python benchmark.py hosts --lines 500000
+    python benchmark.py mirror --clients 24
+    python benchmark.py keys --keys 50000
+    python benchmark.py reconcile
+    python benchmark.py delta --ngrok-mb 24
+    python benchmark.py bundle
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+from simulator import LocalHTTPServer
+
+
+def peak_rss_kb():
+    """Peak resident set size of this process in KiB, or None where unsupported."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == "darwin" else usage
+
+
+def write_random_file(path, size):
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(1024 * 1024, remaining))
+            digest.update(chunk)
+            f.write(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def _download_worker(method, url, dest, sha256):
+    """Run one download in this process and print its timing and peak RSS as JSON."""
+    import requests
+    from download import download_file
+
+    start = time.perf_counter()
+    if method == "legacy":
+        response = requests.get(url)
+        response.raise_for_status()
+        with open(dest, "wb") as f:
+            f.write(response.content)
+    else:
+        segments = 1 if method == "stream" else 4
+        download_file(url, dest, sha256=sha256, segments=segments)
+    seconds = time.perf_counter() - start
+    print(json.dumps({"seconds": seconds, "peak_rss_kb": peak_rss_kb()}))
+
+
+def bench_download(size_mb):
+    size = size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "artifact.zip")
+        sha256 = write_random_file(source, size)
+
+        with LocalHTTPServer({"/artifact.zip": source}) as server:
+            print(f"{'method':<12}{'seconds':>10}{'MiB/s':>10}{'peak RSS MiB':>15}")
+            for method in ("legacy", "stream", "segmented"):
+                dest = os.path.join(tmp, f"{method}.zip")
+                output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), "_download-worker", method, server.url("/artifact.zip"), dest, sha256],
+                    text=True,
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                )
+                result = json.loads(output.strip().splitlines()[-1])
+                rss = result["peak_rss_kb"]
+                print(
+                    f"{method:<12}{result['seconds']:>10.2f}{size_mb / result['seconds']:>10.1f}"
+                    f"{(rss / 1024 if rss else float('nan')):>15.1f}"
+                )
+
+        # Interrupted transfer: the second call must only fetch what the first one missed
+        from download import download_file, DownloadError
+
+        dest = os.path.join(tmp, "resumed.zip")
+        with LocalHTTPServer({"/artifact.zip": source}, fail_after=size // 2) as server:
+            try:
+                download_file(server.url("/artifact.zip"), dest, sha256=sha256, segments=1, retries=1)
+            except DownloadError:
+                pass
+            sent_before = server.bytes_sent
+            download_file(server.url("/artifact.zip"), dest, sha256=sha256, segments=1, retries=1)
+            resumed = server.bytes_sent - sent_before
+        print(f"resume: second attempt transferred {resumed / size:.0%} of the file")
+
+
+STARTUP_PATHS = {
+    "headless": "import cli, installer; import sys; assert 'PyQt5' not in sys.modules",
+    "gui": "import cli, installer, gui",
+}
+
+
+def bench_startup(runs):
+    """Compare interpreter start-up plus imports for the headless and GUI entry points."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'entry point':<12}{'median ms':>12}{'min ms':>10}")
+    for name, code in STARTUP_PATHS.items():
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            completed = subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True, text=True)
+            timings.append((time.perf_counter() - start) * 1000)
+            if completed.returncode != 0:
+                print(f"{name:<12}unavailable: {completed.stderr.strip().splitlines()[-1]}")
+                break
+        else:
+            timings.sort()
+            print(f"{name:<12}{timings[len(timings) // 2]:>12.0f}{timings[0]:>10.0f}")
+
+
+def bench_fleet(hosts, latency):
+    """Scheduling throughput of the fleet runner against simulated hosts."""
+    import asyncio
+    import io
+    from fleet import FakeTransport, FleetRunner
+
+    inventory = [(f"host{i:04d}", {}) for i in range(hosts)]
+    print(f"{'concurrency':<12}{'seconds':>10}{'hosts/s':>10}{'ideal s':>10}")
+    for concurrency in (1, 10, 50, 200):
+        if concurrency == 1 and hosts * latency > 30:
+            continue
+        transport = FakeTransport(latency=(latency, latency), seed=1)
+        runner = FleetRunner(transport, concurrency=concurrency, progress_interval=3600, out=io.StringIO())
+        result = asyncio.run(runner.run(inventory))
+        ideal = -(-hosts // concurrency) * latency
+        print(f"{concurrency:<12}{result.wall_time:>10.2f}{hosts / result.wall_time:>10.1f}{ideal:>10.2f}")
+
+
+def bench_gui_log(lines):
+    """UI-thread time spent showing log lines: one signal per line vs. timer batches."""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtCore import QDateTime
+    from PyQt5.QtWidgets import QApplication, QTextEdit
+    from log_pipeline import LogPipeline
+
+    app = QApplication.instance() or QApplication([])
+    text = [f"verbose subprocess output line {i}" for i in range(lines)]
+
+    # Previous behaviour: every print reached update_log, which appended and scrolled
+    widget = QTextEdit()
+    start = time.perf_counter()
+    for line in text:
+        timestamp = QDateTime.currentDateTime().toString("yyyy-MM-dd hh:mm:ss")
+        widget.append(f"[{timestamp}] {line}")
+        scrollbar = widget.verticalScrollBar()
+        scrollbar.setValue(scrollbar.maximum())
+        app.processEvents()
+    legacy = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pipeline = LogPipeline(spill_path=os.path.join(tmp, "install.log"))
+        writer = threading.Thread(target=lambda: [pipeline.write(line + "\n") for line in text])
+        writer.start()
+        writer.join()
+
+        widget = QTextEdit()
+        widget.document().setMaximumBlockCount(pipeline.max_visible_lines)
+        start = time.perf_counter()
+        batches = 0
+        while pipeline.pending():
+            widget.append("\n".join(pipeline.drain()))
+            scrollbar = widget.verticalScrollBar()
+            scrollbar.setValue(scrollbar.maximum())
+            app.processEvents()
+            batches += 1
+        batched = time.perf_counter() - start
+        pipeline.close()
+
+    print(f"{'mode':<10}{'UI ms':>10}{'ms/1k lines':>13}{'widget lines':>14}")
+    print(f"{'per-line':<10}{legacy * 1000:>10.0f}{legacy * 1e6 / lines:>13.1f}{lines:>14}")
+    print(f"{'batched':<10}{batched * 1000:>10.0f}{batched * 1e6 / lines:>13.1f}{widget.document().blockCount():>14}")
+    print(f"batched mode used {batches} timer ticks")
+
+
+def bench_fetch(count):
+    """Connection reuse, retries and the circuit breaker of the shared fetch layer."""
+    import requests
+    from fetch import CircuitOpenError, Fetcher
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "small.bin")
+        write_random_file(source, 64 * 1024)
+
+        print(f"{'client':<22}{'seconds':>10}{'requests':>10}{'connections':>13}")
+        with LocalHTTPServer({"/small.bin": source}) as server:
+            start = time.perf_counter()
+            for _ in range(count):
+                requests.get(server.url("/small.bin")).raise_for_status()
+            print(f"{'requests.get':<22}{time.perf_counter() - start:>10.2f}{server.requests:>10}{server.connections:>13}")
+        with LocalHTTPServer({"/small.bin": source}) as server:
+            fetcher = Fetcher()
+            start = time.perf_counter()
+            for _ in range(count):
+                fetcher.get(server.url("/small.bin")).raise_for_status()
+            print(f"{'Fetcher (pooled)':<22}{time.perf_counter() - start:>10.2f}{server.requests:>10}{server.connections:>13}")
+            fetcher.close()
+
+        with LocalHTTPServer({"/small.bin": source}, fail_statuses=[503, 503, 502]) as server:
+            waits = []
+            fetcher = Fetcher(sleep=waits.append)
+            response = fetcher.get(server.url("/small.bin"))
+            print(f"retry: HTTP {response.status_code} after {server.requests} requests, "
+                  f"backoff waits {', '.join(f'{w:.2f}s' for w in waits)}")
+            fetcher.close()
+
+        with LocalHTTPServer({}) as server:
+            dead_url = server.url("/small.bin")
+        fetcher = Fetcher(retries=0, connect_timeout=1, breaker_threshold=3)
+        outcomes = []
+        start = time.perf_counter()
+        for _ in range(6):
+            try:
+                fetcher.get(dead_url)
+            except CircuitOpenError:
+                outcomes.append("open")
+            except requests.RequestException:
+                outcomes.append("error")
+        print(f"breaker: {' '.join(outcomes)} in {time.perf_counter() - start:.2f}s "
+              f"(state {fetcher.breaker(dead_url).state})")
+        fetcher.close()
+
+
+def write_blocklist_hosts(path, lines):
+    """A managed hosts file: a header, then blocklist entries with a comment every 100 lines."""
+    with open(path, "wb") as f:
+        f.write(b"# Copyright (c) 1993-2009 Microsoft Corp.\r\n127.0.0.1 localhost\r\n")
+        for i in range(lines):
+            if i % 100 == 0:
+                f.write(f"# block {i // 100}\r\n".encode())
+            else:
+                f.write(f"0.0.0.0 ads{i}.tracker{i % 997}.example.com\r\n".encode())
+
+
+def bench_hosts(lines):
+    """Checking for and adding the RDP alias in a large hosts file."""
+    import tracemalloc
+    from hosts_file import update_hosts_file
+
+    alias = ("127.0.0.2", "procesure")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "hosts")
+        print(f"{'operation':<32}{'ms':>9}{'peak MiB':>10}  result")
+
+        def measure(label, func):
+            tracemalloc.start()
+            start = time.perf_counter()
+            result = func()
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{label:<32}{seconds * 1000:>9.0f}{peak / 2 ** 20:>10.1f}  {result}")
+
+        def legacy():
+            # Previous behaviour: substring test on the whole file, then append
+            with open(path, "r") as f:
+                exists = "127.0.0.2 procesure" in f.read()
+            if not exists:
+                with open(path, "a") as f:
+                    f.write("\n127.0.0.2 procesure\n")
+            return "present" if exists else "appended"
+
+        write_blocklist_hosts(path, lines)
+        measure("legacy check + append", legacy)
+        measure("legacy check (present)", legacy)
+
+        write_blocklist_hosts(path, lines)
+        # A near miss that the substring test used to accept
+        update_hosts_file(path, add=[("127.0.0.2", "procesure2")])
+        measure("legacy check, near miss", legacy)
+
+        write_blocklist_hosts(path, lines)
+        measure("update: add alias", lambda: "changed" if update_hosts_file(path, add=[alias]).changed else "unchanged")
+        measure("update: alias present", lambda: "changed" if update_hosts_file(path, add=[alias]).changed else "unchanged")
+        measure("update: remove alias", lambda: "changed" if update_hosts_file(path, remove=[alias]).changed else "unchanged")
+
+
+E2E_VERSIONS = ("Windows11", "Windows10", "WindowsServer2016")
+E2E_METRICS = ("cold_seconds", "warm_seconds", "process_spawns", "bytes_on_wire", "peak_rss_kb")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "e2e-baseline.json")
+
+
+def build_archives(directory, ngrok_mb):
+    """Write stand-ins for the ngrok and OpenSSH downloads and return their paths."""
+    ngrok_zip = os.path.join(directory, "ngrok-stable-windows-amd64.zip")
+    with zipfile.ZipFile(ngrok_zip, "w") as archive:
+        archive.writestr("ngrok.exe", os.urandom(ngrok_mb * 1024 * 1024))
+    openssh_zip = os.path.join(directory, "OpenSSH-Win64.zip")
+    with zipfile.ZipFile(openssh_zip, "w") as archive:
+        archive.writestr("OpenSSH-Win64/sshd.exe", os.urandom(2 * 1024 * 1024))
+        archive.writestr("OpenSSH-Win64/install-sshd.ps1", "# install sshd\n")
+    return ngrok_zip, openssh_zip
+
+
+def _read_lines(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().splitlines()
+    except OSError:
+        return None
+
+
+def _e2e_worker(windows_version, ngrok_zip, openssh_zip, latency_scale):
+    """Install on a fresh simulated host twice (cold, then already configured) and print JSON."""
+    import artifacts
+    from artifact_cache import ArtifactCache
+    from events import LogMessage, bus
+    from installer import run_installation
+    from instrumentation import RunRecorder
+    from simulator import SimulatedHost, simulate
+
+    # The install log is not part of the result
+    bus.subscribe(lambda event: None, LogMessage)
+    result = {"runs": {}}
+    with tempfile.TemporaryDirectory() as tmp, \
+            LocalHTTPServer({"/ngrok.zip": ngrok_zip, "/openssh.zip": openssh_zip}) as server:
+        artifacts.set_cache(ArtifactCache(os.path.join(tmp, "cache")))
+        artifacts.override_url(artifacts.NGROK, server.url("/ngrok.zip"))
+        artifacts.override_url(artifacts.OPENSSH, server.url("/openssh.zip"))
+        host = SimulatedHost(windows_version, os.path.join(tmp, "Windows"), latency_scale=latency_scale)
+        install_path = os.path.join(tmp, "Procesure")
+        keys = write_key_lines(os.path.join(tmp, "authorized_keys"), 20)
+
+        for phase in ("cold", "warm"):
+            sent_before = server.bytes_sent
+            recorder = RunRecorder().start()
+            start = time.perf_counter()
+            with simulate(host):
+                run_installation(windows_version, "token", "1.tcp.ngrok.io:20000", install_path,
+                                 os.path.join(tmp, "authorized_keys"))
+            seconds = time.perf_counter() - start
+            recorder.stop()
+            totals = recorder.report()["totals"]
+            result["runs"][phase] = {
+                "seconds": seconds,
+                "process_spawns": totals["process_spawns"],
+                "commands": totals["commands"],
+                "bytes_on_wire": server.bytes_sent - sent_before,
+            }
+
+        state = host.probe()
+        result["converged"] = (
+            state["services"].get("sshd") == {"status": "Running", "start_type": "Automatic"}
+            and state["services"].get("ngrok", {}).get("status") == "Running" and "ssh" in (host.tunnels() or ())
+            and state["deny_ts_connections"] == 0 and state["user_authentication"] == 1
+            and host.credential_backend.read("TERMSRV/127.0.0.2") is not None
+            and "127.0.0.2 procesure" in host.hosts_entries()
+            and _read_lines(os.path.join(host.program_data, "ssh", "administrators_authorized_keys")) == keys
+        )
+    result["peak_rss_kb"] = peak_rss_kb()
+    print(json.dumps(result))
+
+
+def bench_e2e(ngrok_mb, latency_scale, baseline_path, save_baseline, tolerance):
+    """Full installs against a simulated host for every supported Windows version."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        ngrok_zip, openssh_zip = build_archives(tmp, ngrok_mb)
+        for windows_version in E2E_VERSIONS:
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), "_e2e-worker", windows_version, ngrok_zip, openssh_zip,
+                 str(latency_scale)],
+                text=True,
+                cwd=here,
+            )
+            worker = json.loads(output.strip().splitlines()[-1])
+            cold, warm = worker["runs"]["cold"], worker["runs"]["warm"]
+            results[windows_version] = {
+                "cold_seconds": round(cold["seconds"], 3),
+                "warm_seconds": round(warm["seconds"], 3),
+                "process_spawns": cold["process_spawns"],
+                "warm_process_spawns": warm["process_spawns"],
+                "bytes_on_wire": cold["bytes_on_wire"],
+                "warm_bytes_on_wire": warm["bytes_on_wire"],
+                "peak_rss_kb": worker["peak_rss_kb"],
+                "converged": worker["converged"],
+            }
+
+    baseline = None
+    if not save_baseline and os.path.exists(baseline_path):
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("latency_scale") != latency_scale or baseline.get("ngrok_mb") != ngrok_mb:
+            print(f"Baseline {baseline_path} was recorded with other settings, not comparing")
+            baseline = None
+
+    print(f"{'version':<20}{'cold s':>9}{'warm s':>9}{'spawns':>8}{'warm':>6}{'KiB wire':>10}{'warm':>6}"
+          f"{'RSS MiB':>9}  converged")
+    regressions = []
+    for windows_version, row in results.items():
+        rss = row["peak_rss_kb"]
+        print(
+            f"{windows_version:<20}{row['cold_seconds']:>9.2f}{row['warm_seconds']:>9.2f}"
+            f"{row['process_spawns']:>8}{row['warm_process_spawns']:>6}"
+            f"{row['bytes_on_wire'] // 1024:>10}{row['warm_bytes_on_wire'] // 1024:>6}"
+            f"{(rss / 1024 if rss else float('nan')):>9.1f}  {'yes' if row['converged'] else 'NO'}"
+        )
+        previous = (baseline or {}).get("results", {}).get(windows_version)
+        for metric in E2E_METRICS if previous else ():
+            old, new = previous.get(metric), row[metric]
+            # Sub-50 ms timing differences are noise, not regressions
+            if old and new and new > old * (1 + tolerance) and not (metric.endswith("seconds") and new - old < 0.05):
+                regressions.append(f"{windows_version} {metric}: {old} -> {new} (+{(new - old) / old:.0%})")
+
+    if save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump({
+                "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": sys.version.split()[0],
+                "platform": sys.platform,
+                "latency_scale": latency_scale,
+                "ngrok_mb": ngrok_mb,
+                "results": results,
+            }, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {baseline_path}")
+    elif baseline is not None:
+        print(f"Compared with the baseline recorded at {baseline['recorded_at']} (tolerance {tolerance:.0%})")
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+
+    if not all(row["converged"] for row in results.values()):
+        print("A simulated host did not reach the configured state")
+        return 1
+    return 1 if regressions else 0
+
+
+def bench_mirror(clients, ngrok_mb, max_transfers):
+    """Many peers installing from one LAN mirror, plus its fallback to upstream."""
+    import tracemalloc
+    from artifact_cache import ArtifactCache
+    from artifacts import Artifact, download_artifact
+    from download import download_file, sha256_file
+    from mirror import MirrorClient, MirrorServer, set_mirror
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ngrok_zip, openssh_zip = build_archives(tmp, ngrok_mb)
+        files = {"/ngrok.zip": ngrok_zip, "/openssh.zip": openssh_zip}
+        with LocalHTTPServer(files) as upstream:
+            # Peers only take pinned artifacts from a mirror
+            artifacts = [Artifact("ngrok", upstream.url("/ngrok.zip"), sha256_file(ngrok_zip)),
+                         Artifact("openssh", upstream.url("/openssh.zip"), sha256_file(openssh_zip))]
+            cache = ArtifactCache(os.path.join(tmp, "mirror-cache"))
+            for artifact in artifacts:
+                cache.fetch(artifact.url, lambda dest, url=artifact.url: download_file(url, dest))
+            seeded = upstream.bytes_sent
+
+            with MirrorServer(cache, "127.0.0.1", 0, max_transfers, discovery_port=None) as server:
+                errors = []
+
+                def peer(index):
+                    client = MirrorClient(server.url)
+                    try:
+                        for artifact in artifacts:
+                            client.download(artifact, os.path.join(tmp, f"peer{index}-{artifact.name}.zip"))
+                    except Exception as e:
+                        errors.append(e)
+                    finally:
+                        client.fetcher.close()
+
+                tracemalloc.start()
+                start = time.perf_counter()
+                threads = [threading.Thread(target=peer, args=(i,)) for i in range(clients)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                seconds = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                total = sum(os.path.getsize(path) for path in (ngrok_zip, openssh_zip))
+                print(f"{'peers':<8}{'seconds':>9}{'MiB/s':>9}{'mirror MiB':>12}{'upstream MiB':>14}"
+                      f"{'peak xfers':>12}{'503s':>6}{'traced MiB':>12}")
+                print(f"{clients:<8}{seconds:>9.2f}{server.bytes_sent / 2 ** 20 / seconds:>9.1f}"
+                      f"{server.bytes_sent / 2 ** 20:>12.1f}{(upstream.bytes_sent - seeded) / 2 ** 20:>14.1f}"
+                      f"{server.peak_active:>12}{server.busy_responses:>6}{peak / 2 ** 20:>12.1f}")
+                print(f"every peer got both artifacts: {not errors and server.bytes_sent == clients * total}"
+                      + (f" ({len(errors)} failed: {errors[0]})" if errors else ""))
+
+                # A copy that no longer matches its hash must be refused by the peer, not installed
+                ngrok_object = cache.object_path(cache.entries()[artifacts[0].url]["sha256"])
+                stat = os.stat(ngrok_object)
+                with open(ngrok_object, "r+b") as f:
+                    f.write(b"corrupt!")
+                os.utime(ngrok_object, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                before = upstream.bytes_sent
+                previous = set_mirror(MirrorClient(server.url))
+                try:
+                    dest = os.path.join(tmp, "corrupt-peer.zip")
+                    download_artifact(artifacts[0], dest)
+                finally:
+                    set_mirror(previous)
+                with open(dest, "rb") as got, open(ngrok_zip, "rb") as want:
+                    intact = got.read() == want.read()
+                print(f"corrupt mirror copy: fell back upstream ({(upstream.bytes_sent - before) / 2 ** 20:.1f} MiB), "
+                      f"result intact: {intact}")
+
+                # Without a pin the mirror's own hash is all there is to check against, so it is not used
+                sent, before = server.bytes_sent, upstream.bytes_sent
+                previous = set_mirror(MirrorClient(server.url))
+                try:
+                    download_artifact(artifacts[1]._replace(sha256=None), os.path.join(tmp, "unpinned-peer.zip"))
+                finally:
+                    set_mirror(previous)
+                print(f"unpinned artifact: {(server.bytes_sent - sent) / 2 ** 20:.1f} MiB from the mirror, "
+                      f"{(upstream.bytes_sent - before) / 2 ** 20:.1f} MiB upstream")
+
+            previous = set_mirror(MirrorClient(server.url))
+            try:
+                start = time.perf_counter()
+                download_artifact(artifacts[1], os.path.join(tmp, "no-mirror-peer.zip"))
+                print(f"mirror down: fell back upstream in {time.perf_counter() - start:.2f}s")
+            finally:
+                set_mirror(previous)
+
+
+def write_key_lines(path, count, start=0, overlap_every=0):
+    """Write `count` synthetic public keys (mostly ed25519, every tenth RSA-sized) and return their lines."""
+    import base64
+
+    lines = []
+    for i in range(start, start + count):
+        keytype = "ssh-rsa" if i % 10 == 0 else "ssh-ed25519"
+        # Deterministic per index, so several sources can share keys
+        body = hashlib.sha256(str(i).encode()).digest() * (9 if keytype == "ssh-rsa" else 1)
+        raw = len(keytype).to_bytes(4, "big") + keytype.encode() + len(body).to_bytes(4, "big") + body
+        lines.append(f"{keytype} {base64.b64encode(raw).decode()} engineer{i}@example.com")
+    with open(path, "w", newline="\n") as f:
+        f.write("\n".join(lines) + "\n")
+    return lines
+
+
+def bench_keys(count):
+    """Syncing a large key set into authorized_keys: first sync, no-op resyncs, small incremental changes."""
+    from authorized_keys import NoAcl, sync_authorized_keys
+
+    with tempfile.TemporaryDirectory() as tmp:
+        team_dir = os.path.join(tmp, "team")
+        os.mkdir(team_dir)
+        # Three overlapping sources: two files in a directory and a URL, sharing a tenth of their keys
+        third = count // 3
+        write_key_lines(os.path.join(team_dir, "a.keys"), third + count // 30)
+        write_key_lines(os.path.join(team_dir, "b.keys"), third + count // 30, start=third)
+        remote = os.path.join(tmp, "remote.keys")
+        write_key_lines(remote, count - 2 * third, start=2 * third)
+        target = os.path.join(tmp, "administrators_authorized_keys")
+        with open(target, "w") as f:
+            f.write("# added by hand\nssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBYvWqKbfq7d1N3O0aBiHpOBHcfHrKX5BdXLx8qAZfz1 admin\n")
+
+        with LocalHTTPServer({"/team.keys": remote}) as server:
+            sources = [team_dir, server.url("/team.keys")]
+            print(f"{'sync':<34}{'seconds':>9}{'added':>8}{'removed':>9}{'total':>8}{'written':>9}")
+
+            def measure(label, **kwargs):
+                start = time.perf_counter()
+                result = sync_authorized_keys(target, kwargs.pop("sources", sources), acl=NoAcl(), **kwargs)
+                seconds = time.perf_counter() - start
+                print(f"{label:<34}{seconds:>9.3f}{len(result.added):>8}{len(result.removed):>9}"
+                      f"{result.total:>8}{str(result.written):>9}")
+                return result
+
+            measure(f"first sync ({count} keys)")
+            measure("unchanged sources and file")
+            with open(target, "a") as f:
+                f.write("# touched\n")
+            measure("file edited, keys unchanged")
+
+            # Rotate a few hundred keys: new ones in one file, others gone from another
+            changed = max(1, count // 100)
+            write_key_lines(os.path.join(team_dir, "c.keys"), changed, start=count)
+            write_key_lines(os.path.join(team_dir, "a.keys"), third + count // 30 - changed, start=changed)
+            measure(f"{changed} added, {changed} dropped")
+            revoked = os.path.join(tmp, "revoked.keys")
+            write_key_lines(revoked, 10, start=third)
+            measure("10 revoked", revoked=[revoked])
+            measure("one source unreachable", sources=sources + [os.path.join(tmp, "missing.keys")],
+                    revoked=[revoked])
+
+            # Malformed lines in a source and in the key file are skipped, never fatal
+            malformed = ['"unbalanced ssh-rsa AAAAB3NzaC1yc2E', 'ssh-ed25519 not-base64!', 'no key here']
+            with open(os.path.join(team_dir, "broken.keys"), "w") as f:
+                f.write("\n".join(malformed) + "\n")
+            with open(target, "a") as f:
+                f.write(malformed[0] + "\n")
+            result = measure("malformed lines", revoked=[revoked])
+            kept = malformed[0] in _read_lines(target)
+            print(f"malformed source lines skipped: {result.invalid} of {len(malformed)}; "
+                  f"malformed line in the key file left alone: {kept}")
+
+
+def bench_reconcile(latency_scale):
+    """Drift detection on a simulated host: cost of a clean pass, and what each kind of drift re-runs."""
+    import artifacts
+    from artifact_cache import ArtifactCache
+    from events import LogMessage, bus
+    from installer import SETUP_CLASSES, run_installation
+    from reconcile import PollingWatcher, ReconcileDaemon, build_checks, default_watcher
+    from setup_classes import TERMINAL_SERVER_KEY
+    from simulator import SimulatedHost, simulate
+    from utils import RDP_CREDENTIAL_TARGET
+
+    bus.subscribe(lambda event: None, LogMessage)
+    windows_version = "Windows11"
+    with tempfile.TemporaryDirectory() as tmp:
+        ngrok_zip, openssh_zip = build_archives(tmp, 2)
+        with LocalHTTPServer({"/ngrok.zip": ngrok_zip, "/openssh.zip": openssh_zip}) as server:
+            artifacts.set_cache(ArtifactCache(os.path.join(tmp, "cache")))
+            artifacts.override_url(artifacts.NGROK, server.url("/ngrok.zip"))
+            artifacts.override_url(artifacts.OPENSSH, server.url("/openssh.zip"))
+            host = SimulatedHost(windows_version, os.path.join(tmp, "Windows"), latency_scale=latency_scale)
+            install_path = os.path.join(tmp, "Procesure")
+            keys_path = os.path.join(tmp, "team.keys")
+            write_key_lines(keys_path, 50)
+            address = "1.tcp.ngrok.io:20000"
+
+            with simulate(host):
+                run_installation(windows_version, "token", address, install_path, keys_path)
+                checks = build_checks(SETUP_CLASSES[windows_version](), "token", address, install_path, keys_path)
+                daemon = ReconcileDaemon(checks)
+                daemon.run_once()
+                keys_target = os.path.join(host.program_data, "ssh", "administrators_authorized_keys")
+
+                def edit(path, transform):
+                    with open(path, "r") as f:
+                        text = f.read()
+                    with open(path, "w") as f:
+                        f.write(transform(text))
+
+                drifts = [
+                    ("none", lambda: None),
+                    ("sshd stopped", lambda: host.stop_service("sshd")),
+                    ("RDP disabled", lambda: host.set_registry_value(TERMINAL_SERVER_KEY, "fDenyTSConnections", 1)),
+                    ("hosts alias removed", lambda: edit(host.hosts_path, lambda t: t.replace("127.0.0.2 procesure", ""))),
+                    ("RDP credential deleted", lambda: host.credential_backend.delete(RDP_CREDENTIAL_TARGET)),
+                    ("ngrok service died", lambda: host.stop_service("ngrok")),
+                    ("agent.yml edited", lambda: edit(os.path.join(install_path, "agent.yml"), lambda t: t + "# x\n")),
+                    ("key file edited", lambda: edit(keys_target, lambda t: t.split("\n", 1)[1])),
+                ]
+                print(f"{'drift':<24}{'ms':>8}{'CPU ms':>8}{'commands':>10}{'spawns':>8}  re-ran")
+                for label, drift in drifts:
+                    drift()
+                    commands, processes = len(host.commands), host.processes
+                    cpu, start = time.process_time(), time.perf_counter()
+                    result = daemon.run_once()
+                    seconds, cpu = time.perf_counter() - start, time.process_time() - cpu
+                    commands, processes = len(host.commands) - commands, host.processes - processes
+                    clean = daemon.run_once().clean
+                    print(f"{label:<24}{seconds * 1000:>8.0f}{cpu * 1000:>8.0f}{commands:>10}"
+                          f"{processes:>8}  {', '.join(result.repaired) or '-'}"
+                          + ("" if clean else "  (still drifted)"))
+
+                # Start-Service fails with a non-terminating error; the repair must fail, not pass silently
+                host.stop_service("sshd")
+                host.fail_cmdlet("Start-Service", "Start-Service : Service 'OpenSSH SSH Server (sshd)' cannot be started.")
+                result = daemon.run_once()
+                host.fail_cmdlet("Start-Service", None)
+                print(f"{'sshd refuses to start':<24}  repair {'failed' if 'install_openssh' in result.failed else 'passed'}"
+                      f", {'repaired' if daemon.run_once().repaired == ['install_openssh'] else 'not repaired'} once it starts")
+
+                # Idle daemon: backing off, then woken by a file change
+                stop = threading.Event()
+                watcher = PollingWatcher(default_watcher(install_path).paths, poll_interval=0.05)
+                idle = ReconcileDaemon(checks, watcher, interval=0.1, max_interval=1.6)
+                thread = threading.Thread(target=idle.run, args=(stop,))
+                cpu = time.process_time()
+                thread.start()
+                time.sleep(4)
+                passes, idle_cpu = idle.passes, time.process_time() - cpu
+                edit(host.hosts_path, lambda t: t.replace("127.0.0.2 procesure", ""))
+                start = time.perf_counter()
+                while "127.0.0.2 procesure" not in host.hosts_entries() and time.perf_counter() - start < 5:
+                    time.sleep(0.01)
+                repaired_after = time.perf_counter() - start
+                stop.set()
+                thread.join()
+                print(f"idle: {passes} passes in 4s with backoff to 1.6s, {idle_cpu * 1000:.0f} ms CPU; "
+                      f"hosts alias restored {repaired_after * 1000:.0f} ms after it was removed")
+
+
+def write_release(old_path, new_path, seed=0):
+    """Write a plausible next release of the binary at old_path: scattered patches, shifted code and an appended section."""
+    import random
+
+    rng = random.Random(seed)
+    with open(old_path, "rb") as f:
+        data = bytearray(f.read())
+    for _ in range(len(data) // (256 * 1024)):
+        offset = rng.randrange(len(data) - 16)
+        data[offset:offset + 8] = os.urandom(8)
+    for _ in range(8):
+        offset = rng.randrange(len(data))
+        data[offset:offset] = os.urandom(rng.randrange(1024, 32 * 1024))
+    for _ in range(4):
+        offset = rng.randrange(len(data) - 32 * 1024)
+        del data[offset:offset + rng.randrange(1024, 32 * 1024)]
+    data += os.urandom(len(data) // 50)
+    with open(new_path, "wb") as f:
+        f.write(data)
+
+
+def bench_delta(ngrok_mb, latency_scale):
+    """ngrok.exe updates on a simulated host: delta vs. full download, and the fallbacks."""
+    import artifacts
+    from artifact_cache import ArtifactCache
+    from delta import INDEX_NAME, DeltaError, apply_delta, build_index, update_ngrok
+    from download import sha256_file
+    from events import LogMessage, bus
+    from installer import run_installation
+    from simulator import SimulatedHost, simulate
+
+    bus.subscribe(lambda event: None, LogMessage)
+    windows_version = "Windows11"
+    with tempfile.TemporaryDirectory() as tmp:
+        old_zip, openssh_zip = build_archives(tmp, ngrok_mb)
+        release = os.path.join(tmp, "release")
+        os.makedirs(release)
+        old_exe = os.path.join(release, "ngrok-old.exe")
+        with zipfile.ZipFile(old_zip) as archive, open(old_exe, "wb") as f:
+            f.write(archive.read("ngrok.exe"))
+        new_exe = os.path.join(release, "ngrok-new.exe")
+        write_release(old_exe, new_exe)
+        new_zip = os.path.join(release, "ngrok-new.zip")
+        with zipfile.ZipFile(new_zip, "w") as archive:
+            archive.write(new_exe, "ngrok.exe")
+
+        deltas = os.path.join(tmp, "deltas")
+        with LocalHTTPServer({"/ngrok.zip": old_zip, "/openssh.zip": openssh_zip}) as server:
+            # The release archive keeps the upstream URL the old one was installed from
+            start = time.perf_counter()
+            index = build_index(new_exe, [old_exe], deltas, new_zip, archive_url=server.url("/ngrok.zip"))
+            generate = time.perf_counter() - start
+            (entry,) = index["deltas"].values()
+            print(f"release: {os.path.getsize(new_exe) / 2 ** 20:.1f} MiB ngrok.exe, "
+                  f"{os.path.getsize(new_zip) / 2 ** 20:.1f} MiB archive; delta {entry['size'] / 2 ** 10:.0f} KiB "
+                  f"({entry['size'] / os.path.getsize(new_zip):.1%} of the archive), generated in {generate:.2f}s")
+            server.files["/deltas/" + INDEX_NAME] = os.path.join(deltas, INDEX_NAME)
+            server.files["/deltas/" + entry["url"]] = os.path.join(deltas, entry["url"])
+
+            artifacts.set_cache(ArtifactCache(os.path.join(tmp, "cache")))
+            artifacts.override_url(artifacts.NGROK, server.url("/ngrok.zip"))
+            artifacts.override_url(artifacts.OPENSSH, server.url("/openssh.zip"))
+            host = SimulatedHost(windows_version, os.path.join(tmp, "Windows"), latency_scale=latency_scale)
+            install_path = os.path.join(tmp, "Procesure")
+            ngrok_path = os.path.join(install_path, "ngrok.exe")
+            index_url = server.url("/deltas/" + INDEX_NAME)
+
+            with simulate(host):
+                # Installed from the old archive, which stays in the artifact cache under the upstream URL
+                run_installation(windows_version, "token", "1.tcp.ngrok.io:20000", install_path, None)
+                server.files["/ngrok.zip"] = new_zip
+                target = sha256_file(new_exe)
+
+                def install(path):
+                    with open(path, "rb") as src, open(ngrok_path, "wb") as dst:
+                        dst.write(src.read())
+
+                def corrupt_delta():
+                    server.files["/deltas/" + entry["url"]] = old_exe
+
+                # The first full update downloads the release archive; the second finds it in the cache
+                scenarios = [
+                    ("delta", lambda: None),
+                    ("already current", lambda: None),
+                    ("unknown version", lambda: install(new_zip)),
+                    ("damaged delta", lambda: (install(old_exe), corrupt_delta())),
+                ]
+                print(f"{'update':<18}{'action':>9}{'seconds':>9}{'KiB on wire':>13}  service commands")
+                for label, prepare in scenarios:
+                    prepare()
+                    sent, commands = server.bytes_sent, len(host.commands)
+                    try:
+                        result = update_ngrok(install_path, index_url)
+                        action, seconds = result.action, f"{result.seconds:.2f}"
+                    except DeltaError as e:
+                        action, seconds = "failed", "-"
+                        print(f"{label}: {e}")
+                    service = ", ".join(command.split()[-1] for command in host.commands[commands:]) or "-"
+                    ok = sha256_file(ngrok_path) == target and host.services["ngrok"]["status"] == "Running"
+                    print(f"{label:<18}{action:>9}{seconds:>9}"
+                          f"{(server.bytes_sent - sent) / 2 ** 10:>13.0f}  {service}"
+                          + ("" if ok else "  (not updated)"))
+
+            # Patch time alone, without the network or the service
+            start = time.perf_counter()
+            apply_delta(old_exe, os.path.join(deltas, entry["url"]), os.path.join(tmp, "patched.exe"))
+            print(f"patch alone: {time.perf_counter() - start:.3f}s to rebuild and verify "
+                  f"{os.path.getsize(new_exe) / 2 ** 20:.1f} MiB")
+
+
+def bench_bundle(ngrok_mb, latency_scale):
+    """Installs reading the archives from an offline bundle: a valid, a corrupt and an invalid pack."""
+    import artifacts
+    from artifact_cache import ArtifactCache
+    from bundle import BUNDLE_NAME, Bundle, build_bundle
+    from events import LogMessage, bus
+    from installer import run_installation
+    from scheduler import ScheduleFailed
+    from simulator import SimulatedHost, simulate
+
+    bus.subscribe(lambda event: None, LogMessage)
+    # Server 2016 takes OpenSSH from its archive too, so both bundle entries are read
+    windows_version = "WindowsServer2016"
+    with tempfile.TemporaryDirectory() as tmp:
+        ngrok_zip, openssh_zip = build_archives(tmp, ngrok_mb)
+        with zipfile.ZipFile(ngrok_zip) as archive:
+            ngrok_exe = archive.read("ngrok.exe")
+        with LocalHTTPServer({"/ngrok.zip": ngrok_zip, "/openssh.zip": openssh_zip}) as server:
+            artifacts.override_url(artifacts.NGROK, server.url("/ngrok.zip"))
+            artifacts.override_url(artifacts.OPENSSH, server.url("/openssh.zip"))
+            valid = os.path.join(tmp, "valid.pack")
+            build_bundle(valid, {"ngrok": (ngrok_zip, server.url("/ngrok.zip")),
+                                 "openssh": (openssh_zip, server.url("/openssh.zip"))})
+            with Bundle(valid) as bundle:
+                entry = bundle.entries["ngrok"]
+
+            def corrupt(path):
+                with open(path, "r+b") as f:
+                    f.seek(entry["offset"] + entry["size"] // 2)
+                    f.write(b"corrupt!")
+
+            def invalid(path):
+                with open(path, "r+b") as f:
+                    f.truncate(os.path.getsize(path) - 4)
+
+            scenarios = [
+                ("valid pack", None, 0),
+                ("corrupt ngrok entry", corrupt, os.path.getsize(ngrok_zip)),
+                ("invalid pack", invalid, os.path.getsize(ngrok_zip) + os.path.getsize(openssh_zip)),
+            ]
+            print(f"{'bundle':<22}{'seconds':>9}{'KiB downloaded':>16}{'expected':>10}  installed")
+            failures = 0
+            for number, (label, damage, expected) in enumerate(scenarios):
+                root = os.path.join(tmp, f"host{number}")
+                install_path = os.path.join(root, "Procesure")
+                os.makedirs(install_path)
+                pack = os.path.join(install_path, BUNDLE_NAME)
+                with open(valid, "rb") as src, open(pack, "wb") as dst:
+                    dst.write(src.read())
+                if damage:
+                    damage(pack)
+                artifacts.set_cache(ArtifactCache(os.path.join(root, "cache")))
+                host = SimulatedHost(windows_version, os.path.join(root, "Windows"), latency_scale=latency_scale)
+                sent, start = server.bytes_sent, time.perf_counter()
+                try:
+                    with simulate(host):
+                        run_installation(windows_version, "token", "1.tcp.ngrok.io:20000", install_path, None)
+                    with open(os.path.join(install_path, "ngrok.exe"), "rb") as f:
+                        installed = f.read() == ngrok_exe and host.probe()["services"].get("sshd") is not None
+                except ScheduleFailed:
+                    installed = False
+                downloaded = server.bytes_sent - sent
+                ok = installed and downloaded == expected
+                failures += not ok
+                print(f"{label:<22}{time.perf_counter() - start:>9.2f}{downloaded / 2 ** 10:>16.0f}"
+                      f"{expected / 2 ** 10:>10.0f}  {'yes' if installed else 'no'}" + ("" if ok else "  (unexpected)"))
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    download_parser = commands.add_parser("download", help="streaming/segmented download vs. requests.get().content")
+    download_parser.add_argument("--size-mb", type=int, default=64)
+
+    startup_parser = commands.add_parser("startup", help="import time of the headless entry point vs. the GUI")
+    startup_parser.add_argument("--runs", type=int, default=10)
+
+    fleet_parser = commands.add_parser("fleet", help="fleet rollout throughput with a fake transport")
+    fleet_parser.add_argument("--hosts", type=int, default=500)
+    fleet_parser.add_argument("--latency", type=float, default=0.05, help="simulated seconds per install")
+
+    gui_log_parser = commands.add_parser("gui-log", help="UI-thread time per log lines, needs PyQt5")
+    gui_log_parser.add_argument("--lines", type=int, default=10000)
+
+    e2e_parser = commands.add_parser("e2e", help="full installs against a simulated host, compared with a baseline")
+    e2e_parser.add_argument("--ngrok-mb", type=int, default=8, help="size of the simulated ngrok.exe")
+    e2e_parser.add_argument("--latency-scale", type=float, default=0.05,
+                            help="multiplier for the simulated host latencies (1.0 = a real host)")
+    e2e_parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    e2e_parser.add_argument("--save-baseline", action="store_true", help="record this run as the new baseline")
+    e2e_parser.add_argument("--tolerance", type=float, default=0.15, help="allowed growth before a metric is flagged")
+
+    e2e_worker_parser = commands.add_parser("_e2e-worker")
+    e2e_worker_parser.add_argument("windows_version")
+    e2e_worker_parser.add_argument("ngrok_zip")
+    e2e_worker_parser.add_argument("openssh_zip")
+    e2e_worker_parser.add_argument("latency_scale", type=float)
+
+    fetch_parser = commands.add_parser("fetch", help="connection reuse, retries and circuit breaker of the fetch layer")
+    fetch_parser.add_argument("--requests", type=int, default=200)
+
+    hosts_parser = commands.add_parser("hosts", help="hosts file check and update on a large synthetic file")
+    hosts_parser.add_argument("--lines", type=int, default=500000)
+
+    mirror_parser = commands.add_parser("mirror", help="concurrent peers downloading from a loopback LAN mirror")
+    mirror_parser.add_argument("--clients", type=int, default=24)
+    mirror_parser.add_argument("--ngrok-mb", type=int, default=8)
+    mirror_parser.add_argument("--max-transfers", type=int, default=8)
+
+    keys_parser = commands.add_parser("keys", help="authorized_keys sync of a large key set")
+    keys_parser.add_argument("--keys", type=int, default=50000)
+
+    reconcile_parser = commands.add_parser("reconcile", help="drift detection and repair on a simulated host")
+    reconcile_parser.add_argument("--latency-scale", type=float, default=0.05)
+
+    delta_parser = commands.add_parser("delta", help="ngrok.exe update from a binary delta vs. a full download")
+    delta_parser.add_argument("--ngrok-mb", type=int, default=24)
+    delta_parser.add_argument("--latency-scale", type=float, default=0.05)
+
+    bundle_parser = commands.add_parser("bundle", help="installs from a valid, a corrupt and an invalid offline bundle")
+    bundle_parser.add_argument("--ngrok-mb", type=int, default=8)
+    bundle_parser.add_argument("--latency-scale", type=float, default=0.01)
+
+    worker_parser = commands.add_parser("_download-worker")
+    worker_parser.add_argument("method")
+    worker_parser.add_argument("url")
+    worker_parser.add_argument("dest")
+    worker_parser.add_argument("sha256")
+
+    args = parser.parse_args(argv)
+    if args.command == "download":
+        bench_download(args.size_mb)
+    elif args.command == "startup":
+        bench_startup(args.runs)
+    elif args.command == "fleet":
+        bench_fleet(args.hosts, args.latency)
+    elif args.command == "gui-log":
+        bench_gui_log(args.lines)
+    elif args.command == "e2e":
+        return bench_e2e(args.ngrok_mb, args.latency_scale, args.baseline, args.save_baseline, args.tolerance)
+    elif args.command == "fetch":
+        bench_fetch(args.requests)
+    elif args.command == "hosts":
+        bench_hosts(args.lines)
+    elif args.command == "mirror":
+        bench_mirror(args.clients, args.ngrok_mb, args.max_transfers)
+    elif args.command == "keys":
+        bench_keys(args.keys)
+    elif args.command == "reconcile":
+        bench_reconcile(args.latency_scale)
+    elif args.command == "delta":
+        bench_delta(args.ngrok_mb, args.latency_scale)
+    elif args.command == "bundle":
+        return bench_bundle(args.ngrok_mb, args.latency_scale)
+    elif args.command == "_e2e-worker":
+        _e2e_worker(args.windows_version, args.ngrok_zip, args.openssh_zip, args.latency_scale)
+    elif args.command == "_download-worker":
+        _download_worker(args.method, args.url, args.dest, args.sha256)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
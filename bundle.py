@@ -0,0 +1,214 @@
+"""
+Offline installer bundles.
+
+A bundle is one pack file carrying the installer's artifacts (the ngrok and
+OpenSSH archives) for sites that cannot download them:
+
+    PROCPACK <version: u32>            header
+    <artifact bytes> ...               stored as downloaded, back to back
+    <manifest JSON>                    name -> offset, size, sha256, url
+    <manifest length: u64> PROCPACK    trailer
+
+The installer memory-maps the pack and hands extract_members a view of each
+archive at its offset, so nothing is unpacked besides the files it needs.
+
+    python bundle.py build procesure-bundle.pack
+    python bundle.py build procesure-bundle.pack --ngrok ngrok.zip --openssh OpenSSH-Win64.zip
+    python bundle.py list procesure-bundle.pack
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from atomicfile import fsync_directory
+from events import log
+
+
+BUNDLE_NAME = "procesure-bundle.pack"
+BUNDLE_ENV = "PROCESURE_BUNDLE"
+MAGIC = b"PROCPACK"
+VERSION = 1
+HEADER = struct.Struct("<8sI")
+TRAILER = struct.Struct("<Q8s")
+CHUNK_SIZE = 1024 * 1024
+
+
+class BundleError(Exception):
+    pass
+
+
+class Bundle:
+    """A pack file opened through a read-only memory map."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = None
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.entries = self._read_manifest()
+        except (ValueError, OSError, KeyError, TypeError, BundleError) as e:
+            self.close()
+            raise BundleError(f"{path} is not a valid installer bundle: {e}")
+        self._verified = set()
+        self._lock = threading.Lock()
+
+    def _read_manifest(self):
+        size = len(self._map)
+        if size < HEADER.size + TRAILER.size:
+            raise BundleError("file too short")
+        magic, version = HEADER.unpack_from(self._map, 0)
+        length, trailer_magic = TRAILER.unpack_from(self._map, size - TRAILER.size)
+        if magic != MAGIC or trailer_magic != MAGIC:
+            raise BundleError("bad magic")
+        if version != VERSION:
+            raise BundleError(f"unsupported version {version}")
+        start = size - TRAILER.size - length
+        if start < HEADER.size:
+            raise BundleError("bad manifest length")
+        entries = json.loads(self._map[start:size - TRAILER.size].decode("utf-8"))["artifacts"]
+        for name, entry in entries.items():
+            if entry["offset"] < HEADER.size or entry["offset"] + entry["size"] > start:
+                raise BundleError(f"{name} lies outside the data area")
+        return entries
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def view(self, name, sha256=None):
+        """
+        Return a memoryview of an artifact, checked against the manifest hash
+        (and sha256 when given) the first time it is read. Release the view
+        before closing the bundle.
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            raise BundleError(f"{self.path} does not contain {name}")
+        if sha256 and sha256.lower() != entry["sha256"]:
+            raise BundleError(f"{self.path} carries a different {name} than expected")
+        view = memoryview(self._map)[entry["offset"]:entry["offset"] + entry["size"]]
+        with self._lock:
+            verified = name in self._verified
+        if not verified:
+            if hashlib.sha256(view).hexdigest() != entry["sha256"]:
+                view.release()
+                raise BundleError(f"{name} in {self.path} is corrupt")
+            with self._lock:
+                self._verified.add(name)
+        return view
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+
+def bundle_search_dirs(*extra_dirs):
+    """Where an installer looks for a bundle: next to the executable (or script), then extra_dirs."""
+    if getattr(sys, "frozen", False):
+        here = os.path.dirname(sys.executable)
+    else:
+        here = os.path.dirname(os.path.abspath(sys.argv[0] or __file__))
+    return [here] + [d for d in extra_dirs if d]
+
+
+def find_bundle(*extra_dirs):
+    """Open the first bundle found ($PROCESURE_BUNDLE, then bundle_search_dirs), or return None."""
+    candidates = [os.environ.get(BUNDLE_ENV)] + [os.path.join(d, BUNDLE_NAME) for d in bundle_search_dirs(*extra_dirs)]
+    for path in candidates:
+        if path and os.path.isfile(path):
+            try:
+                bundle = Bundle(path)
+            except BundleError as e:
+                log(f"{e}, ignoring it.")
+                continue
+            log(f"Using installer bundle {path} ({', '.join(sorted(bundle.entries))}).")
+            return bundle
+    return None
+
+
+def build_bundle(path, sources):
+    """
+    Write a pack holding sources ({name: (file path, url)}) to path and return
+    its manifest entries. The pack is written under a temporary name and
+    renamed into place.
+    """
+    entries = {}
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as out:
+            out.write(HEADER.pack(MAGIC, VERSION))
+            for name, (source, url) in sources.items():
+                digest = hashlib.sha256()
+                offset = out.tell()
+                with open(source, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                        out.write(chunk)
+                entries[name] = {"offset": offset, "size": out.tell() - offset, "sha256": digest.hexdigest(),
+                                 "url": url}
+            manifest = json.dumps({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "artifacts": entries},
+                                  indent=2, sort_keys=True).encode("utf-8")
+            out.write(manifest)
+            out.write(TRAILER.pack(len(manifest), MAGIC))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    fsync_directory(os.path.dirname(os.path.abspath(path)))
+    return entries
+
+
+def main(argv=None):
+    from artifacts import NGROK, OPENSSH, fetch_artifact, resolve
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="pack the installer artifacts into one file")
+    build_parser.add_argument("output", nargs="?", default=BUNDLE_NAME)
+    build_parser.add_argument("--ngrok", help="local ngrok archive (default: cache or download)")
+    build_parser.add_argument("--openssh", help="local OpenSSH-Win64.zip (default: cache or download)")
+    list_parser = commands.add_parser("list", help="show a bundle's manifest and check its hashes")
+    list_parser.add_argument("bundle")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "build":
+            sources = {}
+            for artifact, local in ((NGROK, args.ngrok), (OPENSSH, args.openssh)):
+                artifact = resolve(artifact)
+                sources[artifact.name] = (local or fetch_artifact(artifact), artifact.url)
+            entries = build_bundle(args.output, sources)
+            for name, entry in sorted(entries.items()):
+                print(f"{name:<10}{entry['size']:>12} bytes  sha256 {entry['sha256']}")
+            print(f"Wrote {args.output}")
+        else:
+            with Bundle(args.bundle) as bundle:
+                for name, entry in sorted(bundle.entries.items()):
+                    bundle.view(name).release()
+                    print(f"{name:<10}{entry['size']:>12} bytes at {entry['offset']:<10} ok  {entry['url']}")
+    except (OSError, BundleError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+Non-interactive installer entry point.
+
+Settings are taken from command-line arguments, then a YAML config file, then
+PROCESURE_* environment variables, then the same defaults as the GUI. This
+module must never import gui or PyQt5.
+"""
+import argparse
+import os
+import sys
+
+import yaml
+
+
+EXIT_OK = 0
+EXIT_INSTALL_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NOT_ADMIN = 3
+EXIT_UNSUPPORTED_OS = 4
+
+DEFAULT_INSTALL_PATH = r"C:\Program Files\Procesure"
+DEFAULT_SSH_KEYS_PATH = r"C:\Users\.ssh\authorized_keys"
+
+# setting name -> (config file key, environment variable, default)
+SETTINGS = {
+    "auth_token": ("auth_token", "PROCESURE_AUTH_TOKEN", None),
+    "address": ("address", "PROCESURE_ADDRESS", None),
+    "install_path": ("install_path", "PROCESURE_INSTALL_PATH", DEFAULT_INSTALL_PATH),
+    "ssh_keys_path": ("ssh_keys_path", "PROCESURE_SSH_KEYS_PATH", DEFAULT_SSH_KEYS_PATH),
+}
+
+
+class TeeWriter:
+    """File-like object that copies everything written to several streams."""
+
+    def __init__(self, *streams):
+        self.streams = [stream for stream in streams if stream is not None]
+
+    def write(self, text):
+        for stream in self.streams:
+            stream.write(text)
+        return len(text)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="agent",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--headless", action="store_true", help="run without the GUI (implied by this entry point)")
+    parser.add_argument("--auth-token", dest="auth_token", help="ngrok auth token")
+    parser.add_argument("--address", dest="address", help="reserved TCP address for the SSH tunnel")
+    parser.add_argument("--install-path", dest="install_path", help=f"install directory (default: {DEFAULT_INSTALL_PATH})")
+    parser.add_argument("--ssh-keys-path", dest="ssh_keys_path", help="public keys to authorize: key files, directories or URLs separated by ';'")
+    parser.add_argument("--config", help="YAML file with auth_token, address, install_path, ssh_keys_path "
+                                         "and an optional list of extra tunnels")
+    parser.add_argument("--log-file", help="also append the installation log to this file")
+    parser.add_argument("--quiet", action="store_true", help="do not write the log to stdout")
+    parser.add_argument("--trace-dir", help="write a JSON run report and a Chrome trace of the install here")
+    parser.add_argument("--force", action="store_true", help="ignore the install journal and run every step again")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="after installing, keep running and repair whatever drifts from the installed state")
+    parser.add_argument("--reconcile-interval", type=float, default=60.0,
+                        help="seconds between drift checks while things change (default: 60)")
+    return parser
+
+
+def resolve_settings(args, environ=None):
+    """Merge arguments, config file, environment and defaults into one dict."""
+    environ = os.environ if environ is None else environ
+    config = {}
+    if args.config:
+        with open(args.config, "r") as f:
+            config = yaml.safe_load(f) or {}
+        if not isinstance(config, dict):
+            raise ValueError(f"{args.config} must contain a mapping of settings")
+
+    settings = {}
+    for name, (config_key, env_var, default) in SETTINGS.items():
+        value = getattr(args, name, None)
+        if value is None:
+            value = config.get(config_key)
+        if value is None:
+            value = environ.get(env_var)
+        if value is None:
+            value = default
+        settings[name] = value
+
+    missing = [name for name in ("auth_token", "address") if not settings[name]]
+    if missing:
+        raise ValueError(f"Missing required setting(s): {', '.join(missing)}")
+
+    # Extra agent tunnels (besides SSH) only come from the config file
+    from agent_config import Tunnel
+
+    tunnels = config.get("tunnels") or []
+    if not isinstance(tunnels, list):
+        raise ValueError("tunnels must be a list of tunnel settings")
+    settings["tunnels"] = [Tunnel.from_dict(tunnel) for tunnel in tunnels]
+    return settings
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    try:
+        settings = resolve_settings(args)
+    except (OSError, ValueError, yaml.YAMLError) as e:
+        print(f"Configuration error: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    from events import LogMessage, bus
+
+    log_file = open(args.log_file, "a", encoding="utf-8") if args.log_file else None
+    sink = TeeWriter(None if args.quiet else sys.stdout, log_file)
+
+    def write_log(event):
+        sink.write(event.text + "\n")
+        sink.flush()
+
+    bus.subscribe(write_log, LogMessage)
+    try:
+        # Ctrl+C or a service stop kills the running commands instead of leaving them behind
+        from process import install_signal_handlers
+
+        install_signal_handlers()
+        return run(settings, args.trace_dir, args.force, args.reconcile_interval if args.reconcile else None)
+    finally:
+        bus.unsubscribe(write_log)
+        if log_file:
+            log_file.close()
+
+
+def run(settings, trace_dir=None, force=False, reconcile_interval=None):
+    # Imported here so that a configuration error never pays for these imports
+    from events import log
+    from installer import run_installation
+    from scheduler import ScheduleFailed
+    from utils import check_admin_privileges, get_windows_version
+
+    if not check_admin_privileges():
+        log("This script requires administrator privileges. Please run as administrator.")
+        return EXIT_NOT_ADMIN
+
+    try:
+        windows_version = get_windows_version()
+    except ValueError as e:
+        log(e)
+        return EXIT_UNSUPPORTED_OS
+
+    log(f"Detected Windows version: {windows_version}")
+    log("Starting installation process...")
+    try:
+        run_installation(
+            windows_version,
+            settings["auth_token"],
+            settings["address"],
+            settings["install_path"],
+            settings["ssh_keys_path"],
+            trace_dir=trace_dir,
+            force=force,
+            tunnels=settings.get("tunnels", ()),
+        )
+    except ScheduleFailed:
+        # run_installation has already logged and published the failure
+        return EXIT_INSTALL_FAILED
+
+    if reconcile_interval is not None:
+        from installer import SETUP_CLASSES
+        from reconcile import run_reconcile
+
+        run_reconcile(SETUP_CLASSES[windows_version](), settings, interval=reconcile_interval)
+    return EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""
+Stored credentials (Windows Credential Manager) without shelling out to cmdkey.
+
+Each target is read or written with a single CredReadW/CredWriteW call, so
+checking a credential does not list every credential on the machine, and the
+password never appears on a command line.
+"""
+import ctypes
+import threading
+from collections import namedtuple
+
+
+CRED_TYPE_GENERIC = 1
+# What cmdkey uses: the credential roams with the profile and survives logoff
+CRED_PERSIST_ENTERPRISE = 3
+ERROR_NOT_FOUND = 1168
+
+
+# password is None when a backend does not (or may not) reveal it
+Credential = namedtuple("Credential", ["target", "user", "password"], defaults=(None,))
+
+
+class CredentialError(Exception):
+    pass
+
+
+class CredentialBackend:
+    """Reads and writes generic credentials by target name."""
+
+    def read(self, target):
+        """Return the Credential stored for target, or None."""
+        raise NotImplementedError
+
+    def write(self, credential):
+        raise NotImplementedError
+
+    def delete(self, target):
+        raise NotImplementedError
+
+    def read_many(self, targets):
+        return {target: self.read(target) for target in targets}
+
+    def upsert_many(self, credentials):
+        """
+        Write every credential whose user or password differs from what is
+        stored, and return the targets that were written.
+        """
+        current = self.read_many([credential.target for credential in credentials])
+        written = []
+        for credential in credentials:
+            existing = current.get(credential.target)
+            if existing is not None and existing.user == credential.user and (
+                credential.password is None or existing.password == credential.password
+            ):
+                continue
+            self.write(credential)
+            written.append(credential.target)
+        return written
+
+
+class MemoryCredentialBackend(CredentialBackend):
+    """Credentials in a dict, for tests and the simulated host."""
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def read(self, target):
+        with self._lock:
+            self.calls += 1
+            return self.store.get(target.lower())
+
+    def write(self, credential):
+        with self._lock:
+            self.calls += 1
+            self.store[credential.target.lower()] = credential
+
+    def delete(self, target):
+        with self._lock:
+            self.calls += 1
+            self.store.pop(target.lower(), None)
+
+
+class _FILETIME(ctypes.Structure):
+    _fields_ = [("dwLowDateTime", ctypes.c_uint32), ("dwHighDateTime", ctypes.c_uint32)]
+
+
+class _CREDENTIAL(ctypes.Structure):
+    _fields_ = [
+        ("Flags", ctypes.c_uint32),
+        ("Type", ctypes.c_uint32),
+        ("TargetName", ctypes.c_wchar_p),
+        ("Comment", ctypes.c_wchar_p),
+        ("LastWritten", _FILETIME),
+        ("CredentialBlobSize", ctypes.c_uint32),
+        ("CredentialBlob", ctypes.POINTER(ctypes.c_ubyte)),
+        ("Persist", ctypes.c_uint32),
+        ("AttributeCount", ctypes.c_uint32),
+        ("Attributes", ctypes.c_void_p),
+        ("TargetAlias", ctypes.c_wchar_p),
+        ("UserName", ctypes.c_wchar_p),
+    ]
+
+
+class WindowsCredentialBackend(CredentialBackend):
+    """Generic credentials in the Windows Credential Manager, through advapi32."""
+
+    def __init__(self):
+        try:
+            advapi32 = ctypes.WinDLL("advapi32", use_last_error=True)
+        except (AttributeError, OSError) as e:
+            raise CredentialError(f"Credential Manager is not available: {e}")
+        self._read = advapi32.CredReadW
+        self._read.argtypes = [ctypes.c_wchar_p, ctypes.c_uint32, ctypes.c_uint32,
+                               ctypes.POINTER(ctypes.POINTER(_CREDENTIAL))]
+        self._read.restype = ctypes.c_int
+        self._write = advapi32.CredWriteW
+        self._write.argtypes = [ctypes.POINTER(_CREDENTIAL), ctypes.c_uint32]
+        self._write.restype = ctypes.c_int
+        self._delete = advapi32.CredDeleteW
+        self._delete.argtypes = [ctypes.c_wchar_p, ctypes.c_uint32, ctypes.c_uint32]
+        self._delete.restype = ctypes.c_int
+        self._free = advapi32.CredFree
+        self._free.argtypes = [ctypes.c_void_p]
+        self._free.restype = None
+
+    def read(self, target):
+        pointer = ctypes.POINTER(_CREDENTIAL)()
+        if not self._read(target, CRED_TYPE_GENERIC, 0, ctypes.byref(pointer)):
+            error = ctypes.get_last_error()
+            if error == ERROR_NOT_FOUND:
+                return None
+            raise CredentialError(f"CredReadW({target}) failed: {ctypes.WinError(error)}")
+        try:
+            credential = pointer.contents
+            blob = ctypes.string_at(credential.CredentialBlob, credential.CredentialBlobSize)
+            return Credential(credential.TargetName, credential.UserName, blob.decode("utf-16-le"))
+        finally:
+            self._free(pointer)
+
+    def write(self, credential):
+        blob = (credential.password or "").encode("utf-16-le")
+        buffer = (ctypes.c_ubyte * len(blob)).from_buffer_copy(blob)
+        native = _CREDENTIAL(
+            Type=CRED_TYPE_GENERIC,
+            TargetName=credential.target,
+            CredentialBlobSize=len(blob),
+            CredentialBlob=ctypes.cast(buffer, ctypes.POINTER(ctypes.c_ubyte)),
+            Persist=CRED_PERSIST_ENTERPRISE,
+            UserName=credential.user,
+        )
+        if not self._write(ctypes.byref(native), 0):
+            raise CredentialError(f"CredWriteW({credential.target}) failed: {ctypes.WinError(ctypes.get_last_error())}")
+
+    def delete(self, target):
+        if not self._delete(target, CRED_TYPE_GENERIC, 0):
+            error = ctypes.get_last_error()
+            if error != ERROR_NOT_FOUND:
+                raise CredentialError(f"CredDeleteW({target}) failed: {ctypes.WinError(error)}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_credential_backend():
+    """Return the process-wide backend: the Credential Manager on Windows."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = WindowsCredentialBackend()
+        return _backend
+
+
+def set_credential_backend(backend):
+    """Replace the process-wide backend and return the previous one."""
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+        return previous
@@ -0,0 +1,476 @@
+"""
+Binary deltas between ngrok releases.
+
+A delta rebuilds one exact binary from another: it copies the byte ranges the
+two share from the installed file and carries only the bytes that changed,
+so consecutive releases cost a fraction of the full archive to roll out.
+Deltas are built on a connected machine next to an index that names the
+target release:
+
+    python delta.py index ngrok-3.5.exe ngrok-3.3.exe ngrok-3.4.exe --archive ngrok-3.5.zip --out deltas/
+
+which writes deltas/index.json, one .delta file per older release and a copy
+of the release archive (or only its URL, with --archive-url). With
+PROCESURE_NGROK_DELTAS set to the URL of index.json, download_ngrok hashes the
+installed ngrok.exe, fetches the matching delta, rebuilds and verifies the new
+binary, and swaps it in while the service is stopped. Without a matching delta
+(or when the rebuilt file does not verify) the release archive is downloaded
+instead, checked against the hash in the index.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from collections import namedtuple
+from urllib.parse import urljoin
+
+from archive import ArchiveError, extract_members
+from artifact_cache import CacheLockTimeout
+from artifacts import NGROK, Artifact, open_artifact
+from download import DownloadError, download_file, print_progress, sha256_file
+from events import log
+from fetch import get_fetcher
+from ngrok_service import get_service_control
+
+
+DELTA_INDEX_ENV = "PROCESURE_NGROK_DELTAS"
+INDEX_NAME = "index.json"
+MAGIC = b"PRDELTA1"
+BLOCK_SIZE = 2048
+CHUNK_SIZE = 256 * 1024
+# Literal runs are stored in pieces of at most this size, compressed when that makes them smaller
+MAX_LITERAL = 1024 * 1024
+
+_HEADER = struct.Struct(">8sIQ32sQ32s")
+_COPY = struct.Struct(">QI")
+_LITERAL = struct.Struct(">I")
+_PACKED = struct.Struct(">II")
+OP_COPY = b"C"
+OP_LITERAL = b"L"
+OP_PACKED = b"Z"
+OP_END = b"E"
+
+_ADLER_MOD = 65521
+
+CURRENT = "current"
+DELTA = "delta"
+FULL = "full"
+
+
+class DeltaError(Exception):
+    pass
+
+
+DeltaHeader = namedtuple("DeltaHeader", ["block_size", "source_size", "source_sha256", "target_size", "target_sha256"])
+UpdateResult = namedtuple("UpdateResult", ["action", "downloaded", "seconds"])
+
+
+def _strong(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class _OpWriter:
+    """Writes delta operations, merging adjacent copies and batching literal bytes."""
+
+    def __init__(self, f):
+        self.f = f
+        self.copy_start = None
+        self.copy_length = 0
+        self.copied = 0
+        self.literal = 0
+
+    def copy(self, offset, length):
+        if self.copy_start is not None and self.copy_start + self.copy_length == offset:
+            self.copy_length += length
+            return
+        self._flush_copy()
+        self.copy_start, self.copy_length = offset, length
+
+    def data(self, data):
+        if not data:
+            return
+        self._flush_copy()
+        view = memoryview(data)
+        for start in range(0, len(view), MAX_LITERAL):
+            piece = bytes(view[start:start + MAX_LITERAL])
+            packed = zlib.compress(piece, 9)
+            if len(packed) < len(piece):
+                self.f.write(OP_PACKED + _PACKED.pack(len(piece), len(packed)) + packed)
+            else:
+                self.f.write(OP_LITERAL + _LITERAL.pack(len(piece)) + piece)
+            self.literal += len(piece)
+
+    def _flush_copy(self):
+        if self.copy_start is not None:
+            self.f.write(OP_COPY + _COPY.pack(self.copy_start, self.copy_length))
+            self.copied += self.copy_length
+            self.copy_start, self.copy_length = None, 0
+
+    def close(self):
+        self._flush_copy()
+        self.f.write(OP_END)
+
+
+def make_delta(source_path, target_path, delta_path, block_size=BLOCK_SIZE):
+    """
+    Write a delta that rebuilds target_path from source_path and return
+    (bytes copied from the source, literal bytes carried in the delta).
+
+    The source is indexed in fixed blocks by a weak Adler-32 checksum and a
+    strong hash; the target is scanned with a rolling checksum so that blocks
+    are found again at any offset, as rsync does. After a match the scan jumps
+    a whole block, so only the changed regions are walked byte by byte.
+    """
+    with open(source_path, "rb") as f:
+        source = f.read()
+    with open(target_path, "rb") as f:
+        target = f.read()
+
+    blocks = {}
+    for offset in range(0, len(source) - block_size + 1, block_size):
+        blocks.setdefault(zlib.adler32(source[offset:offset + block_size]), []).append(offset)
+    strong = {}
+
+    def source_strong(offset):
+        digest = strong.get(offset)
+        if digest is None:
+            digest = strong[offset] = _strong(source[offset:offset + block_size])
+        return digest
+
+    header = _HEADER.pack(MAGIC, block_size, len(source), hashlib.sha256(source).digest(),
+                          len(target), hashlib.sha256(target).digest())
+    part_path = delta_path + ".part"
+    with open(part_path, "wb") as f:
+        f.write(header)
+        ops = _OpWriter(f)
+        end = len(target)
+        position = literal_start = 0
+        weak = None
+        next_offset = None  # where the source continues after the last copied block
+        while position + block_size <= end:
+            if weak is None:
+                weak = zlib.adler32(target[position:position + block_size])
+                a, b = weak & 0xFFFF, weak >> 16
+            match = None
+            candidates = blocks.get(weak)
+            if candidates:
+                digest = _strong(target[position:position + block_size])
+                # Prefer the block right after the previous copy so the copies merge
+                if next_offset in candidates and source_strong(next_offset) == digest:
+                    match = next_offset
+                else:
+                    match = next((offset for offset in candidates if source_strong(offset) == digest), None)
+            if match is not None:
+                ops.data(target[literal_start:position])
+                ops.copy(match, block_size)
+                position += block_size
+                literal_start = position
+                next_offset = match + block_size
+                weak = None
+                continue
+            if position + block_size < end:
+                # Roll the checksum one byte forward
+                out_byte, in_byte = target[position], target[position + block_size]
+                a = (a - out_byte + in_byte) % _ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % _ADLER_MOD
+                weak = (b << 16) | a
+            position += 1
+        ops.data(target[literal_start:])
+        ops.close()
+    os.replace(part_path, delta_path)
+    return ops.copied, ops.literal
+
+
+def read_header(f):
+    """Read and check the header of an open delta file."""
+    raw = f.read(_HEADER.size)
+    if len(raw) != _HEADER.size:
+        raise DeltaError("The delta is truncated")
+    magic, block_size, source_size, source_sha256, target_size, target_sha256 = _HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise DeltaError("Not a delta file")
+    return DeltaHeader(block_size, source_size, source_sha256.hex(), target_size, target_sha256.hex())
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise DeltaError("The delta is truncated")
+    return data
+
+
+def apply_delta(source_path, delta_path, out_path, source_sha256=None):
+    """
+    Rebuild the delta's target from source_path into out_path and return its header.
+
+    The source must be the exact file the delta was made from (source_sha256
+    saves hashing it again when the caller already has). The output is hashed
+    while it is written and only renamed into place once it matches the
+    target hash, so out_path is either the verified target or untouched.
+    """
+    part_path = out_path + ".part"
+    with open(delta_path, "rb") as delta:
+        header = read_header(delta)
+        if os.path.getsize(source_path) != header.source_size:
+            raise DeltaError(f"{source_path} is not the file this delta was made from")
+        if (source_sha256 or sha256_file(source_path)).lower() != header.source_sha256:
+            raise DeltaError(f"{source_path} is not the file this delta was made from")
+        digest = hashlib.sha256()
+        written = 0
+        try:
+            with open(source_path, "rb") as source, open(part_path, "wb") as out:
+                while True:
+                    op = _read_exact(delta, 1)
+                    if op == OP_END:
+                        break
+                    if op == OP_COPY:
+                        offset, length = _COPY.unpack(_read_exact(delta, _COPY.size))
+                        if offset + length > header.source_size:
+                            raise DeltaError("The delta copies past the end of the source")
+                        source.seek(offset)
+                        while length:
+                            data = _read_exact(source, min(length, CHUNK_SIZE))
+                            length -= len(data)
+                            digest.update(data)
+                            out.write(data)
+                            written += len(data)
+                        continue
+                    if op == OP_LITERAL:
+                        (size,) = _LITERAL.unpack(_read_exact(delta, _LITERAL.size))
+                        data = _read_exact(delta, size)
+                    elif op == OP_PACKED:
+                        size, packed_size = _PACKED.unpack(_read_exact(delta, _PACKED.size))
+                        try:
+                            data = zlib.decompress(_read_exact(delta, packed_size))
+                        except zlib.error as e:
+                            raise DeltaError(f"The delta is damaged: {e}")
+                        if len(data) != size:
+                            raise DeltaError("The delta is damaged")
+                    else:
+                        raise DeltaError(f"Unknown delta operation {op!r}")
+                    digest.update(data)
+                    out.write(data)
+                    written += len(data)
+            if written != header.target_size or digest.hexdigest() != header.target_sha256:
+                raise DeltaError("The rebuilt file does not match the target hash")
+            os.replace(part_path, out_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    return header
+
+
+def build_index(target_path, source_paths, out_dir, archive_path, archive_url=None, block_size=BLOCK_SIZE):
+    """
+    Write a delta from every source to target_path into out_dir, plus the
+    index.json that names the target, the full archive carrying it and the
+    delta for each source hash. Returns the index.
+
+    The archive is published at archive_url, or copied into out_dir when no
+    URL is given; installers fetch it by its hash when no delta applies.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    target_sha256 = sha256_file(target_path)
+    if archive_url is None:
+        archive_url = os.path.basename(archive_path)
+        shutil.copyfile(archive_path, os.path.join(out_dir, archive_url))
+    index = {
+        "target": {"sha256": target_sha256, "size": os.path.getsize(target_path)},
+        "archive": {"url": archive_url, "sha256": sha256_file(archive_path)},
+        "deltas": {},
+    }
+    for source_path in source_paths:
+        source_sha256 = sha256_file(source_path)
+        if source_sha256 == target_sha256:
+            continue
+        name = f"{source_sha256[:16]}-{target_sha256[:16]}.delta"
+        delta_path = os.path.join(out_dir, name)
+        make_delta(source_path, target_path, delta_path, block_size)
+        index["deltas"][source_sha256] = {
+            "url": name,
+            "sha256": sha256_file(delta_path),
+            "size": os.path.getsize(delta_path),
+        }
+    with open(os.path.join(out_dir, INDEX_NAME), "w") as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+def delta_index_url():
+    """URL of the published delta index, or None when delta updates are not set up."""
+    return os.environ.get(DELTA_INDEX_ENV) or None
+
+
+def fetch_index(url, fetcher=None):
+    """Download and check a delta index; relative URLs in it are resolved against its own."""
+    fetcher = fetcher or get_fetcher()
+    try:
+        response = fetcher.get(url)
+        response.raise_for_status()
+        index = response.json()
+        target = index["target"]
+        deltas = {
+            source.lower(): dict(entry, url=urljoin(url, entry["url"]))
+            for source, entry in (index.get("deltas") or {}).items()
+        }
+        archive = index["archive"]
+        return {
+            "target": {"sha256": target["sha256"].lower(), "size": int(target["size"])},
+            "archive": Artifact(NGROK.name + "-release", urljoin(url, archive["url"]), archive["sha256"].lower()),
+            "deltas": deltas,
+        }
+    except Exception as e:
+        raise DeltaError(f"Could not read the delta index {url}: {e}")
+
+
+def _rebuild_from_delta(ngrok_path, installed_sha256, entry, new_path):
+    """Download the delta for the installed binary and rebuild the target into new_path."""
+    delta_path = new_path + ".delta"
+    try:
+        download_file(entry["url"], delta_path, sha256=entry.get("sha256"), expected_size=entry.get("size"),
+                      segments=1, progress=print_progress("Downloading ngrok update"))
+        apply_delta(ngrok_path, delta_path, new_path, source_sha256=installed_sha256)
+        return os.path.getsize(delta_path)
+    finally:
+        if os.path.exists(delta_path):
+            os.remove(delta_path)
+
+
+def _extract_full(archive, new_path):
+    """Extract ngrok.exe from the release archive named by the index into new_path."""
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(new_path)) as tmp:
+        # The pinned hash keeps an older archive cached under the same URL from being used
+        with open_artifact(archive) as ngrok_zip:
+            extracted = extract_members(ngrok_zip, tmp, ["ngrok.exe"])[0]
+        os.replace(extracted, new_path)
+
+
+def _start_again(control, ngrok_path):
+    """Start the service after a failed swap; a failure is only logged so the caller's error is the one raised."""
+    try:
+        if not control.query().running:
+            control.start(ngrok_path)
+    except Exception as e:
+        log(f"Could not start the ngrok service again: {e}")
+
+
+def swap_binary(ngrok_path, new_path, control=None):
+    """
+    Replace ngrok_path with new_path. A running service is stopped first (Windows
+    does not let a running executable be replaced) and started again afterwards;
+    if it does not come back with the new binary, the old one is put back.
+    """
+    control = control or get_service_control()
+    status = control.query()
+    was_running = status.installed and status.running
+    backup_path = ngrok_path + ".old"
+    moved = False
+    try:
+        if was_running:
+            log("Stopping the ngrok service to replace its binary...")
+            control.stop(ngrok_path)
+        os.replace(ngrok_path, backup_path)
+        moved = True
+        os.replace(new_path, ngrok_path)
+        if was_running:
+            control.start(ngrok_path)
+    except Exception:
+        if moved:
+            os.replace(backup_path, ngrok_path)
+        if was_running:
+            _start_again(control, ngrok_path)
+        raise
+    try:
+        os.remove(backup_path)
+    except OSError:
+        # Still held open by something; the next update overwrites it
+        pass
+
+
+def update_ngrok(install_path, index_url=None, control=None, fetcher=None):
+    """
+    Bring an installed ngrok.exe to the version named by the delta index and
+    return an UpdateResult: CURRENT when it already is, DELTA when it was
+    rebuilt from a delta, FULL when the full archive had to be used.
+    """
+    start = time.perf_counter()
+    ngrok_path = os.path.join(install_path, "ngrok.exe")
+    index = fetch_index(index_url or delta_index_url(), fetcher)
+    target = index["target"]
+    installed_sha256 = sha256_file(ngrok_path)
+    if installed_sha256 == target["sha256"]:
+        return UpdateResult(CURRENT, 0, time.perf_counter() - start)
+
+    new_path = ngrok_path + ".new"
+    action, downloaded = FULL, None
+    entry = index["deltas"].get(installed_sha256)
+    if entry is None:
+        log("No delta for the installed ngrok.exe, using the full download.")
+    else:
+        try:
+            downloaded = _rebuild_from_delta(ngrok_path, installed_sha256, entry, new_path)
+            action = DELTA
+        except (DownloadError, DeltaError, OSError) as e:
+            log(f"ngrok delta update failed ({e}), using the full download.")
+    try:
+        if action == FULL:
+            try:
+                _extract_full(index["archive"], new_path)
+            except (ArchiveError, DownloadError, CacheLockTimeout, ValueError) as e:
+                raise DeltaError(f"The full ngrok download failed: {e}")
+            if sha256_file(new_path) != target["sha256"]:
+                raise DeltaError("The full ngrok download is not the version named by the delta index")
+        swap_binary(ngrok_path, new_path, control)
+    finally:
+        if os.path.exists(new_path):
+            os.remove(new_path)
+    return UpdateResult(action, downloaded, time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    make_parser = commands.add_parser("make", help="write a delta that rebuilds TARGET from SOURCE")
+    make_parser.add_argument("source")
+    make_parser.add_argument("target")
+    make_parser.add_argument("delta")
+    make_parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    apply_parser = commands.add_parser("apply", help="rebuild the target of a delta from its source")
+    apply_parser.add_argument("source")
+    apply_parser.add_argument("delta")
+    apply_parser.add_argument("out")
+    index_parser = commands.add_parser("index", help="write deltas from older releases and index.json")
+    index_parser.add_argument("target")
+    index_parser.add_argument("sources", nargs="+")
+    index_parser.add_argument("--out", required=True, help="directory to publish")
+    index_parser.add_argument("--archive", required=True, help="the release archive carrying TARGET")
+    index_parser.add_argument("--archive-url", help="where the archive is published (default: copied into --out)")
+    index_parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "make":
+            copied, literal = make_delta(args.source, args.target, args.delta, args.block_size)
+            print(f"{args.delta}: {os.path.getsize(args.delta)} bytes ({copied} copied, {literal} literal)")
+        elif args.command == "apply":
+            header = apply_delta(args.source, args.delta, args.out)
+            print(f"{args.out}: {header.target_size} bytes, sha256 {header.target_sha256}")
+        else:
+            index = build_index(args.target, args.sources, args.out, args.archive, args.archive_url,
+                                args.block_size)
+            for source, entry in index["deltas"].items():
+                print(f"{source[:16]}: {entry['url']} ({entry['size']} bytes)")
+    except (OSError, DeltaError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+
+from events import BytesTransferred, DownloadRetry, log, publish
+from fetch import CircuitOpenError, get_fetcher
+
+
+CHUNK_SIZE = 256 * 1024
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+STATE_SAVE_INTERVAL = 4 * 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _Progress:
+    """Thread-safe byte counter that forwards to an optional callback(done, total)."""
+
+    def __init__(self, callback, done, total):
+        self.callback = callback
+        self.done = done
+        self.total = total
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.done += count
+            done = self.done
+        if self.callback:
+            self.callback(done, self.total)
+
+
+class _ResumeState:
+    """The segment layout of a partial download, persisted next to the .part file."""
+
+    def __init__(self, path, url, size, validator, segments):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.validator = validator
+        self.segments = segments  # [start, end, done] with end inclusive
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, url, size, validator):
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("url") != url or data.get("size") != size or data.get("validator") != validator:
+            return None
+        return cls(path, url, size, validator, data["segments"])
+
+    @property
+    def done(self):
+        return sum(segment[2] for segment in self.segments)
+
+    def advance(self, index, count):
+        with self._lock:
+            self.segments[index][2] += count
+
+    def save(self):
+        with self._lock:
+            data = {"url": self.url, "size": self.size, "validator": self.validator, "segments": self.segments}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+
+
+def split_segments(size, count):
+    """Split [0, size) into count contiguous [start, end, 0] ranges."""
+    step = -(-size // count)
+    return [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+
+
+def probe(fetcher, url):
+    """Return (size, supports_ranges, validator) for a URL; size is None when unknown."""
+    try:
+        response = fetcher.head(url, allow_redirects=True)
+        response.raise_for_status()
+    except CircuitOpenError:
+        raise
+    except requests.RequestException:
+        return None, False, None
+    length = response.headers.get("Content-Length")
+    size = int(length) if length and length.isdigit() else None
+    ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+    return size, ranges, validator
+
+
+def sha256_file(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _fetch_segment(fetcher, url, part_path, state, index, chunk_size, progress):
+    start, end, done = state.segments[index]
+    if start + done > end:
+        return
+    headers = {"Range": f"bytes={start + done}-{end}"}
+    with fetcher.session.get(url, headers=headers, stream=True, timeout=fetcher.timeout) as response:
+        if response.status_code != 206:
+            raise DownloadError(f"Server ignored range request (HTTP {response.status_code})")
+        unsaved = 0
+        with open(part_path, "r+b") as f:
+            f.seek(start + done)
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                state.advance(index, len(chunk))
+                progress.add(len(chunk))
+                unsaved += len(chunk)
+                if unsaved >= STATE_SAVE_INTERVAL:
+                    f.flush()
+                    state.save()
+                    unsaved = 0
+    if state.segments[index][2] != end - start + 1:
+        raise DownloadError(f"Segment {index} ended early")
+
+
+def _download_segmented(fetcher, url, part_path, state, chunk_size, progress):
+    if not os.path.exists(part_path) or os.path.getsize(part_path) != state.size:
+        with open(part_path, "ab") as f:
+            f.truncate(state.size)
+    state.save()
+
+    errors = []
+    threads = [
+        threading.Thread(
+            target=lambda i=i: _run_collecting(errors, _fetch_segment, fetcher, url, part_path, state, i, chunk_size, progress),
+            daemon=True,
+        )
+        for i in range(len(state.segments))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    state.save()
+    if errors:
+        raise errors[0]
+
+
+def _run_collecting(errors, func, *args):
+    try:
+        func(*args)
+    except Exception as e:
+        errors.append(e)
+
+
+def _download_single(fetcher, url, part_path, resume, chunk_size, progress):
+    offset = os.path.getsize(part_path) if resume and os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with fetcher.session.get(url, headers=headers, stream=True, timeout=fetcher.timeout) as response:
+        if offset and response.status_code == 416:
+            # Nothing past the end of .part: done when the server's size agrees, stale otherwise
+            if response.headers.get("Content-Range", "") == f"bytes */{offset}":
+                progress.done = offset
+                return
+            _discard(part_path)
+            return _download_single(fetcher, url, part_path, False, chunk_size, progress)
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            offset = 0
+        progress.done = offset
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                progress.add(len(chunk))
+
+
+def download_file(url, dest, sha256=None, expected_size=None, segments=4, chunk_size=CHUNK_SIZE,
+                  progress=None, fetcher=None, retries=3):
+    """
+    Stream url into dest, never holding more than one chunk per segment in memory.
+
+    When the server supports byte ranges the file is fetched as parallel segments.
+    Interrupted transfers leave dest.part (and dest.part.json for segmented
+    downloads) behind and are resumed by the next call. The result is checked
+    against expected_size and sha256 when given; dest only appears once it is
+    complete and verified.
+
+    Requests go through the shared Fetcher (pooled connections, timeouts, the
+    per-origin circuit breaker); up to `retries` attempts are made, backing off
+    between them and resuming where the previous attempt stopped.
+    """
+    fetcher = fetcher or get_fetcher()
+    part_path = dest + ".part"
+    state_path = part_path + ".json"
+
+    try:
+        size, ranges, validator = probe(fetcher, url)
+    except CircuitOpenError as e:
+        raise DownloadError(str(e))
+    if expected_size is not None and size is not None and size != expected_size:
+        raise DownloadError(f"Server reports {size} bytes, expected {expected_size}")
+
+    last_error = None
+    for attempt in range(retries):
+        if attempt:
+            time.sleep(fetcher.backoff(attempt))
+        try:
+            fetcher.check(url)
+        except CircuitOpenError as e:
+            raise DownloadError(str(e))
+        try:
+            if ranges and size:
+                state = _ResumeState.load(state_path, url, size, validator)
+                if state is None:
+                    count = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+                    state = _ResumeState(state_path, url, size, validator, split_segments(size, count))
+                tracker = _Progress(progress, state.done, size)
+                _download_segmented(fetcher, url, part_path, state, chunk_size, tracker)
+            else:
+                tracker = _Progress(progress, 0, size)
+                _download_single(fetcher, url, part_path, ranges, chunk_size, tracker)
+            fetcher.record(url, ok=True)
+            break
+        except (requests.RequestException, DownloadError, OSError) as e:
+            fetcher.record(url, ok=False)
+            last_error = e
+            publish(DownloadRetry(url, attempt + 1, str(e)))
+            log(f"Download attempt {attempt + 1} of {retries} failed: {e}")
+    else:
+        raise DownloadError(f"Download of {url} failed: {last_error}")
+
+    actual_size = os.path.getsize(part_path)
+    wanted_size = expected_size if expected_size is not None else size
+    if wanted_size is not None and actual_size != wanted_size:
+        _discard(part_path, state_path)
+        raise DownloadError(f"Downloaded {actual_size} bytes, expected {wanted_size}")
+    if sha256 and sha256_file(part_path).lower() != sha256.lower():
+        _discard(part_path, state_path)
+        raise DownloadError(f"SHA-256 mismatch for {url}")
+
+    os.replace(part_path, dest)
+    _discard(state_path)
+    return dest
+
+
+def _discard(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def print_progress(label, step_percent=10):
+    """
+    Return a progress callback that publishes BytesTransferred events and logs
+    every step_percent of the transfer.
+    """
+    reported = [-1]
+    lock = threading.Lock()
+
+    def callback(done, total):
+        publish(BytesTransferred(label, done, total))
+        if not total:
+            return
+        percent = done * 100 // total // step_percent * step_percent
+        with lock:
+            if percent > reported[0]:
+                reported[0] = percent
+                log(f"{label}: {percent}% ({done // 1024} KiB of {total // 1024} KiB)")
+
+    return callback
@@ -0,0 +1,137 @@
+import functools
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class LogMessage:
+    text: str
+
+
+@dataclass(frozen=True)
+class StepStarted:
+    step: str
+
+
+@dataclass(frozen=True)
+class StepFinished:
+    step: str
+    seconds: float
+
+
+@dataclass(frozen=True)
+class StepFailed:
+    step: str
+    error: str
+    seconds: float
+
+
+@dataclass(frozen=True)
+class StepSkipped:
+    """A step was not run because the install journal shows it already completed."""
+
+    step: str
+
+
+@dataclass(frozen=True)
+class Progress:
+    percent: int
+    step: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class BytesTransferred:
+    name: str
+    done: int
+    total: Optional[int]
+
+
+@dataclass(frozen=True)
+class CommandFinished:
+    """A command ran to completion; spawned is False when it reused a live process."""
+
+    command: str
+    seconds: float
+    returncode: int
+    spawned: bool
+
+
+@dataclass(frozen=True)
+class DownloadRetry:
+    url: str
+    attempt: int
+    error: str
+
+
+@dataclass(frozen=True)
+class InstallResult:
+    success: bool
+    message: str
+    windows_version: Optional[str] = None
+
+
+class EventBus:
+    """
+    Synchronous publish/subscribe channel for install events.
+
+    Handlers run on the publishing thread, so GUI subscribers must hand events
+    over to the UI thread themselves. A handler registered for a base class
+    receives its subclasses too; with no event types it receives everything.
+    """
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, handler, *event_types):
+        with self._lock:
+            self._subscribers = self._subscribers + [(handler, event_types)]
+        return handler
+
+    def unsubscribe(self, handler):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s[0] != handler]
+
+    def has_subscribers(self, event_type):
+        return any(not types or issubclass(event_type, types) for _, types in self._subscribers)
+
+    def publish(self, event):
+        # The list is replaced, never mutated, so iterating a snapshot is safe
+        for handler, event_types in self._subscribers:
+            if not event_types or isinstance(event, event_types):
+                handler(event)
+
+
+bus = EventBus()
+
+
+def publish(event):
+    bus.publish(event)
+
+
+def log(text):
+    """Publish a log line, falling back to stdout when nobody is listening."""
+    if bus.has_subscribers(LogMessage):
+        bus.publish(LogMessage(str(text)))
+    else:
+        print(text)
+
+
+def step(name):
+    """Decorator publishing StepStarted/StepFinished/StepFailed around a setup step."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            publish(StepStarted(name))
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                publish(StepFailed(name, f"{type(e).__name__}: {e}", time.perf_counter() - start))
+                raise
+            publish(StepFinished(name, time.perf_counter() - start))
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,214 @@
+"""
+The HTTP layer shared by every artifact download.
+
+One pooled requests.Session keeps connections alive between the probe, the
+segment requests and the next artifact. Requests get explicit connect/read
+timeouts, retries with exponential backoff and full jitter, and a circuit
+breaker per origin so a dead mirror fails fast instead of eating every retry.
+"""
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from events import log
+
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+POOL_SIZE = 16
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_AFTER = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+PROXY_ENV = "PROCESURE_PROXY"
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised without touching the network while an origin's breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures for one origin.
+
+    After `threshold` failures the breaker opens and requests fail immediately;
+    once `reset_after` seconds have passed a single trial request is let through
+    (half-open), and its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_after=BREAKER_RESET_AFTER, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if self.clock() - self.opened_at >= self.reset_after else "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at < self.reset_after or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = self.clock()
+            self._trial = False
+
+
+def origin_of(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+class Fetcher:
+    """Pooled, retrying HTTP client. Use get_fetcher() for the shared instance."""
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, pool_size=POOL_SIZE,
+                 breaker_threshold=BREAKER_THRESHOLD, breaker_reset_after=BREAKER_RESET_AFTER, proxies=None,
+                 sleep=time.sleep):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_after = breaker_reset_after
+        self.sleep = sleep
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        # Retries are handled here, where they can back off and feed the breaker
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if proxies:
+            self.session.proxies.update(proxies)
+
+    def breaker(self, url):
+        origin = origin_of(url)
+        with self._lock:
+            if origin not in self._breakers:
+                self._breakers[origin] = CircuitBreaker(self.breaker_threshold, self.breaker_reset_after)
+            return self._breakers[origin]
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait before retry number `attempt` (1-based): full jitter, capped."""
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def check(self, url):
+        if not self.breaker(url).allow():
+            raise CircuitOpenError(f"Too many recent failures talking to {origin_of(url)}, not trying again yet")
+
+    def record(self, url, ok):
+        breaker = self.breaker(url)
+        if ok:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+    def request(self, method, url, retries=None, **kwargs):
+        """
+        Send a request, retrying connection errors, timeouts and 429/5xx answers.
+
+        Returns the final response (which may still carry an error status once
+        retries are exhausted) or raises the last requests exception.
+        """
+        retries = self.retries if retries is None else retries
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            self.check(url)
+            retry_after = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                self.record(url, ok=False)
+                if attempt >= retries:
+                    raise
+                error = str(e)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.record(url, ok=True)
+                    return response
+                self.record(url, ok=False)
+                if attempt >= retries:
+                    return response
+                error = f"HTTP {response.status_code}"
+                retry_after = _retry_after(response)
+                response.close()
+            attempt += 1
+            delay = self.backoff(attempt, retry_after)
+            log(f"{method} {url} failed ({error}), retry {attempt} of {retries} in {delay:.1f}s")
+            self.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def _retry_after(response):
+    value = response.headers.get("Retry-After", "")
+    return float(value) if value.isdigit() else None
+
+
+def proxies_from_env(environ=None):
+    """PROCESURE_PROXY applies to both schemes; the usual HTTP(S)_PROXY variables still work too."""
+    environ = os.environ if environ is None else environ
+    proxy = environ.get(PROXY_ENV)
+    return {"http": proxy, "https": proxy} if proxy else None
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def get_fetcher():
+    """Return the process-wide Fetcher, created on first use."""
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = Fetcher(proxies=proxies_from_env())
+        return _fetcher
+
+
+def set_fetcher(fetcher):
+    """Replace the process-wide Fetcher and return the previous one."""
+    global _fetcher
+    with _fetcher_lock:
+        previous, _fetcher = _fetcher, fetcher
+        return previous
@@ -0,0 +1,260 @@
+"""
+Roll the installer out to many hosts concurrently.
+
+Each host runs the normal headless install (`agent.exe --headless`) through a
+pluggable transport. The inventory is a YAML file with optional `defaults` and a
+`hosts` list (plain names or mappings overriding the defaults), or a text file
+with one host per line.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shlex
+import sys
+import time
+
+import yaml
+
+
+# Exit codes of cli.py that retrying cannot fix
+PERMANENT_EXIT_CODES = {2, 3, 4}
+
+
+class TransportError(Exception):
+    """The host could not be reached or the command could not be started."""
+
+
+class Transport:
+    """Runs the headless installer on one host and returns its exit code."""
+
+    async def install(self, host, settings):
+        raise NotImplementedError
+
+
+class CommandTransport(Transport):
+    """
+    Runs a local command per host, such as `ssh {host} agent.exe --headless ...`.
+
+    Placeholders: {host}, {auth_token}, {address}, {install_path}, {ssh_keys_path}.
+    Settings are also exported as PROCESURE_* variables to the local command only;
+    ssh does not pass them on to the host (short of SendEnv/AcceptEnv), so a remote
+    template has to name the settings it needs through the placeholders.
+    """
+
+    def __init__(self, template, timeout=1800):
+        self.template = template
+        self.timeout = timeout
+
+    async def install(self, host, settings):
+        values = {key: "" for key in ("auth_token", "address", "install_path", "ssh_keys_path")}
+        values.update(settings)
+        argv = [part.format(host=host, **values) for part in shlex.split(self.template)]
+        env = dict(os.environ)
+        env.update({f"PROCESURE_{key.upper()}": str(value) for key, value in settings.items() if value is not None})
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *argv, env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+            )
+        except OSError as e:
+            raise TransportError(f"Could not start {argv[0]}: {e}")
+        try:
+            return await asyncio.wait_for(process.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise TransportError(f"Install on {host} timed out after {self.timeout}s")
+
+
+class FakeTransport(Transport):
+    """Simulates remote installs with random latency and failures, for tests and benchmarks."""
+
+    def __init__(self, latency=(0.05, 0.2), failure_rate=0.0, unreachable_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.unreachable_rate = unreachable_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+
+    async def install(self, host, settings):
+        self.calls += 1
+        await asyncio.sleep(self.random.uniform(*self.latency))
+        if self.random.random() < self.unreachable_rate:
+            raise TransportError(f"{host} is unreachable")
+        return 1 if self.random.random() < self.failure_rate else 0
+
+
+class HostResult:
+    def __init__(self, host):
+        self.host = host
+        self.status = "pending"
+        self.attempts = 0
+        self.exit_code = None
+        self.error = None
+        self.seconds = 0.0
+
+
+class FleetResult:
+    def __init__(self, results, aborted, wall_time):
+        self.results = results
+        self.aborted = aborted
+        self.wall_time = wall_time
+
+    def count(self, status):
+        return sum(1 for result in self.results if result.status == status)
+
+    @property
+    def ok(self):
+        return not self.aborted and self.count("succeeded") == len(self.results)
+
+
+class FleetRunner:
+    """
+    Installs on many hosts with bounded concurrency, per-host retries and an
+    early abort once the failure rate passes max_failure_rate (evaluated after
+    min_samples hosts have finished).
+    """
+
+    def __init__(self, transport, concurrency=10, retries=2, retry_delay=5.0,
+                 max_failure_rate=0.25, min_samples=10, progress_interval=5.0, out=None):
+        self.transport = transport
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_failure_rate = max_failure_rate
+        self.min_samples = min_samples
+        self.progress_interval = progress_interval
+        self.out = out or sys.stdout
+
+    async def run(self, hosts):
+        """hosts is a list of (host, settings) pairs."""
+        results = [HostResult(host) for host, _ in hosts]
+        abort = asyncio.Event()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+
+        async def install(result, settings):
+            async with semaphore:
+                if abort.is_set():
+                    result.status = "skipped"
+                    return
+                result.status = "running"
+                started = time.perf_counter()
+                await self._install_with_retries(result, settings, abort)
+                result.seconds = time.perf_counter() - started
+                self._check_failure_rate(results, abort)
+
+        reporter = asyncio.ensure_future(self._report(results, start))
+        try:
+            await asyncio.gather(*(install(result, settings) for result, (_, settings) in zip(results, hosts)))
+        finally:
+            reporter.cancel()
+        wall_time = time.perf_counter() - start
+        self._print_table(results, wall_time)
+        return FleetResult(results, abort.is_set(), wall_time)
+
+    async def _install_with_retries(self, result, settings, abort):
+        for attempt in range(self.retries + 1):
+            result.attempts = attempt + 1
+            try:
+                result.exit_code = await self.transport.install(result.host, settings)
+                result.error = None
+            except TransportError as e:
+                result.exit_code, result.error = None, str(e)
+            if result.exit_code == 0:
+                result.status = "succeeded"
+                return
+            if result.exit_code in PERMANENT_EXIT_CODES or attempt == self.retries or abort.is_set():
+                break
+            result.status = "retrying"
+            await asyncio.sleep(self.retry_delay * (2 ** attempt))
+        result.status = "failed"
+
+    def _check_failure_rate(self, results, abort):
+        finished = [r for r in results if r.status in ("succeeded", "failed")]
+        failed = sum(1 for r in finished if r.status == "failed")
+        if len(finished) >= self.min_samples and failed / len(finished) > self.max_failure_rate and not abort.is_set():
+            print(
+                f"Aborting rollout: {failed} of {len(finished)} hosts failed "
+                f"(limit {self.max_failure_rate:.0%}).",
+                file=self.out,
+            )
+            abort.set()
+
+    async def _report(self, results, start):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self._print_table(results, time.perf_counter() - start)
+
+    def _print_table(self, results, elapsed):
+        statuses = ("pending", "running", "retrying", "succeeded", "failed", "skipped")
+        counts = {status: 0 for status in statuses}
+        for result in results:
+            counts[result.status] += 1
+        done = counts["succeeded"] + counts["failed"]
+        rate = done / elapsed * 60 if elapsed else 0.0
+        remaining = counts["pending"] + counts["running"] + counts["retrying"]
+        eta = f"{remaining / rate:.1f} min" if rate and remaining else "-"
+        header = "".join(f"{status:>11}" for status in statuses)
+        row = "".join(f"{counts[status]:>11}" for status in statuses)
+        print(f"[{elapsed:7.1f}s]{header}{'hosts/min':>11}{'ETA':>11}", file=self.out)
+        print(f"{'':10}{row}{rate:>11.1f}{eta:>11}", file=self.out)
+        self.out.flush()
+
+
+def load_inventory(path):
+    """Return a list of (host, settings) pairs from a YAML or plain-text inventory."""
+    with open(path, "r") as f:
+        text = f.read()
+    if not path.lower().endswith((".yml", ".yaml")):
+        hosts = [line.strip() for line in text.splitlines()]
+        return [(host, {}) for host in hosts if host and not host.startswith("#")]
+
+    data = yaml.safe_load(text) or {}
+    defaults = data.get("defaults") or {}
+    inventory = []
+    for entry in data.get("hosts") or []:
+        if isinstance(entry, str):
+            inventory.append((entry, dict(defaults)))
+        else:
+            entry = dict(entry)
+            host = entry.pop("host")
+            inventory.append((host, {**defaults, **entry}))
+    return inventory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inventory", help="YAML or text inventory file")
+    parser.add_argument("--command", help="transport command template, e.g. \"ssh {host} agent.exe --headless\"")
+    parser.add_argument("--fake", action="store_true", help="simulate installs instead of contacting hosts")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--max-failure-rate", type=float, default=0.25)
+    parser.add_argument("--min-samples", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.fake:
+        transport = FakeTransport(failure_rate=0.05)
+    elif args.command:
+        transport = CommandTransport(args.command)
+    else:
+        parser.error("either --command or --fake is required")
+
+    runner = FleetRunner(
+        transport,
+        concurrency=args.concurrency,
+        retries=args.retries,
+        max_failure_rate=args.max_failure_rate,
+        min_samples=args.min_samples,
+    )
+    result = asyncio.run(runner.run(load_inventory(args.inventory)))
+    for host_result in result.results:
+        if host_result.status != "succeeded":
+            detail = host_result.error or f"exit code {host_result.exit_code}"
+            print(f"{host_result.host}: {host_result.status} after {host_result.attempts} attempt(s) ({detail})")
+    return 0 if result.ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,9 +3,17 @@ from PyQt5.QtWidgets import (
     QLabel, QLineEdit, QPushButton, QFrame, QFileDialog,
     QHBoxLayout, QTextEdit
 )
-from PyQt5.QtCore import Qt, QObject, pyqtSignal, QDateTime, QThread
+from PyQt5.QtCore import Qt, QObject, pyqtSignal, QThread, QTimer
 from PyQt5.QtGui import QFont, QPalette, QColor
 import sys
+from events import InstallResult, LogMessage, bus, log
+from log_pipeline import LogPipeline
+from process import cancel
+
+
+LOG_FLUSH_INTERVAL_MS = 100
+# How long Close waits for the cancelled installation to stop its commands
+CANCEL_WAIT_MS = 15000
 
 
 class InstallationWorker(QThread):
@@ -24,39 +32,36 @@ class InstallationWorker(QThread):
             self.install_function(self.auth_token, self.ip_address, self.install_path, self.ssh_keys_path)
             self.finished.emit()
         except Exception as e:
-            print(f"Installation thread error: {e}")
+            log(f"Installation thread error: {e}")
 
 
 class LogHandler(QObject):
-    log_signal = pyqtSignal(str)
+    """Subscribes to LogMessage events and feeds them to the batching pipeline."""
 
     def __init__(self):
         super().__init__()
         self.original_stdout = sys.stdout
-        self.original_stderr = sys.stderr
+        # Lines are queued here from any thread and flushed to the widget on a timer
+        self.pipeline = LogPipeline()
 
-    def write(self, text):
-        if text.strip():  # Only emit non-empty strings
-            # Write to original stdout for console debugging
-            self.original_stdout.write(text)
-            self.log_signal.emit(text)
-
-    def flush(self):
-        self.original_stdout.flush()
+    def handle(self, event):
+        # Echo to the console for debugging (sys.stdout is None in the windowed exe)
+        if self.original_stdout is not None:
+            self.original_stdout.write(event.text + "\n")
+        self.pipeline.write(event.text + "\n")
 
     def start_capture(self):
-        """Start capturing stdout and stderr"""
-        sys.stdout = self
-        sys.stderr = self
+        """Start receiving installer log events"""
+        bus.subscribe(self.handle, LogMessage)
 
     def stop_capture(self):
-        """Restore original stdout and stderr"""
-        sys.stdout = self.original_stdout
-        sys.stderr = self.original_stderr
+        """Stop receiving installer log events"""
+        bus.unsubscribe(self.handle)
 
 
 class ModernConfigGUI(QMainWindow):
     config_ready = pyqtSignal(str, str, str, str)  # Updated to include ssh_keys_path
+    install_result = pyqtSignal(object)  # Carries the InstallResult event to the GUI thread
 
     def __init__(self):
         super().__init__()
@@ -67,15 +72,20 @@ class ModernConfigGUI(QMainWindow):
         self.path_entry_clicked = False
         self.ssh_path_entry_clicked = False
         self.log_handler = LogHandler()
-        self.log_handler.log_signal.connect(self.update_log)
         self.installation_complete = False
         self.worker = None
         self.initUI()
 
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.log_timer.start(LOG_FLUSH_INTERVAL_MS)
+
         # Start capturing logs immediately
         self.log_handler.start_capture()
-        print("Procesure Agent Configuration Started")
-        print("Please enter your configuration details and click Continue to begin installation.")
+        self.install_result.connect(self.on_install_result)
+        bus.subscribe(self.forward_install_result, InstallResult)
+        log("Procesure Agent Configuration Started")
+        log("Please enter your configuration details and click Continue to begin installation.")
 
     def start_installation_process(self, install_function):
         """Start the installation process in a separate thread"""
@@ -94,8 +104,16 @@ class ModernConfigGUI(QMainWindow):
         self.worker = None
 
     def closeEvent(self, event):
-        """Handle window close event"""
+        """Handle window close event, cancelling an installation that is still running"""
+        if self.worker is not None and self.worker.isRunning():
+            log("Cancelling installation...")
+            cancel()
+            self.worker.wait(CANCEL_WAIT_MS)
         self.log_handler.stop_capture()
+        bus.unsubscribe(self.forward_install_result)
+        self.log_timer.stop()
+        self.flush_log()
+        self.log_handler.pipeline.close()
         event.accept()
 
     def initUI(self):
@@ -246,6 +264,8 @@ class ModernConfigGUI(QMainWindow):
         layout.addWidget(QLabel('Installation Progress:'))
         self.log_text = QTextEdit()
         self.log_text.setReadOnly(True)
+        # Only the most recent lines stay in the widget; the full log is in the spill file
+        self.log_text.document().setMaximumBlockCount(self.log_handler.pipeline.max_visible_lines)
         layout.addWidget(self.log_text, 1)  # Give it a stretch factor of 1
 
         # Button container at the bottom
@@ -274,41 +294,43 @@ class ModernConfigGUI(QMainWindow):
         y = (screen.height() - self.height()) // 2
         self.move(x, y)
 
-    def update_log(self, text):
-        # Add timestamp to log messages
-        timestamp = QDateTime.currentDateTime().toString("yyyy-MM-dd hh:mm:ss")
-        formatted_text = f"[{timestamp}] {text.strip()}"
-        self.log_text.append(formatted_text)
+    def flush_log(self):
+        """Append the queued log lines to the widget in one batch."""
+        lines = self.log_handler.pipeline.drain()
+        if not lines:
+            return
+        self.log_text.append("\n".join(lines))
 
         # Scroll to the bottom
         scrollbar = self.log_text.verticalScrollBar()
         scrollbar.setValue(scrollbar.maximum())
 
-        # Check if installation is complete
-        if "Setup complete" in text:
+    def forward_install_result(self, result):
+        """Bus handler, called on the installation thread"""
+        self.install_result.emit(result)
+
+    def on_install_result(self, result):
+        if result.success:
             self.installation_complete = True
             self.continue_btn.hide()
             self.close_btn.show()
-            print("Installation completed successfully. You may now close the window.")
+            log("Installation completed successfully. You may now close the window.")
             # Enable all input fields
             self.auth_entry.setEnabled(True)
             self.ip_entry.setEnabled(True)
             self.path_entry.setEnabled(True)
             self.ssh_path_entry.setEnabled(True)
-        elif "Setup failed" in text:
+        else:
             self.installation_complete = False
             self.continue_btn.setEnabled(True)
             self.continue_btn.setText("Continue")
-            print("Installation failed. Please check the logs above and try again.")
+            log("Installation failed. Please check the logs above and try again.")
             # Enable all input fields
             self.auth_entry.setEnabled(True)
             self.ip_entry.setEnabled(True)
             self.path_entry.setEnabled(True)
             self.ssh_path_entry.setEnabled(True)
 
-    def get_log_handler(self):
-        return self.log_handler
-
     def on_path_entry_click(self, event):
         if not self.path_entry_clicked:
             self.path_entry.clear()
@@ -327,7 +349,7 @@ class ModernConfigGUI(QMainWindow):
 
         # Validate input
         if not self.auth_token or not self.ip_address:
-            print("Error: Please fill in all required fields.")
+            log("Error: Please fill in all required fields.")
             return
 
         if not self.path_entry.text():
@@ -341,9 +363,9 @@ class ModernConfigGUI(QMainWindow):
             self.ssh_keys_path = self.ssh_path_entry.text()
 
         # Log the configuration (without showing sensitive data)
-        print(f"Installation Path: {self.install_path}")
-        print(f"SSH Keys Path: {self.ssh_keys_path}")
-        print("Starting installation process...")
+        log(f"Installation Path: {self.install_path}")
+        log(f"SSH Keys Path: {self.ssh_keys_path}")
+        log("Starting installation process...")
 
         # Disable input fields during installation
         self.auth_entry.setEnabled(False)
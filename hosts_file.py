@@ -0,0 +1,263 @@
+import codecs
+import ctypes
+import os
+import stat
+from collections import namedtuple
+
+from atomicfile import write_atomic
+
+
+def default_hosts_path():
+    system_root = os.environ.get("SystemRoot", r"C:\Windows")
+    return os.path.join(system_root, r"System32\drivers\etc\hosts")
+
+
+class HostsDiff(namedtuple("HostsDiff", ["added", "removed"])):
+    """The (ip, name) pairs an update added and removed."""
+
+    @property
+    def changed(self):
+        return bool(self.added or self.removed)
+
+
+class HostsFile:
+    """
+    A hosts file held as its original bytes, edited as a set of line splices.
+
+    Everything that is not edited (comments, blank lines, spacing, line endings,
+    encoding) is written back byte for byte. Looking up or editing a few names
+    searches the raw bytes for them and parses only the matching lines,
+    which keeps managed hosts files with hundreds of thousands of blocklist
+    entries cheap; index() builds the full name-to-addresses map when needed.
+    Host names compare case-insensitively, as the resolver does.
+    """
+
+    def __init__(self, data=b"", encoding="utf-8", newline=b"\r\n", bom=b""):
+        self.data = data
+        self.encoding = encoding
+        self.newline = newline
+        self.bom = bom
+        self._edits = {}  # line start -> (line end, replacement bytes or None to drop the line)
+        self._appended = []
+        self._folded = None
+
+    @classmethod
+    def read(cls, path):
+        """Read path in one go; a missing file is an empty hosts file."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return cls()
+        bom = codecs.BOM_UTF8 if data.startswith(codecs.BOM_UTF8) else b""
+        data = data[len(bom):]
+        first_end = data.find(b"\n")
+        newline = b"\r\n" if first_end <= 0 or data[first_end - 1:first_end] == b"\r" else b"\n"
+        return cls(data, _detect_encoding(data), newline, bom)
+
+    def _parse(self, line):
+        """Return (ip, [names]) for an entry line, or None for comments and blanks."""
+        fields = line.decode(self.encoding, "replace").split("#", 1)[0].split()
+        if len(fields) < 2:
+            return None
+        return fields[0], fields[1:]
+
+    def _line_at(self, start):
+        """(end, current bytes) of the line starting at start; bytes is None for a dropped line."""
+        end = self.data.find(b"\n", start)
+        end = len(self.data) if end < 0 else end + 1
+        edit = self._edits.get(start)
+        return end, self.data[start:end] if edit is None else edit[1]
+
+    def entries(self):
+        """Yield (ip, [names]) for every entry, streaming through the file."""
+        start = 0
+        while start < len(self.data):
+            end, line = self._line_at(start)
+            parsed = self._parse(line) if line is not None else None
+            if parsed is not None:
+                yield parsed
+            start = end
+        for line in self._appended:
+            parsed = self._parse(line)
+            if parsed is not None:
+                yield parsed
+
+    def index(self):
+        """Map every lower-cased host name to its addresses, in file order."""
+        index = {}
+        for ip, names in self.entries():
+            for name in names:
+                index.setdefault(name.lower(), []).append(ip)
+        return index
+
+    def _candidates(self, name):
+        """Yield (position, line, ip, names) for the entries that map name."""
+        if self._folded is None:
+            self._folded = self.data.lower()
+        token = name.lower().encode(self.encoding)
+        starts = []
+        found = self._folded.find(token)
+        while found >= 0:
+            # bytes.find is much faster than a regex over every line; the hit is
+            # only a candidate until its line has been parsed
+            start = self.data.rfind(b"\n", 0, found) + 1
+            if not starts or starts[-1] != start:
+                starts.append(start)
+            found = self._folded.find(token, found + len(token))
+        lines = []
+        for start in starts:
+            _, line = self._line_at(start)
+            if line is not None:
+                lines.append((start, line))
+        lines.extend((("appended", i), line) for i, line in enumerate(self._appended))
+        for position, line in lines:
+            parsed = self._parse(line)
+            if parsed and any(n.lower() == name.lower() for n in parsed[1]):
+                yield position, line, parsed[0], parsed[1]
+
+    def addresses(self, name):
+        """Every IP address name is mapped to, in file order."""
+        return [ip for _, _, ip, _ in self._candidates(name)]
+
+    def has(self, ip, name):
+        return ip in self.addresses(name)
+
+    def apply(self, add=(), remove=()):
+        """
+        Add and remove (ip, name) pairs and return a HostsDiff of what changed.
+
+        A removed name is taken out of its line; the line itself is dropped
+        only when no other names remain on it. Additions already present are
+        left alone.
+        """
+        removed = []
+        for ip, name in remove:
+            for position, line, entry_ip, names in list(self._candidates(name)):
+                if entry_ip != ip:
+                    continue
+                self._replace(position, self._without(line, entry_ip, names, name))
+                removed.append((ip, name))
+
+        added = []
+        for ip, name in add:
+            if self.has(ip, name):
+                continue
+            self._appended.append(f"{ip} {name}".encode(self.encoding) + self.newline)
+            added.append((ip, name))
+        return HostsDiff(added, removed)
+
+    def _replace(self, position, line):
+        if isinstance(position, tuple):
+            self._appended[position[1]] = line or b""
+        else:
+            end, _ = self._line_at(position)
+            self._edits[position] = (end, line)
+
+    def _without(self, line, ip, names, name):
+        """The line with name removed, or None when no names would be left."""
+        remaining = [n for n in names if n.lower() != name.lower()]
+        if not remaining:
+            return None
+        text = line.decode(self.encoding, "replace")
+        comment = " #" + text.split("#", 1)[1].rstrip("\r\n") if "#" in text else ""
+        ending = self.newline if line.endswith(b"\n") else b""
+        return (" ".join([ip] + remaining) + comment).encode(self.encoding) + ending
+
+    def to_bytes(self):
+        parts = [self.bom]
+        position = 0
+        for start in sorted(self._edits):
+            end, line = self._edits[start]
+            parts.append(self.data[position:start])
+            if line is not None:
+                parts.append(line)
+            position = end
+        parts.append(self.data[position:])
+        if self._appended and self.data and not self.data.endswith(b"\n"):
+            parts.append(self.newline)
+        parts.extend(self._appended)
+        return b"".join(parts)
+
+    def write(self, path):
+        """
+        Replace path with the edited content. The new file takes over the old
+        one's permissions (its ACL on Windows) and read-only bit; when that is
+        not allowed, the old file is rewritten in place instead.
+        """
+        data = self.to_bytes()
+        try:
+            mode = os.stat(path).st_mode
+        except FileNotFoundError:
+            write_atomic(path, data)
+            return
+        read_only = not mode & stat.S_IWRITE
+        if read_only:
+            os.chmod(path, mode | stat.S_IWRITE)
+        try:
+            write_atomic(path, data, prepare=lambda tmp_path: _copy_security(path, tmp_path))
+        except PermissionError:
+            _write_in_place(path, data)
+        finally:
+            if read_only:
+                os.chmod(path, mode)
+
+
+def _copy_security(source, dest):
+    """Give dest the owner and permissions of source (raising PermissionError when that is not allowed)."""
+    if os.name != "nt":
+        source_stat = os.stat(source)
+        os.chown(dest, source_stat.st_uid, source_stat.st_gid)
+        os.chmod(dest, stat.S_IMODE(source_stat.st_mode) | stat.S_IWRITE)
+        return
+    advapi32 = ctypes.WinDLL("advapi32", use_last_error=True)
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    owner, group, dacl, descriptor = (ctypes.c_void_p() for _ in range(4))
+    # SE_FILE_OBJECT; OWNER_, GROUP_ and DACL_SECURITY_INFORMATION
+    error = advapi32.GetNamedSecurityInfoW(source, 1, 0x7, ctypes.byref(owner), ctypes.byref(group),
+                                           ctypes.byref(dacl), None, ctypes.byref(descriptor))
+    if error:
+        raise ctypes.WinError(error)
+    try:
+        control, revision = ctypes.c_uint16(), ctypes.c_uint32()
+        advapi32.GetSecurityDescriptorControl(descriptor, ctypes.byref(control), ctypes.byref(revision))
+        # SE_DACL_PROTECTED -> PROTECTED_DACL_SECURITY_INFORMATION, so inheritance stays as it was
+        info = 0x7 | (0x80000000 if control.value & 0x1000 else 0x20000000)
+        error = advapi32.SetNamedSecurityInfoW(dest, 1, ctypes.c_uint32(info), owner, group, dacl, None)
+        if error:
+            raise PermissionError(error, f"Could not copy the permissions of {source}", dest)
+    finally:
+        kernel32.LocalFree(descriptor)
+
+
+def _write_in_place(path, data):
+    """Overwrite path's content, keeping the file itself (and so its ACL and attributes); not atomic."""
+    with open(path, "r+b") as f:
+        f.write(data)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _detect_encoding(data):
+    """UTF-8 when the whole file decodes as UTF-8, otherwise the ANSI code page (mbcs on Windows)."""
+    try:
+        data.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "mbcs" if os.name == "nt" else "latin-1"
+
+
+def update_hosts_file(path=None, add=(), remove=()):
+    """
+    Apply additions and removals to the hosts file and return the HostsDiff.
+
+    The file is only rewritten, through a temporary file and an atomic
+    replace (see HostsFile.write), when something actually changed.
+    """
+    path = path or default_hosts_path()
+    hosts = HostsFile.read(path)
+    diff = hosts.apply(add=add, remove=remove)
+    if diff.changed:
+        hosts.write(path)
+    return diff
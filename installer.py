@@ -0,0 +1,179 @@
+import threading
+
+from artifacts import NGROK, OPENSSH, resolve, set_bundle
+from bundle import find_bundle
+from delta import delta_index_url
+from events import InstallResult, Progress, StepFailed, StepFinished, StepSkipped, bus, log, publish
+from instrumentation import RunRecorder, trace_dir_from_env
+from journal import InstallJournal
+from powershell import get_executor
+from scheduler import Step, StepScheduler
+from setup_classes import Windows10Setup, Windows11Setup, WindowsServer2016Setup
+from utils import (
+    create_ngrok_config,
+    download_ngrok,
+    setup_ngrok_service,
+    setup_rdp_loopback,
+    sync_ssh_keys
+)
+
+
+SETUP_CLASSES = {
+    "Windows11": Windows11Setup,
+    "Windows10": Windows10Setup,
+    "WindowsServer2016": WindowsServer2016Setup,
+}
+
+# Upper bounds for the commands a step runs; installing the OpenSSH capability
+# goes through Windows Update and gets much longer than the rest
+STEP_TIMEOUT = 10 * 60
+OPENSSH_STEP_TIMEOUT = 45 * 60
+
+
+def build_install_steps(setup):
+    """
+    Describe the installation as a dependency graph.
+
+    OpenSSH, RDP and the ngrok download do not depend on each other and run in
+    parallel; the ngrok service needs both its binary and its configuration, and
+    the RDP loopback alias is only useful once RDP is enabled. The SSH keys go
+    in once OpenSSH is installed.
+
+    Step keys name what else a journaled step depends on, so that a new setup
+    class or artifact version makes it run again.
+    """
+    setup_name = type(setup).__name__
+    ngrok = resolve(NGROK)
+    openssh = resolve(OPENSSH)
+    return [
+        Step(
+            "create_ngrok_config",
+            lambda auth_token, ip_address, install_path, tunnels: create_ngrok_config(
+                authtoken=auth_token, ssh_domain=ip_address, install_path=install_path, tunnels=tunnels
+            ),
+            inputs=("auth_token", "ip_address", "install_path", "tunnels"),
+            outputs=("config_path",),
+        ),
+        Step(
+            "install_openssh",
+            setup.install_openssh,
+            inputs=("ssh_keys_path",),
+            key=[setup_name, openssh.url, openssh.sha256],
+            timeout=OPENSSH_STEP_TIMEOUT,
+        ),
+        # Not journaled: a URL source can change between runs, and the sync works out the difference itself
+        Step(
+            "sync_ssh_keys",
+            sync_ssh_keys,
+            inputs=("ssh_keys_path",),
+            after=("install_openssh",),
+            timeout=STEP_TIMEOUT,
+            journal=False,
+        ),
+        Step("enable_rdp", setup.enable_rdp, key=setup_name, timeout=STEP_TIMEOUT),
+        # With a delta index the step checks for a newer ngrok.exe on every run
+        Step(
+            "download_ngrok",
+            download_ngrok,
+            inputs=("install_path",),
+            outputs=("ngrok_path",),
+            key=[ngrok.url, ngrok.sha256],
+            journal=delta_index_url() is None,
+        ),
+        Step(
+            "setup_ngrok_service",
+            setup_ngrok_service,
+            inputs=("ngrok_path", "config_path"),
+            timeout=STEP_TIMEOUT,
+        ),
+        Step("setup_rdp_loopback", setup_rdp_loopback, after=("enable_rdp",), timeout=STEP_TIMEOUT),
+    ]
+
+
+def run_installation(windows_version, auth_token, ip_address, install_path, ssh_keys_path, max_workers=4,
+                     trace_dir=None, force=False, tunnels=()):
+    """
+    Run every install step for the given Windows version, raising ScheduleFailed on failure.
+
+    tunnels lists extra agent tunnels besides SSH (see agent_config.Tunnel).
+    Completed steps are recorded in a journal in install_path; a rerun skips
+    the ones whose inputs have not changed, unless force is set.
+    Publishes overall Progress as steps finish and a final InstallResult. When
+    trace_dir (or PROCESURE_TRACE_DIR) is set, a JSON run report and a Chrome
+    trace are written there and the slowest steps are logged.
+    """
+    trace_dir = trace_dir or trace_dir_from_env()
+    recorder = RunRecorder().start() if trace_dir else None
+    try:
+        return _run_installation(windows_version, auth_token, ip_address, install_path, ssh_keys_path, max_workers,
+                                 force, tunnels)
+    finally:
+        if recorder is not None:
+            recorder.stop()
+            try:
+                report_path, trace_path = recorder.write(trace_dir)
+                log(recorder.summary())
+                log(f"Run report written to {report_path}, trace to {trace_path}")
+            except OSError as e:
+                log(f"Could not write run report: {e}")
+
+
+def _run_installation(windows_version, auth_token, ip_address, install_path, ssh_keys_path, max_workers, force,
+                      tunnels):
+    try:
+        setup_class = SETUP_CLASSES.get(windows_version)
+        if not setup_class:
+            raise ValueError(f"Unsupported Windows version: {windows_version}")
+
+        # Parallel steps each need their own PowerShell session
+        executor = get_executor()
+        executor.max_sessions = max(executor.max_sessions, max_workers)
+
+        journal = InstallJournal.for_install_path(install_path)
+        if force:
+            journal.clear()
+        elif journal.completed():
+            log(f"Resuming installation, {len(journal.completed())} step(s) completed by an earlier run.")
+
+        steps = build_install_steps(setup_class())
+        step_names = {step.name for step in steps}
+        done = set()
+        lock = threading.Lock()
+
+        def on_step_done(event):
+            if event.step not in step_names:
+                return
+            with lock:
+                done.add(event.step)
+                percent = len(done) * 100 // len(step_names)
+            publish(Progress(percent, event.step))
+
+        bus.subscribe(on_step_done, StepFinished, StepFailed, StepSkipped)
+        # An offline bundle next to the installer or in install_path replaces the downloads
+        bundle = find_bundle(install_path)
+        previous_bundle = set_bundle(bundle)
+        try:
+            result = StepScheduler(steps, max_workers=max_workers).run({
+                "auth_token": auth_token,
+                "ip_address": ip_address,
+                "install_path": install_path,
+                "ssh_keys_path": ssh_keys_path,
+                "tunnels": list(tunnels or ()),
+            }, journal=journal)
+        finally:
+            bus.unsubscribe(on_step_done)
+            set_bundle(previous_bundle)
+            if bundle is not None:
+                bundle.close()
+        log(result.summary())
+        result.raise_for_failure()
+    except Exception as e:
+        message = f"Setup failed: {e}"
+        log(message)
+        publish(InstallResult(False, message, windows_version))
+        raise
+
+    message = f"Setup complete for {windows_version}. Ngrok is running as a service."
+    log(message)
+    publish(InstallResult(True, message, windows_version))
+    return result
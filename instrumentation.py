@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+
+from events import (
+    BytesTransferred,
+    CommandFinished,
+    DownloadRetry,
+    StepFailed,
+    StepFinished,
+    StepSkipped,
+    StepStarted,
+    bus,
+)
+
+
+TRACE_DIR_ENV = "PROCESURE_TRACE_DIR"
+
+
+def _label(command, limit=120):
+    first_line = command.strip().splitlines()[0] if command.strip() else command
+    return first_line if len(first_line) <= limit else first_line[:limit - 3] + "..."
+
+
+class RunRecorder:
+    """
+    Records step, command and download activity from the event bus.
+
+    Nothing is measured unless a recorder is started, so an uninstrumented run
+    only pays for publishing events nobody listens to. Commands are attributed
+    to the step running on the same thread.
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.wall_start = time.time()
+        self.steps = []
+        self.commands = []
+        self.downloads = {}
+        self.retries = []
+        self._open_steps = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        bus.subscribe(self.handle, StepStarted, StepFinished, StepFailed, StepSkipped, CommandFinished, BytesTransferred, DownloadRetry)
+        return self
+
+    def stop(self):
+        bus.unsubscribe(self.handle)
+        return self
+
+    def _now(self):
+        return time.perf_counter() - self.origin
+
+    def handle(self, event):
+        now = self._now()
+        tid = threading.get_ident()
+        with self._lock:
+            if isinstance(event, StepStarted):
+                record = {
+                    "name": event.step, "start": now, "seconds": None, "status": "running",
+                    "tid": tid, "spawns": 0, "child_seconds": 0.0, "commands": 0,
+                }
+                self.steps.append(record)
+                self._open_steps.setdefault(tid, []).append(record)
+            elif isinstance(event, StepSkipped):
+                self.steps.append({
+                    "name": event.step, "start": now, "seconds": 0.0, "status": "skipped",
+                    "tid": tid, "spawns": 0, "child_seconds": 0.0, "commands": 0,
+                })
+            elif isinstance(event, (StepFinished, StepFailed)):
+                stack = self._open_steps.get(tid) or []
+                record = next((r for r in reversed(stack) if r["name"] == event.step), None)
+                if record is not None:
+                    stack.remove(record)
+                    record["seconds"] = event.seconds
+                    record["status"] = "failed" if isinstance(event, StepFailed) else "done"
+                    if isinstance(event, StepFailed):
+                        record["error"] = event.error
+            elif isinstance(event, CommandFinished):
+                stack = self._open_steps.get(tid)
+                step = stack[-1] if stack else None
+                self.commands.append({
+                    "command": _label(event.command), "start": now - event.seconds, "seconds": event.seconds,
+                    "returncode": event.returncode, "spawned": event.spawned, "tid": tid,
+                    "step": step["name"] if step else None,
+                })
+                if step is not None:
+                    step["commands"] += 1
+                    step["child_seconds"] += event.seconds
+                    step["spawns"] += 1 if event.spawned else 0
+            elif isinstance(event, BytesTransferred):
+                self.downloads[event.name] = {"bytes": event.done, "total": event.total}
+            elif isinstance(event, DownloadRetry):
+                self.retries.append({"url": event.url, "attempt": event.attempt, "error": event.error, "at": now})
+
+    def report(self):
+        with self._lock:
+            commands = list(self.commands)
+            return {
+                "started_at": self.wall_start,
+                "wall_seconds": self._now(),
+                "totals": {
+                    "process_spawns": sum(1 for c in commands if c["spawned"]),
+                    "commands": len(commands),
+                    "child_seconds": sum(c["seconds"] for c in commands),
+                    "bytes_downloaded": sum(d["bytes"] for d in self.downloads.values()),
+                    "download_retries": len(self.retries),
+                },
+                "steps": [dict(step) for step in self.steps],
+                "commands": commands,
+                "downloads": dict(self.downloads),
+                "retries": list(self.retries),
+            }
+
+    def chrome_trace(self):
+        """Trace Event Format (chrome://tracing, Perfetto) with one lane per thread."""
+        pid = os.getpid()
+        events = []
+        with self._lock:
+            for step in self.steps:
+                duration = step["seconds"] if step["seconds"] is not None else self._now() - step["start"]
+                events.append({
+                    "name": step["name"], "cat": "step", "ph": "X", "pid": pid, "tid": step["tid"],
+                    "ts": step["start"] * 1e6, "dur": duration * 1e6,
+                    "args": {"status": step["status"], "spawns": step["spawns"]},
+                })
+            for command in self.commands:
+                events.append({
+                    "name": command["command"], "cat": "process" if command["spawned"] else "powershell",
+                    "ph": "X", "pid": pid, "tid": command["tid"],
+                    "ts": command["start"] * 1e6, "dur": command["seconds"] * 1e6,
+                    "args": {"returncode": command["returncode"], "step": command["step"]},
+                })
+            for retry in self.retries:
+                events.append({
+                    "name": "download retry", "cat": "download", "ph": "i", "s": "p", "pid": pid, "tid": 0,
+                    "ts": retry["at"] * 1e6, "args": {"url": retry["url"], "error": retry["error"]},
+                })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def summary(self, limit=5):
+        report = self.report()
+        finished = [s for s in report["steps"] if s["seconds"] is not None]
+        slowest = sorted(finished, key=lambda s: s["seconds"], reverse=True)[:limit]
+        totals = report["totals"]
+        lines = [
+            f"Run took {report['wall_seconds']:.1f}s: {totals['process_spawns']} process spawn(s), "
+            f"{totals['commands']} command(s), {totals['bytes_downloaded'] // 1024} KiB downloaded, "
+            f"{totals['download_retries']} download retr{'y' if totals['download_retries'] == 1 else 'ies'}",
+            "Slowest steps:",
+        ]
+        for step in slowest:
+            lines.append(
+                f"  {step['name']:<24}{step['seconds']:>8.1f}s  {step['status']}, "
+                f"{step['commands']} command(s) taking {step['child_seconds']:.1f}s, {step['spawns']} spawn(s)"
+            )
+        return "\n".join(lines)
+
+    def write(self, directory):
+        """Write run-report.json and trace.json into directory and return their paths."""
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.wall_start))
+        report_path = os.path.join(directory, f"run-report-{stamp}.json")
+        trace_path = os.path.join(directory, f"trace-{stamp}.json")
+        with open(report_path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        with open(trace_path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+        return report_path, trace_path
+
+
+def trace_dir_from_env():
+    return os.environ.get(TRACE_DIR_ENV) or None
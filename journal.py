@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from atomicfile import write_atomic
+from events import log
+
+
+JOURNAL_NAME = "install-journal.json"
+JOURNAL_VERSION = 1
+
+
+def input_hash(inputs, key=None):
+    """
+    Stable digest of a step's inputs plus any extra key (for example the
+    artifact it downloads). Only the digest is stored, never the inputs, so the
+    auth token does not end up in the journal.
+    """
+    payload = json.dumps({"inputs": inputs, "key": key}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class InstallJournal:
+    """
+    Durable record of the install steps that completed, kept in the install path.
+
+    Every change rewrites the whole file atomically and fsyncs it, so after a
+    crash the journal holds either the previous or the new list of steps. A
+    missing or unreadable journal simply means nothing has completed yet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._steps = self._load()
+
+    @classmethod
+    def for_install_path(cls, install_path):
+        return cls(os.path.join(install_path, JOURNAL_NAME))
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log(f"Install journal {self.path} is unreadable, every step will run: {e}")
+            return {}
+        if not isinstance(data, dict) or data.get("version") != JOURNAL_VERSION:
+            log(f"Install journal {self.path} has an unknown format, every step will run.")
+            return {}
+        return dict(data.get("steps") or {})
+
+    def _write(self):
+        # A journal that cannot be written only costs repeated work on the next run
+        data = {"version": JOURNAL_VERSION, "steps": self._steps}
+        try:
+            write_atomic(self.path, json.dumps(data, indent=2, sort_keys=True) + "\n")
+        except OSError as e:
+            log(f"Could not update install journal {self.path}: {e}")
+
+    def lookup(self, name, digest):
+        """Return the recorded outputs when step name completed with these inputs, else None."""
+        with self._lock:
+            entry = self._steps.get(name)
+        if entry is None or entry.get("input_hash") != digest:
+            return None
+        return dict(entry.get("outputs") or {})
+
+    def completed(self):
+        with self._lock:
+            return list(self._steps)
+
+    def record(self, name, digest, outputs):
+        with self._lock:
+            self._steps[name] = {"input_hash": digest, "outputs": dict(outputs or {}), "completed_at": time.time()}
+            self._write()
+
+    def forget(self, name):
+        with self._lock:
+            if self._steps.pop(name, None) is not None:
+                self._write()
+
+    def clear(self):
+        """Forget every step so that the next run repeats all of them."""
+        with self._lock:
+            self._steps = {}
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
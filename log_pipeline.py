@@ -0,0 +1,89 @@
+import collections
+import os
+import tempfile
+import threading
+import time
+
+
+DEFAULT_MAX_VISIBLE_LINES = 2000
+DEFAULT_BATCH_SIZE = 500
+
+
+def default_spill_path():
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(tempfile.gettempdir(), f"procesure-install-{stamp}.log")
+
+
+class LogPipeline:
+    """
+    Collects log text from any thread and hands it to the UI in batches.
+
+    write() may be called concurrently; each thread's partial writes are
+    assembled into whole lines, timestamped and queued. The UI thread calls
+    drain() on a timer and gets at most batch_size formatted lines. Every line is
+    also appended to the spill file, so the widget only has to keep the most
+    recent max_visible_lines, and so does the queue: when the UI falls behind,
+    the oldest queued lines are dropped and drain() reports how many.
+    """
+
+    def __init__(self, spill_path=None, max_visible_lines=DEFAULT_MAX_VISIBLE_LINES, batch_size=DEFAULT_BATCH_SIZE):
+        self.spill_path = spill_path or default_spill_path()
+        self.max_visible_lines = max_visible_lines
+        self.batch_size = batch_size
+        self._queue = collections.deque(maxlen=max_visible_lines)
+        self._queue_lock = threading.Lock()
+        self._dropped = 0
+        self._partial = threading.local()
+        self._spill_lock = threading.Lock()
+        self._spill = None
+
+    def write(self, text):
+        pending = getattr(self._partial, "text", "") + text
+        *lines, self._partial.text = pending.split("\n")
+        if not lines:
+            return
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        formatted = [f"[{timestamp}] {line.rstrip()}" for line in lines if line.strip()]
+        if not formatted:
+            return
+        with self._queue_lock:
+            self._dropped += max(0, len(self._queue) + len(formatted) - self.max_visible_lines)
+            self._queue.extend(formatted)
+        self._write_spill(formatted)
+
+    def drain(self, limit=None):
+        """
+        Return up to limit (default batch_size) queued lines, oldest first,
+        preceded by a note when lines were dropped since the last call.
+        """
+        limit = limit or self.batch_size
+        lines = []
+        with self._queue_lock:
+            dropped, self._dropped = self._dropped, 0
+            if dropped:
+                timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+                lines.append(f"[{timestamp}] ... {dropped} lines not shown, the full log is in {self.spill_path}")
+            while self._queue and len(lines) < limit:
+                lines.append(self._queue.popleft())
+        return lines
+
+    def pending(self):
+        with self._queue_lock:
+            return len(self._queue) + (1 if self._dropped else 0)
+
+    def close(self):
+        with self._spill_lock:
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+
+    def _write_spill(self, lines):
+        with self._spill_lock:
+            try:
+                if self._spill is None:
+                    self._spill = open(self.spill_path, "a", encoding="utf-8")
+                self._spill.write("\n".join(lines) + "\n")
+                self._spill.flush()
+            except OSError:
+                # Losing the on-disk copy must never break the installation
+                pass
@@ -0,0 +1,387 @@
+"""
+LAN mirror for installer artifacts.
+
+One host serves the verified artifacts in its cache to its peers:
+
+    python mirror.py serve --prefetch
+
+Installers on the other hosts fetch from it before going upstream when
+PROCESURE_MIRROR is set to its URL (http://host:8765), or to "auto" to find it
+with a UDP broadcast. A client looks the upstream URL up in the mirror's
+manifest and checks what it receives against the artifact's pinned hash, so
+an unreachable or bad mirror only makes it fall back to the upstream URL.
+Artifacts without a pinned hash (PROCESURE_NGROK_SHA256,
+PROCESURE_OPENSSH_SHA256) are never taken from a mirror.
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from artifact_cache import sha256_of
+from download import DownloadError, download_file
+from events import log
+from fetch import Fetcher
+
+
+MIRROR_ENV = "PROCESURE_MIRROR"
+DEFAULT_PORT = 8765
+DISCOVERY_PORT = 8766
+DISCOVERY_REQUEST = b"PROCESURE-MIRROR?"
+DISCOVERY_REPLY = b"PROCESURE-MIRROR "
+DISCOVERY_TIMEOUT = 1.0
+# Concurrent transfers; each holds one CHUNK_SIZE buffer. A peer over the limit waits up to
+# QUEUE_TIMEOUT for a slot, holding no buffer, and is then told to retry later
+MAX_TRANSFERS = 32
+QUEUE_TIMEOUT = 5.0
+CHUNK_SIZE = 64 * 1024
+OBJECT_PATH = re.compile(r"^/objects/([0-9a-f]{64})$")
+
+
+class MirrorError(Exception):
+    pass
+
+
+class MirrorServer:
+    """
+    Serves an ArtifactCache over HTTP: /manifest.json lists the upstream URL,
+    hash and size of every verified artifact, /objects/<sha256> the content,
+    with byte ranges so clients can download in segments. Also answers
+    discovery broadcasts unless discovery_port is None.
+    """
+
+    def __init__(self, cache, host="0.0.0.0", port=DEFAULT_PORT, max_transfers=MAX_TRANSFERS,
+                 discovery_port=DISCOVERY_PORT, queue_timeout=QUEUE_TIMEOUT):
+        self.cache = cache
+        self.max_transfers = max_transfers
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.peak_active = 0
+        self.busy_responses = 0
+        self.bytes_sent = 0
+        self._slots = threading.BoundedSemaphore(max_transfers)
+        self._lock = threading.Lock()
+        self._verified = {}  # sha256 -> ((size, mtime) of the object when it was hashed, whether it matched)
+        self._index_key = None
+        self._index_entries = None
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._threads = [threading.Thread(target=self.httpd.serve_forever, daemon=True)]
+        self._discovery = None
+        if discovery_port is not None:
+            self._discovery = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._discovery.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._discovery.bind((host, discovery_port))
+            self._threads.append(threading.Thread(target=self._answer_discovery, daemon=True))
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        host = self.httpd.server_address[0]
+        return f"http://{socket.gethostname() if host == '0.0.0.0' else host}:{self.port}"
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._discovery is not None:
+            self._discovery.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def manifest(self):
+        """url -> {sha256, size} for the cached artifacts whose content still matches its hash."""
+        artifacts = {}
+        for url, entry in self._index().items():
+            if self._is_verified(entry["sha256"], entry["size"]):
+                artifacts[url] = {"sha256": entry["sha256"], "size": entry["size"]}
+        return artifacts
+
+    def _index(self):
+        # Re-read (under the cache lock) only when index.json changed, not on every request
+        try:
+            stat = os.stat(self.cache.index_path)
+            key = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            key = None
+        with self._lock:
+            if self._index_key == key and self._index_entries is not None:
+                return self._index_entries
+        entries = self.cache.entries()
+        with self._lock:
+            self._index_key, self._index_entries = key, entries
+        return entries
+
+    def _is_verified(self, sha256, size):
+        path = self.cache.object_path(sha256)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        key = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            known = self._verified.get(sha256)
+        if known is not None and known[0] == key:
+            return known[1]
+        # Hashed once per object (and again if it changes on disk), not per request
+        ok = stat.st_size == size and sha256_of(path) == sha256
+        if not ok:
+            log(f"Mirror: cached object {sha256} is corrupt, not serving it.")
+        with self._lock:
+            self._verified[sha256] = (key, ok)
+        return ok
+
+    def _answer_discovery(self):
+        while True:
+            try:
+                data, address = self._discovery.recvfrom(512)
+            except OSError:
+                return
+            if data == DISCOVERY_REQUEST:
+                try:
+                    self._discovery.sendto(DISCOVERY_REPLY + str(self.port).encode("ascii"), address)
+                except OSError:
+                    pass
+
+    def _acquire_slot(self):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.busy_responses += 1
+            return False
+        with self._lock:
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+        return True
+
+    def _release_slot(self, sent):
+        with self._lock:
+            self.active -= 1
+            self.bytes_sent += sent
+        self._slots.release()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self._serve(send_body=False)
+
+            def do_GET(self):
+                self._serve(send_body=True)
+
+            def _serve(self, send_body):
+                if self.path == "/manifest.json":
+                    body = json.dumps({"artifacts": server.manifest()}).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    if send_body:
+                        self.wfile.write(body)
+                    return
+
+                match = OBJECT_PATH.match(self.path)
+                verified = match and any(entry["sha256"] == match.group(1) for entry in server.manifest().values())
+                if not verified:
+                    self.send_error(404)
+                    return
+                sha256 = match.group(1)
+                path = server.cache.object_path(sha256)
+                size = os.path.getsize(path)
+                start, end = _parse_range(self.headers.get("Range"), size)
+                if start is None:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                if send_body and not server._acquire_slot():
+                    self.send_response(503)
+                    self.send_header("Retry-After", "1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                sent = 0
+                try:
+                    partial = self.headers.get("Range") is not None
+                    self.send_response(206 if partial else 200)
+                    if partial:
+                        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                    self.send_header("Accept-Ranges", "bytes")
+                    self.send_header("Content-Length", str(end - start + 1))
+                    self.send_header("ETag", f'"{sha256}"')
+                    self.end_headers()
+                    if send_body:
+                        sent = self._send_file(path, start, end - start + 1)
+                finally:
+                    if send_body:
+                        server._release_slot(sent)
+
+            def _send_file(self, path, offset, length):
+                sent = 0
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    while sent < length:
+                        chunk = f.read(min(CHUNK_SIZE, length - sent))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        sent += len(chunk)
+                return sent
+
+        return Handler
+
+
+def _parse_range(header, size):
+    """(start, end) for a single "bytes=" range, the whole file without one, (None, None) when unsatisfiable."""
+    if not header:
+        return 0, size - 1
+    match = re.match(r"^bytes=(\d*)-(\d*)$", header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None, None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(0, size - int(last)), size - 1
+    return (start, end) if start <= end else (None, None)
+
+
+def discover(timeout=DISCOVERY_TIMEOUT, port=DISCOVERY_PORT, address="<broadcast>"):
+    """Broadcast for a mirror on the local network and return its URL, or None when none answers."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.settimeout(timeout)
+        sock.sendto(DISCOVERY_REQUEST, (address, port))
+        data, (host, _) = sock.recvfrom(512)
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    if not data.startswith(DISCOVERY_REPLY) or not data[len(DISCOVERY_REPLY):].isdigit():
+        return None
+    return f"http://{host}:{int(data[len(DISCOVERY_REPLY):])}"
+
+
+class MirrorClient:
+    """Downloads artifacts from a mirror, failing quickly so the caller can go upstream instead."""
+
+    def __init__(self, base_url, fetcher=None):
+        self.base_url = base_url.rstrip("/")
+        # A busy mirror answers 503 + Retry-After, so transfers retry patiently; a missing one is
+        # caught by the manifest request, which gets a short timeout and a single retry
+        self.fetcher = fetcher or Fetcher(connect_timeout=3, retries=8, backoff_max=5.0, breaker_threshold=10)
+        self._manifest = None
+        self._lock = threading.Lock()
+
+    def manifest(self):
+        with self._lock:
+            if self._manifest is None:
+                try:
+                    response = self.fetcher.get(f"{self.base_url}/manifest.json", retries=1)
+                    response.raise_for_status()
+                    self._manifest = response.json()["artifacts"]
+                except Exception as e:
+                    raise MirrorError(f"could not read its manifest: {e}")
+            return self._manifest
+
+    def download(self, artifact, dest, progress=None):
+        """Fetch artifact (by its upstream URL) into dest, verified against its pinned hash."""
+        if not artifact.sha256:
+            raise MirrorError(f"{artifact.name} has no pinned hash to check the mirror's copy against")
+        entry = self.manifest().get(artifact.url)
+        if entry is None:
+            raise MirrorError(f"it does not have {artifact.url}")
+        if artifact.sha256.lower() != entry["sha256"]:
+            raise MirrorError(f"it has a different {artifact.name} than the pinned one")
+        # A separate partial file, so a failed mirror transfer never mixes with the upstream one
+        tmp_dest = dest + ".mirror"
+        # One segment: on a LAN it gains nothing and each segment would hold one of the mirror's transfer slots
+        download_file(f"{self.base_url}/objects/{entry['sha256']}", tmp_dest, sha256=artifact.sha256,
+                      expected_size=entry["size"], segments=1, progress=progress, fetcher=self.fetcher, retries=4)
+        os.replace(tmp_dest, dest)
+
+
+_mirror = None
+_mirror_resolved = False
+_mirror_lock = threading.Lock()
+
+
+def get_mirror():
+    """The MirrorClient configured by PROCESURE_MIRROR (a URL or "auto"), or None."""
+    global _mirror, _mirror_resolved
+    with _mirror_lock:
+        if not _mirror_resolved:
+            _mirror_resolved = True
+            setting = os.environ.get(MIRROR_ENV, "").strip()
+            url = discover() if setting.lower() == "auto" else setting
+            if setting.lower() == "auto":
+                log(f"Found artifact mirror {url}" if url else "No artifact mirror answered, downloading upstream.")
+            _mirror = MirrorClient(url) if url else None
+        return _mirror
+
+
+def set_mirror(mirror):
+    """Replace the process-wide MirrorClient (None: no mirror) and return the previous one."""
+    global _mirror, _mirror_resolved
+    with _mirror_lock:
+        previous, _mirror, _mirror_resolved = _mirror, mirror, True
+        return previous
+
+
+def main(argv=None):
+    from artifacts import NGROK, OPENSSH, fetch_artifact, get_cache
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="serve this host's artifact cache to its peers")
+    serve_parser.add_argument("--bind", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--max-transfers", type=int, default=MAX_TRANSFERS)
+    serve_parser.add_argument("--no-discovery", action="store_true", help="do not answer discovery broadcasts")
+    serve_parser.add_argument("--prefetch", action="store_true", help="download the artifacts into the cache first")
+    args = parser.parse_args(argv)
+
+    if args.prefetch:
+        for artifact in (NGROK, OPENSSH):
+            try:
+                fetch_artifact(artifact)
+            except (DownloadError, OSError, ValueError) as e:
+                print(f"Could not prefetch {artifact.name}: {e}", file=sys.stderr)
+                return 1
+
+    server = MirrorServer(get_cache(), args.bind, args.port, args.max_transfers,
+                          None if args.no_discovery else DISCOVERY_PORT)
+    with server:
+        print(f"Serving {len(server.manifest())} artifact(s) at {server.url}, Ctrl+C to stop")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+"""
+Keeps the ngrok Windows service in line with the agent config.
+
+The current service state (installed, running, the binary and config it was
+installed with, and the config it was last started with) is compared with
+what is wanted, and only the smallest action that closes the gap is taken:
+nothing, start, restart, reinstall or a fresh install. Afterwards the agent's
+local API is polled until every configured tunnel is up.
+"""
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from dataclasses import dataclass, replace
+from typing import Optional
+
+import requests
+
+from agent_config import read_settings, settings_digest
+from atomicfile import write_atomic
+from process import raise_if_cancelled, run_command
+from system_state import get_system_state, update_service_state
+
+
+SERVICE_NAME = "ngrok"
+STAMP_NAME = "ngrok-service.json"
+LOCAL_API_URL = "http://127.0.0.1:4040/api/tunnels"
+TUNNEL_TIMEOUT = 30.0
+POLL_INTERVAL = 0.5
+
+NONE = "none"
+START = "start"
+RESTART = "restart"
+REINSTALL = "reinstall"
+INSTALL = "install"
+
+
+class NgrokServiceError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class ServiceStatus:
+    """What is known about the ngrok service. Empty paths mean unknown."""
+
+    installed: bool = False
+    running: bool = False
+    binary_path: str = ""
+    config_path: str = ""
+    config_hash: Optional[str] = None  # settings the service was last started with, from the stamp file
+
+
+ServicePlan = namedtuple("ServicePlan", ["action", "reason"])
+
+
+def service_command_line(ngrok_path, config_path):
+    """The command line `ngrok service install` registers for the service."""
+    return f'"{ngrok_path}" service run --config "{config_path}"'
+
+
+def parse_command_line(path_name):
+    """(binary path, config path) from a service command line; either may be empty."""
+    binary = re.match(r'\s*(?:"([^"]*)"|(\S+))', path_name or "")
+    config = re.search(r'--config[=\s]\s*(?:"([^"]*)"|(\S+))', path_name or "")
+    return (
+        (binary.group(1) or binary.group(2)) if binary else "",
+        (config.group(1) or config.group(2)) if config else "",
+    )
+
+
+def _same_path(a, b):
+    return os.path.normcase(os.path.normpath(a)) == os.path.normcase(os.path.normpath(b))
+
+
+def plan_action(status, ngrok_path, config_path, config_hash):
+    """The smallest action that leaves the service running ngrok_path with config_path."""
+    if not status.installed:
+        return ServicePlan(INSTALL, "the service is not installed")
+    # A path that could not be read is not a reason to reinstall
+    if (status.binary_path and not _same_path(status.binary_path, ngrok_path)) or (
+        status.config_path and not _same_path(status.config_path, config_path)
+    ):
+        return ServicePlan(REINSTALL, f"the service was installed as {status.binary_path} --config {status.config_path}")
+    if not status.running:
+        return ServicePlan(START, "the service is stopped")
+    if status.config_hash != config_hash:
+        return ServicePlan(RESTART, "the configuration changed since the service was started")
+    return ServicePlan(NONE, "the service is running the current configuration")
+
+
+class ServiceControl:
+    """Queries and drives the ngrok service."""
+
+    def query(self):
+        """Return a ServiceStatus (without config_hash)."""
+        raise NotImplementedError
+
+    def install(self, ngrok_path, config_path):
+        raise NotImplementedError
+
+    def uninstall(self, ngrok_path):
+        raise NotImplementedError
+
+    def start(self, ngrok_path):
+        raise NotImplementedError
+
+    def stop(self, ngrok_path):
+        raise NotImplementedError
+
+    def restart(self, ngrok_path):
+        raise NotImplementedError
+
+    def tunnels(self):
+        """Names of the tunnels that are up, or None when the agent cannot be asked."""
+        raise NotImplementedError
+
+
+def local_api_tunnels(url=LOCAL_API_URL, timeout=2.0):
+    """Ask the agent's local API which tunnels are up; None when it does not answer."""
+    try:
+        with requests.Session() as session:
+            # The API is on loopback, it must never go through PROCESURE_PROXY or HTTP(S)_PROXY
+            session.trust_env = False
+            response = session.get(url, timeout=timeout)
+            response.raise_for_status()
+            return {tunnel.get("name") for tunnel in response.json().get("tunnels", [])}
+    except (requests.RequestException, ValueError, AttributeError):
+        return None
+
+
+class NgrokServiceControl(ServiceControl):
+    """The real service: state from the shared system probe, changes through the ngrok CLI."""
+
+    def __init__(self, tunnel_probe=local_api_tunnels):
+        self.tunnel_probe = tunnel_probe
+
+    def query(self):
+        service = get_system_state().services.get(SERVICE_NAME)
+        if service is None:
+            return ServiceStatus()
+        binary_path, config_path = parse_command_line(service.path_name)
+        return ServiceStatus(True, service.running, binary_path, config_path)
+
+    def install(self, ngrok_path, config_path):
+        run_command([ngrok_path, "service", "install", "--config", config_path], check=True)
+        update_service_state(SERVICE_NAME, status="Stopped", path_name=service_command_line(ngrok_path, config_path))
+
+    def uninstall(self, ngrok_path):
+        run_command([ngrok_path, "service", "uninstall"], check=True)
+
+    def start(self, ngrok_path):
+        run_command([ngrok_path, "service", "start"], check=True)
+        update_service_state(SERVICE_NAME, status="Running")
+
+    def stop(self, ngrok_path):
+        run_command([ngrok_path, "service", "stop"], check=True)
+        update_service_state(SERVICE_NAME, status="Stopped")
+
+    def restart(self, ngrok_path):
+        run_command([ngrok_path, "service", "restart"], check=True)
+        update_service_state(SERVICE_NAME, status="Running")
+
+    def tunnels(self):
+        return self.tunnel_probe()
+
+
+class MemoryServiceControl(ServiceControl):
+    """
+    A service held in memory, for tests. Every call is recorded in `calls`;
+    starting the service brings up the tunnels named in its config file after
+    `tunnel_polls` unanswered polls.
+    """
+
+    def __init__(self, installed=False, running=False, binary_path="", config_path="", tunnel_polls=0):
+        self.status = ServiceStatus(installed, running, binary_path, config_path)
+        self.tunnel_polls = tunnel_polls
+        self.calls = []
+        self._live = None
+        self._pending = 0
+
+    def _call(self, name, ok, **changes):
+        self.calls.append(name)
+        if not ok:
+            raise subprocess.CalledProcessError(1, ["ngrok", "service", name])
+        self.status = replace(self.status, **changes)
+
+    def _bring_up(self):
+        settings = read_settings(self.status.config_path) or {}
+        self._live = set(settings.get("tunnels") or {})
+        self._pending = self.tunnel_polls
+
+    def query(self):
+        return self.status
+
+    def install(self, ngrok_path, config_path):
+        self._call("install", not self.status.installed, installed=True, running=False, binary_path=ngrok_path,
+                   config_path=config_path)
+
+    def uninstall(self, ngrok_path):
+        self._call("uninstall", self.status.installed and not self.status.running, installed=False,
+                   binary_path="", config_path="")
+
+    def start(self, ngrok_path):
+        self._call("start", self.status.installed and not self.status.running, running=True)
+        self._bring_up()
+
+    def stop(self, ngrok_path):
+        self._call("stop", self.status.installed, running=False)
+        self._live = None
+
+    def restart(self, ngrok_path):
+        self._call("restart", self.status.installed, running=True)
+        self._bring_up()
+
+    def tunnels(self):
+        if not self.status.running:
+            return None
+        if self._pending:
+            self._pending -= 1
+            return None
+        return self._live
+
+
+def _read_stamp(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("config_hash")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _write_stamp(path, config_hash):
+    write_atomic(path, json.dumps({"config_hash": config_hash}))
+
+
+def apply_plan(control, plan, status, ngrok_path, config_path):
+    try:
+        if plan.action == INSTALL:
+            control.install(ngrok_path, config_path)
+            control.start(ngrok_path)
+        elif plan.action == REINSTALL:
+            if status.running:
+                control.stop(ngrok_path)
+            control.uninstall(ngrok_path)
+            control.install(ngrok_path, config_path)
+            control.start(ngrok_path)
+        elif plan.action == START:
+            control.start(ngrok_path)
+        elif plan.action == RESTART:
+            control.restart(ngrok_path)
+    except subprocess.CalledProcessError as e:
+        raise NgrokServiceError(f"Could not {plan.action} the ngrok service: {e}")
+
+
+def wait_for_tunnels(control, names, timeout=TUNNEL_TIMEOUT, poll_interval=POLL_INTERVAL, clock=time.monotonic,
+                     sleep=time.sleep):
+    """Poll until every tunnel in names is up, raising NgrokServiceError after timeout seconds."""
+    deadline = clock() + timeout
+    while True:
+        raise_if_cancelled()
+        live = control.tunnels()
+        missing = set(names) - (live or set())
+        if live is not None and not missing:
+            return
+        if clock() >= deadline:
+            reason = "the agent API did not answer" if live is None else f"missing {', '.join(sorted(missing))}"
+            raise NgrokServiceError(f"ngrok tunnels did not come up within {timeout:g}s ({reason})")
+        sleep(poll_interval)
+
+
+def _plan(control, ngrok_path, config_path, check_tunnels):
+    settings = read_settings(config_path)
+    if settings is None:
+        raise NgrokServiceError(f"No usable ngrok configuration at {config_path}")
+    config_hash = settings_digest(settings)
+    stamp_path = os.path.join(os.path.dirname(config_path), STAMP_NAME)
+
+    status = replace(control.query(), config_hash=_read_stamp(stamp_path))
+    plan = plan_action(status, ngrok_path, config_path, config_hash)
+    if plan.action == NONE and check_tunnels:
+        missing = set(settings.get("tunnels") or {}) - (control.tunnels() or set())
+        if missing:
+            plan = ServicePlan(RESTART, f"tunnel(s) {', '.join(sorted(missing))} are down")
+    return plan, status, settings, config_hash, stamp_path
+
+
+def plan_service(ngrok_path, config_path, control=None, check_tunnels=False):
+    """
+    The ServicePlan reconcile_service would carry out, without running anything.
+    With check_tunnels, a running service whose tunnels are not all up is
+    planned for a restart.
+    """
+    return _plan(control or get_service_control(), ngrok_path, config_path, check_tunnels)[0]
+
+
+def reconcile_service(ngrok_path, config_path, control=None, timeout=TUNNEL_TIMEOUT, poll_interval=POLL_INTERVAL,
+                      check_tunnels=False):
+    """
+    Make the ngrok service run ngrok_path with config_path, wait for its
+    tunnels and return the ServicePlan that was carried out.
+    """
+    control = control or get_service_control()
+    plan, status, settings, config_hash, stamp_path = _plan(control, ngrok_path, config_path, check_tunnels)
+    if plan.action != NONE:
+        apply_plan(control, plan, status, ngrok_path, config_path)
+        _write_stamp(stamp_path, config_hash)
+    wait_for_tunnels(control, settings.get("tunnels") or {}, timeout, poll_interval)
+    return plan
+
+
+_control = None
+_control_lock = threading.Lock()
+
+
+def get_service_control():
+    """Return the process-wide ServiceControl, the real ngrok service by default."""
+    global _control
+    with _control_lock:
+        if _control is None:
+            _control = NgrokServiceControl()
+        return _control
+
+
+def set_service_control(control):
+    """Replace the process-wide ServiceControl and return the previous one."""
+    global _control
+    with _control_lock:
+        previous, _control = _control, control
+        return previous
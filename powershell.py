@@ -0,0 +1,316 @@
+import atexit
+import base64
+import collections
+import io
+import os
+import re
+import subprocess
+import threading
+import time
+import uuid
+
+from events import CommandFinished, log, publish
+from process import TAIL_LINES, CommandResult, Watchdog, effective_timeout, raise_if_cancelled
+
+
+POWERSHELL_ARGV = [
+    "powershell",
+    "-NoLogo",
+    "-NoProfile",
+    "-NonInteractive",
+    "-ExecutionPolicy",
+    "Bypass",
+    "-Command",
+    "-",
+]
+
+# Every command is sent as a single line so that `-Command -` executes it as soon
+# as it is read. The command itself travels base64 encoded, which keeps quotes and
+# newlines from interfering with the framing. The output is framed by a per-call
+# token so command output can never be mistaken for a frame marker. Standard
+# output is written line by line as the command produces it, so it can be
+# streamed into the log; errors are collected and written after it. Cmdlets
+# such as Start-Service or Set-ItemProperty report failure with non-terminating
+# errors, so any error record fails the command, as it did with a separate
+# powershell process. Native programs fail through their exit code only: their
+# stderr lines arrive as NativeCommandError records.
+_WRAPPER = (
+    "& {{ $global:LASTEXITCODE = 0; $__ec = 0; $__err = ''; "
+    "$__cmd = [Text.Encoding]::UTF8.GetString([Convert]::FromBase64String('{payload}')); "
+    "[Console]::Out.WriteLine('{token} OUT'); try {{ Invoke-Expression $__cmd 2>&1 | ForEach-Object {{ "
+    "if ($_ -is [System.Management.Automation.ErrorRecord]) {{ $__err += ($_ | Out-String); "
+    "if ($_.FullyQualifiedErrorId -notlike 'NativeCommandError*') {{ $__ec = 1 }} }} else {{ $_ }} "
+    "}} | Out-String -Stream | ForEach-Object {{ [Console]::Out.WriteLine($_) }} "
+    "}} catch {{ $__err += ($_ | Out-String); $__ec = 1 }}; "
+    "if ($__ec -eq 0 -and $LASTEXITCODE) {{ $__ec = $LASTEXITCODE }}; "
+    "[Console]::Out.WriteLine(''); [Console]::Out.WriteLine('{token} ERR'); "
+    "[Console]::Out.Write($__err); [Console]::Out.WriteLine(''); "
+    "[Console]::Out.WriteLine('{token} END ' + $__ec); [Console]::Out.Flush() }}"
+)
+_WRAPPER_PATTERN = re.compile(r"FromBase64String\('([A-Za-z0-9+/=]*)'\).*'(\w+) OUT'")
+
+_STARTUP = "[Console]::OutputEncoding = [Text.Encoding]::UTF8; $ProgressPreference = 'SilentlyContinue'"
+
+
+def encode_command(token, command):
+    """Wrap a PowerShell command into a single framed line."""
+    payload = base64.b64encode(command.encode("utf-8")).decode("ascii")
+    return _WRAPPER.format(payload=payload, token=token) + "\n"
+
+
+def decode_command(line):
+    """Return the (token, command) pair carried by a framed line, or None."""
+    match = _WRAPPER_PATTERN.search(line)
+    if not match:
+        return None
+    return match.group(2), base64.b64decode(match.group(1)).decode("utf-8")
+
+
+def encode_result(token, returncode, stdout, stderr):
+    """Render a command result the way the wrapper prints it."""
+    return (
+        f"{token} OUT\n{stdout}\n"
+        f"{token} ERR\n{stderr}\n"
+        f"{token} END {returncode}\n"
+    )
+
+
+class PowerShellSession:
+    """A single long-lived PowerShell host that executes commands sent over stdin."""
+
+    def __init__(self, spawn=None):
+        self.spawn = spawn or _spawn_powershell
+        self.process = None
+
+    def start(self):
+        if self.process is None or self.process.poll() is not None:
+            start = time.perf_counter()
+            self.process = self.spawn()
+            self._send(_STARTUP + "\n")
+            publish(CommandFinished("powershell (session start)", time.perf_counter() - start, 0, True))
+
+    def run(self, command, check=True, timeout=None, stream=True):
+        """
+        Run a command and return a CommandResult, like process.run_command.
+
+        Output lines are logged as they arrive when stream is set. A timeout or
+        cancel() kills the session (and what it started) and raises
+        subprocess.TimeoutExpired or CommandCancelled; the next command starts
+        a fresh session.
+        """
+        raise_if_cancelled(command)
+        timeout = effective_timeout(timeout)
+        self.start()
+        start = time.perf_counter()
+        token = "PSFRAME" + uuid.uuid4().hex
+        self._send(encode_command(token, command))
+
+        sections = {"OUT": [], "ERR": []}
+        tail = collections.deque(maxlen=TAIL_LINES)
+        current = None
+        with Watchdog(self.process, timeout) as watchdog:
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    self.close()
+                    watchdog.raise_if_fired(command, "".join(sections["OUT"]))
+                    raise subprocess.CalledProcessError(
+                        -1, command, "".join(sections["OUT"]), "PowerShell session exited unexpectedly"
+                    )
+                if line.startswith(token + " "):
+                    marker = line[len(token) + 1:].strip()
+                    if marker.startswith("END"):
+                        returncode = int(marker.split()[1])
+                        break
+                    current = marker
+                    continue
+                if current in sections:
+                    sections[current].append(line)
+                    if current == "OUT" and line.strip():
+                        tail.append(line.rstrip("\r\n"))
+                        if stream:
+                            log(f"  {line.rstrip()}")
+
+        # The wrapper terminates each section with an extra newline
+        stdout = "".join(sections["OUT"])[:-1]
+        stderr = "".join(sections["ERR"])[:-1]
+        duration = time.perf_counter() - start
+        result = CommandResult(command, returncode, stdout, stderr, duration, tail)
+        publish(CommandFinished(command, duration, returncode, False))
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, stdout, stderr)
+        return result
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            if self.process.poll() is None:
+                self._send("exit\n")
+                self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+        self.process = None
+
+    def _send(self, text):
+        try:
+            self.process.stdin.write(text)
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as e:
+            self.process = None
+            raise subprocess.CalledProcessError(-1, text.strip(), "", f"PowerShell session unavailable: {e}")
+
+
+class PowerShellExecutor:
+    """Hands out long-lived PowerShell sessions, starting at most max_sessions of them."""
+
+    def __init__(self, spawn=None, max_sessions=1):
+        self.spawn = spawn
+        self.max_sessions = max_sessions
+        self._idle = []
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def run(self, command, check=True, timeout=None, stream=True):
+        session = self._acquire()
+        try:
+            return session.run(command, check=check, timeout=timeout, stream=stream)
+        finally:
+            self._release(session)
+
+    def close(self):
+        with self._condition:
+            sessions, self._idle = self._idle, []
+            self._count -= len(sessions)
+        for session in sessions:
+            session.close()
+
+    def _acquire(self):
+        with self._condition:
+            while not self._idle and self._count >= self.max_sessions:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._count += 1
+        return PowerShellSession(self.spawn)
+
+    def _release(self, session):
+        with self._condition:
+            self._idle.append(session)
+            self._condition.notify()
+
+
+def _spawn_powershell():
+    creationflags = getattr(subprocess, "CREATE_NO_WINDOW", 0)
+    return subprocess.Popen(
+        POWERSHELL_ARGV,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+        creationflags=creationflags,
+    )
+
+
+class FakeShell:
+    """
+    In-process stand-in for a PowerShell host, speaking the same framing protocol.
+
+    `handler(command)` returns (returncode, stdout, stderr). `startup_delay` and
+    `command_delay` simulate the cost of starting a host and running a command.
+    """
+
+    def __init__(self, handler=None, startup_delay=0.0, command_delay=0.0):
+        self.handler = handler or (lambda command: (0, "", ""))
+        self.startup_delay = startup_delay
+        self.command_delay = command_delay
+        self.spawn_count = 0
+        self.commands = []
+
+    def __call__(self):
+        self.spawn_count += 1
+        return _FakeShellProcess(self)
+
+
+class _FakeShellProcess:
+    def __init__(self, shell):
+        self.shell = shell
+        self.returncode = None
+        stdin_read, stdin_write = os.pipe()
+        stdout_read, stdout_write = os.pipe()
+        self.stdin = io.open(stdin_write, "w", encoding="utf-8")
+        self.stdout = io.open(stdout_read, "r", encoding="utf-8")
+        self._input = io.open(stdin_read, "r", encoding="utf-8")
+        self._output = io.open(stdout_write, "w", encoding="utf-8")
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        threading.Event().wait(self.shell.startup_delay)
+        for line in self._input:
+            if line.strip() == "exit":
+                break
+            frame = decode_command(line)
+            if frame is None:
+                continue
+            token, command = frame
+            self.shell.commands.append(command)
+            if self.shell.command_delay:
+                threading.Event().wait(self.shell.command_delay)
+            try:
+                returncode, stdout, stderr = self.shell.handler(command)
+            except Exception as e:
+                returncode, stdout, stderr = 1, "", str(e)
+            try:
+                self._output.write(encode_result(token, returncode, stdout, stderr))
+                self._output.flush()
+            except (OSError, ValueError):
+                # Killed while the command ran
+                return
+        if self.returncode is None:
+            self.returncode = 0
+        self._output.close()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return self.returncode
+
+    def kill(self):
+        # Closing our end of the output makes the reader see the session end, as with a real kill
+        self.returncode = -9
+        for stream in (self.stdin, self._output):
+            try:
+                stream.close()
+            except (OSError, ValueError):
+                pass
+
+
+_executor = PowerShellExecutor()
+
+
+@atexit.register
+def _close_executor():
+    _executor.close()
+
+
+def get_executor():
+    """Return the process-wide PowerShell executor."""
+    return _executor
+
+
+def set_executor(executor):
+    """Replace the process-wide PowerShell executor, closing the previous one."""
+    global _executor
+    previous, _executor = _executor, executor
+    previous.close()
+    return previous
+
+
+def run_powershell(command, check=True, timeout=None, stream=True):
+    """Run a PowerShell command in a shared long-lived session (see PowerShellSession.run)."""
+    return _executor.run(command, check=check, timeout=timeout, stream=stream)
@@ -0,0 +1,224 @@
+"""
+Child processes for the setup steps.
+
+Output is streamed into the log line by line while a command runs, every
+command can be given a timeout (and every step a total time budget through
+time_limit), and cancel() - from the GUI's Close button or a signal - kills
+whatever is running, including the children it started.
+"""
+import collections
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from events import CommandFinished, log, publish
+
+
+TAIL_LINES = 50
+WATCH_INTERVAL = 0.1
+
+
+class CommandCancelled(subprocess.SubprocessError):
+    """The command was not started, or was killed, because the installation was cancelled."""
+
+
+class CommandResult(subprocess.CompletedProcess):
+    """CompletedProcess plus the time the command took and the last lines it printed."""
+
+    def __init__(self, args, returncode, stdout=None, stderr=None, duration=0.0, tail=()):
+        super().__init__(args, returncode, stdout, stderr)
+        self.duration = duration
+        self.tail = list(tail)
+
+
+def describe(args):
+    """Printable form of a command line, with cmdkey passwords masked."""
+    text = args if isinstance(args, str) else " ".join(str(arg) for arg in args)
+    return re.sub(r"(/pass:)\S+", r"\1***", text)
+
+
+# Cancellation lasts for the rest of the process: once the user has asked to
+# stop, no further command is started either.
+_cancelled = threading.Event()
+
+
+def cancel():
+    """Kill every running command and refuse to start new ones."""
+    _cancelled.set()
+
+
+def cancelled():
+    return _cancelled.is_set()
+
+
+def raise_if_cancelled(command=""):
+    if _cancelled.is_set():
+        raise CommandCancelled(f"Installation cancelled: {describe(command)}" if command else "Installation cancelled")
+
+
+def install_signal_handlers():
+    """Turn Ctrl+C, Ctrl+Break and SIGTERM into cancel(). Must be called from the main thread."""
+    def handler(signum, frame):
+        log("Cancelling installation...")
+        cancel()
+
+    for name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), handler)
+
+
+_local = threading.local()
+
+
+@contextmanager
+def time_limit(seconds):
+    """Give the commands this thread runs inside the block at most `seconds` in total (None: no limit)."""
+    previous = getattr(_local, "deadline", None)
+    if seconds is not None:
+        deadline = time.monotonic() + seconds
+        _local.deadline = deadline if previous is None else min(previous, deadline)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def effective_timeout(timeout=None):
+    """The smaller of timeout and what is left of the current time_limit, or None for no limit."""
+    deadline = getattr(_local, "deadline", None)
+    if deadline is None:
+        return timeout
+    remaining = max(0.0, deadline - time.monotonic())
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def kill_tree(process):
+    """Kill a process and every process it started."""
+    pid = getattr(process, "pid", None)
+    if pid is not None:
+        try:
+            if os.name == "nt":
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(pid)], capture_output=True,
+                               creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0))
+            elif os.getpgid(pid) == pid:
+                # Only a process that leads its own group (start_new_session) is killed as a group
+                os.killpg(pid, signal.SIGKILL)
+        except (OSError, subprocess.SubprocessError):
+            pass
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+
+class Watchdog:
+    """
+    Kills a process tree when its timeout expires or the installation is
+    cancelled, while the caller is blocked reading the process's output.
+    `reason` says afterwards whether and why it fired.
+    """
+
+    def __init__(self, process, timeout=None):
+        self.process = process
+        self.timeout = timeout
+        self.reason = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+
+    def _watch(self):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while not self._done.wait(WATCH_INTERVAL):
+            if _cancelled.is_set():
+                self.reason = "cancelled"
+            elif deadline is not None and time.monotonic() >= deadline:
+                self.reason = "timeout"
+            else:
+                continue
+            kill_tree(self.process)
+            return
+
+    def raise_if_fired(self, command, output=None):
+        if self.reason == "cancelled":
+            raise CommandCancelled(f"Killed {describe(command)}: installation cancelled")
+        if self.reason == "timeout":
+            raise subprocess.TimeoutExpired(command, self.timeout, output)
+
+
+def stream_process(args, timeout=None, on_line=None):
+    """Run args with stdout and stderr merged, calling on_line for each line as it is printed."""
+    process = subprocess.Popen(
+        args,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+        start_new_session=os.name != "nt",
+    )
+    lines = []
+    with Watchdog(process, timeout) as watchdog:
+        for line in process.stdout:
+            lines.append(line)
+            if on_line is not None:
+                on_line(line.rstrip("\r\n"))
+        process.wait()
+    output = "".join(lines)
+    watchdog.raise_if_fired(args, output)
+    return subprocess.CompletedProcess(args, process.returncode, output, "")
+
+
+_runner = stream_process
+
+
+def set_runner(runner):
+    """
+    Replace the function that actually runs commands (stream_process by default).
+    It is called as runner(args, timeout=..., on_line=...) and returns a CompletedProcess.
+    """
+    global _runner
+    previous, _runner = _runner, runner
+    return previous
+
+
+def run_command(args, check=False, timeout=None, stream=True):
+    """
+    Run a command and return a CommandResult, publishing CommandFinished.
+
+    stdout and stderr are merged into result.stdout; with stream set each line
+    is also logged as soon as it is printed. A command running past timeout (or
+    the enclosing time_limit) raises subprocess.TimeoutExpired, a cancelled one
+    CommandCancelled; in both cases its whole process tree is killed.
+    """
+    raise_if_cancelled(args)
+    tail = collections.deque(maxlen=TAIL_LINES)
+
+    def on_line(line):
+        tail.append(line)
+        if stream and line.strip():
+            log(f"  {line}")
+
+    start = time.perf_counter()
+    returncode = -1
+    try:
+        completed = _runner(args, timeout=effective_timeout(timeout), on_line=on_line)
+        returncode = completed.returncode
+    finally:
+        publish(CommandFinished(describe(args), time.perf_counter() - start, returncode, True))
+
+    result = CommandResult(args, returncode, completed.stdout, completed.stderr, time.perf_counter() - start, tail)
+    if check:
+        result.check_returncode()
+    return result
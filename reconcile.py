@@ -0,0 +1,445 @@
+"""
+Drift detection and repair after installation.
+
+Installed hosts drift: sshd gets stopped, RDP gets switched off again, the
+hosts alias disappears, the ngrok service dies. The reconcile daemon probes
+everything the installer configures in one cheap pass and re-runs only the
+steps whose result no longer holds (plus the steps that depend on them).
+
+Between passes it sleeps, doubling the interval up to max_interval while
+nothing drifts, and wakes up early when a watched file or registry key
+changes: on Windows through change notifications, elsewhere by comparing
+file stats now and then.
+
+    python cli.py --headless --config install.yml --reconcile
+"""
+import ctypes
+import os
+import threading
+import time
+from collections import namedtuple
+
+from agent_config import CONFIG_NAME
+from authorized_keys import default_target, target_changed
+from credentials import get_credential_backend
+from events import log
+from hosts_file import HostsFile, default_hosts_path
+from ngrok_service import NONE, plan_service, reconcile_service
+from process import cancelled, time_limit
+from setup_classes import RDP_TCP_KEY, TERMINAL_SERVER_KEY, ensure_sshd_service
+from system_state import ServiceState, SystemState, get_system_state, invalidate_system_state, update_system_state
+from utils import (
+    RDP_ALIAS_IP, RDP_ALIAS_NAME, RDP_CREDENTIAL_TARGET, available_key_sources, build_agent_config,
+    create_ngrok_config, download_ngrok, setup_rdp_loopback, sync_ssh_keys,
+)
+
+
+INTERVAL = 60.0
+MAX_INTERVAL = 15 * 60.0
+BACKOFF = 2.0
+REPAIR_TIMEOUT = 10 * 60
+# How often a waiting daemon looks at stat signatures and at cancellation
+POLL_INTERVAL = 2.0
+
+
+# detect(snapshot) returns why the check fails, or None; repair(snapshot) fixes it.
+# A check is also repaired when one named in `after` was repaired in the same pass.
+Check = namedtuple("Check", ["name", "detect", "repair", "after"], defaults=((),))
+
+
+class CycleResult(namedtuple("CycleResult", ["drifted", "repaired", "failed", "seconds"])):
+    """drifted: name -> reason; repaired: names; failed: name -> exception."""
+
+    @property
+    def clean(self):
+        return not self.drifted and not self.failed
+
+
+def _hklm_path(key):
+    return key.split("\\", 1)[1] if key.upper().startswith("HKLM:") else key
+
+
+SERVICE_STATUSES = {1: "Stopped", 2: "StartPending", 3: "StopPending", 4: "Running", 5: "ContinuePending",
+                    6: "PausePending", 7: "Paused"}
+START_TYPES = {0: "Boot", 1: "System", 2: "Automatic", 3: "Manual", 4: "Disabled"}
+
+
+class _ServiceStatus(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint32) for name in (
+        "service_type", "current_state", "controls_accepted", "win32_exit_code", "service_exit_code",
+        "check_point", "wait_hint")]
+
+
+def _query_service(advapi32, manager, name):
+    """ServiceState of one service from the service manager and its registry key, or None when not installed."""
+    import winreg
+
+    handle = advapi32.OpenServiceW(manager, name, 0x0004)  # SERVICE_QUERY_STATUS
+    if not handle:
+        return None
+    try:
+        status = _ServiceStatus()
+        if not advapi32.QueryServiceStatus(handle, ctypes.byref(status)):
+            return None
+    finally:
+        advapi32.CloseServiceHandle(handle)
+    start_type, path_name = "", ""
+    try:
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, rf"SYSTEM\CurrentControlSet\Services\{name}") as key:
+            start_type = START_TYPES.get(winreg.QueryValueEx(key, "Start")[0], "")
+            path_name = str(winreg.QueryValueEx(key, "ImagePath")[0])
+    except OSError:
+        pass
+    return ServiceState(SERVICE_STATUSES.get(status.current_state, ""), start_type, path_name)
+
+
+def probe_native_state(services=("sshd", "ngrok")):
+    """
+    The part of SystemState the checks need, read straight from the service
+    manager and the registry: no PowerShell, no child process.
+    """
+    import winreg
+
+    def registry_value(key, name):
+        try:
+            with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, _hklm_path(key)) as handle:
+                return winreg.QueryValueEx(handle, name)[0]
+        except OSError:
+            return None
+
+    advapi32 = ctypes.WinDLL("advapi32", use_last_error=True)
+    advapi32.OpenSCManagerW.restype = ctypes.c_void_p
+    advapi32.OpenServiceW.restype = ctypes.c_void_p
+    advapi32.OpenServiceW.argtypes = [ctypes.c_void_p, ctypes.c_wchar_p, ctypes.c_uint32]
+    advapi32.QueryServiceStatus.argtypes = [ctypes.c_void_p, ctypes.POINTER(_ServiceStatus)]
+    advapi32.CloseServiceHandle.argtypes = [ctypes.c_void_p]
+    manager = advapi32.OpenSCManagerW(None, None, 0x0001)  # SC_MANAGER_CONNECT
+    if not manager:
+        raise ctypes.WinError(ctypes.get_last_error())
+    try:
+        states = {name: _query_service(advapi32, manager, name) for name in services}
+    finally:
+        advapi32.CloseServiceHandle(manager)
+    return SystemState(
+        services={name: state for name, state in states.items() if state is not None},
+        deny_ts_connections=registry_value(TERMINAL_SERVER_KEY, "fDenyTSConnections"),
+        user_authentication=registry_value(RDP_TCP_KEY, "UserAuthentication"),
+    )
+
+
+def probe_state():
+    """
+    A fresh SystemState for one pass, also seeded into the shared snapshot the
+    repair steps read. Natively on Windows, through the PowerShell probe elsewhere
+    (that is, on a simulated host).
+    """
+    if os.name != "nt":
+        invalidate_system_state()
+        return get_system_state()
+    state = probe_native_state()
+    # The native probe cannot see the OpenSSH capability or the firewall rules,
+    # so those come from the previous snapshot. A missing sshd service means
+    # OpenSSH itself may be gone: probe everything again through PowerShell.
+    if "sshd" not in state.services:
+        invalidate_system_state()
+    get_system_state()
+    return update_system_state(services=state.services, deny_ts_connections=state.deny_ts_connections,
+                               user_authentication=state.user_authentication)
+
+
+class _FileCheck:
+    """Runs an expensive file check again only when the file's size or modification time changed."""
+
+    def __init__(self, path, check):
+        self.path = path
+        self.check = check
+        self._passed = None
+
+    def __call__(self):
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+        if signature is not None and signature == self._passed:
+            return None
+        reason = self.check()
+        self._passed = signature if reason is None else None
+        return reason
+
+
+def build_checks(setup, auth_token, ip_address, install_path, ssh_keys_path, tunnels=()):
+    """The checks for everything start_installation configures (setup: the Windows setup class), in repair order."""
+    ngrok_path = os.path.join(install_path, "ngrok.exe")
+    config_path = os.path.join(install_path, CONFIG_NAME)
+    rendered = build_agent_config(auth_token, ip_address, tunnels).render()
+
+    def config_drift():
+        try:
+            with open(config_path, "rb") as f:
+                return None if f.read() == rendered else "agent.yml was changed"
+        except OSError:
+            return "agent.yml is missing"
+
+    def hosts_drift():
+        hosts = HostsFile.read(default_hosts_path())
+        return None if hosts.has(RDP_ALIAS_IP, RDP_ALIAS_NAME) else f"the {RDP_ALIAS_NAME} alias is gone"
+
+    config_check = _FileCheck(config_path, config_drift)
+    hosts_check = _FileCheck(default_hosts_path(), hosts_drift)
+    keys_target = default_target()
+    keys_check = _FileCheck(keys_target, lambda: "the key file was changed" if target_changed(keys_target) else None)
+
+    def detect_sshd(state):
+        if state.sshd is None:
+            return "sshd is not installed"
+        if not state.sshd_ready:
+            return f"sshd is {state.sshd.status or 'unknown'} and starts {state.sshd.start_type or 'unknown'}"
+        return None
+
+    def repair_sshd(state):
+        if state.sshd is None:
+            setup.install_openssh(ssh_keys_path)
+        else:
+            ensure_sshd_service()
+
+    def detect_rdp(state):
+        if state.rdp_enabled:
+            return None
+        return (f"fDenyTSConnections is {state.deny_ts_connections}, "
+                f"UserAuthentication is {state.user_authentication}")
+
+    def detect_loopback(state):
+        reason = hosts_check()
+        if reason is None and get_credential_backend().read(RDP_CREDENTIAL_TARGET) is None:
+            reason = f"the {RDP_CREDENTIAL_TARGET} credential is gone"
+        return reason
+
+    def detect_service(state):
+        if not os.path.exists(ngrok_path) or config_check():
+            return None  # repaired through ngrok_binary / ngrok_config first
+        plan = plan_service(ngrok_path, config_path, check_tunnels=True)
+        return None if plan.action == NONE else plan.reason
+
+    checks = [
+        Check("install_openssh", detect_sshd, repair_sshd),
+        Check("enable_rdp", detect_rdp, lambda state: setup.enable_rdp()),
+        Check("setup_rdp_loopback", detect_loopback, lambda state: setup_rdp_loopback()),
+        Check("download_ngrok", lambda state: None if os.path.exists(ngrok_path) else "ngrok.exe is missing",
+              lambda state: download_ngrok(install_path)),
+        Check("create_ngrok_config", lambda state: config_check(),
+              lambda state: create_ngrok_config(auth_token, ip_address, install_path, tunnels)),
+        Check("setup_ngrok_service", detect_service,
+              lambda state: reconcile_service(ngrok_path, config_path, check_tunnels=True),
+              after=("download_ngrok", "create_ngrok_config")),
+    ]
+    if available_key_sources(ssh_keys_path):
+        checks.append(Check("sync_ssh_keys", lambda state: keys_check(), lambda state: sync_ssh_keys(ssh_keys_path)))
+    return checks
+
+
+class PollingWatcher:
+    """Notices changes to files by comparing their size and modification time every poll_interval."""
+
+    def __init__(self, paths, poll_interval=POLL_INTERVAL):
+        self.paths = list(paths)
+        self.poll_interval = poll_interval
+        self._signature = self._read()
+
+    def _read(self):
+        signature = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    def wait(self, timeout, stop):
+        """Wait up to timeout seconds; True when a file changed, False on timeout, stop or cancellation."""
+        deadline = time.monotonic() + timeout
+        while not stop.is_set() and not cancelled():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            stop.wait(min(self.poll_interval, remaining))
+            signature = self._read()
+            if signature != self._signature:
+                self._signature = signature
+                return True
+        return False
+
+    def close(self):
+        pass
+
+
+class Win32ChangeWatcher:
+    """
+    Waits on directory change notifications and registry change events, so a
+    host with nothing changing costs no work at all between passes (the
+    handles are only polled every POLL_INTERVAL for stop and cancellation).
+    Services have no such notification; the interval covers them.
+    """
+
+    FILE_NOTIFY = 0x1 | 0x10  # FILE_NOTIFY_CHANGE_FILE_NAME | FILE_NOTIFY_CHANGE_LAST_WRITE
+    REG_NOTIFY = 0x4  # REG_NOTIFY_CHANGE_LAST_SET
+    WAIT_TIMEOUT = 0x102
+    INVALID_HANDLE = ctypes.c_void_p(-1).value
+
+    def __init__(self, directories, registry_keys, poll_interval=POLL_INTERVAL):
+        import winreg
+
+        self.poll_interval = poll_interval
+        self._kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        self._advapi32 = ctypes.WinDLL("advapi32", use_last_error=True)
+        self._kernel32.FindFirstChangeNotificationW.restype = ctypes.c_void_p
+        self._kernel32.FindFirstChangeNotificationW.argtypes = [ctypes.c_wchar_p, ctypes.c_int, ctypes.c_uint32]
+        self._kernel32.FindNextChangeNotification.argtypes = [ctypes.c_void_p]
+        self._kernel32.FindCloseChangeNotification.argtypes = [ctypes.c_void_p]
+        self._kernel32.CreateEventW.restype = ctypes.c_void_p
+        self._kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+        self._kernel32.WaitForMultipleObjects.argtypes = [ctypes.c_uint32, ctypes.POINTER(ctypes.c_void_p),
+                                                          ctypes.c_int, ctypes.c_uint32]
+        self._advapi32.RegNotifyChangeKeyValue.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_uint32,
+                                                           ctypes.c_void_p, ctypes.c_int]
+        self._watches = []  # (kind, handle, registry key)
+        for directory in directories:
+            handle = self._kernel32.FindFirstChangeNotificationW(directory, False, self.FILE_NOTIFY)
+            if handle and handle != self.INVALID_HANDLE:
+                self._watches.append(("dir", handle, None))
+        for path in registry_keys:
+            try:
+                key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, _hklm_path(path), 0, winreg.KEY_NOTIFY)
+            except OSError:
+                continue
+            event = self._kernel32.CreateEventW(None, False, False, None)
+            self._watches.append(("reg", event, key))
+            self._arm(event, key)
+
+    def _arm(self, event, key):
+        self._advapi32.RegNotifyChangeKeyValue(key.handle, True, self.REG_NOTIFY, event, True)
+
+    def wait(self, timeout, stop):
+        if not self._watches:
+            stop.wait(timeout)
+            return False
+        handles = (ctypes.c_void_p * len(self._watches))(*[handle for _, handle, _ in self._watches])
+        deadline = time.monotonic() + timeout
+        while not stop.is_set() and not cancelled():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            slice_ms = int(min(self.poll_interval, remaining) * 1000)
+            index = self._kernel32.WaitForMultipleObjects(len(handles), handles, False, slice_ms)
+            if index == self.WAIT_TIMEOUT:
+                continue
+            if not 0 <= index < len(self._watches):
+                raise ctypes.WinError(ctypes.get_last_error())
+            kind, handle, key = self._watches[index]
+            if kind == "dir":
+                self._kernel32.FindNextChangeNotification(handle)
+            else:
+                self._arm(handle, key)
+            return True
+        return False
+
+    def close(self):
+        for kind, handle, key in self._watches:
+            if kind == "dir":
+                self._kernel32.FindCloseChangeNotification(handle)
+            else:
+                self._kernel32.CloseHandle(handle)
+                key.Close()
+        self._watches = []
+
+
+def default_watcher(install_path):
+    """Change notifications for the install directory, the hosts file, the key file and the RDP settings."""
+    directories = [install_path, os.path.dirname(default_hosts_path()), os.path.dirname(default_target())]
+    if os.name == "nt":
+        return Win32ChangeWatcher([d for d in directories if os.path.isdir(d)], [TERMINAL_SERVER_KEY, RDP_TCP_KEY])
+    return PollingWatcher([os.path.join(install_path, name) for name in ("agent.yml", "ngrok.exe")]
+                          + [default_hosts_path(), default_target()])
+
+
+class ReconcileDaemon:
+    """
+    Runs passes of checks, repairing what drifted. The wait between passes
+    starts at interval, doubles after every pass that found nothing (up to
+    max_interval) and goes back to interval after drift or a change notification.
+    """
+
+    def __init__(self, checks, watcher=None, probe=probe_state, interval=INTERVAL, max_interval=MAX_INTERVAL):
+        self.checks = list(checks)
+        self.watcher = watcher
+        self.probe = probe
+        self.interval = interval
+        self.max_interval = max_interval
+        self.passes = 0
+
+    def run_once(self):
+        """Probe, compare with the desired state, repair what drifted and return a CycleResult."""
+        start = time.perf_counter()
+        self.passes += 1
+        state = self.probe()
+        drifted = {}
+        for check in self.checks:
+            try:
+                reason = check.detect(state)
+            except Exception as e:
+                reason = f"could not be checked: {e}"
+            if reason:
+                drifted[check.name] = reason
+
+        repaired, failed = [], {}
+        for check in self.checks:
+            if cancelled():
+                break
+            reason = drifted.get(check.name)
+            if reason is None:
+                dependencies = [name for name in check.after if name in repaired]
+                if not dependencies:
+                    continue
+                reason = f"{', '.join(dependencies)} was repaired"
+            log(f"Drift in {check.name}: {reason}. Repairing...")
+            try:
+                with time_limit(REPAIR_TIMEOUT):
+                    check.repair(state)
+                repaired.append(check.name)
+            except Exception as e:
+                log(f"Could not repair {check.name}: {e}")
+                failed[check.name] = e
+        if repaired or failed:
+            # The repairs changed the host; the next pass must not trust this snapshot
+            invalidate_system_state()
+        return CycleResult(drifted, repaired, failed, time.perf_counter() - start)
+
+    def run(self, stop=None, max_passes=None):
+        """Reconcile until stop is set, the installation is cancelled or max_passes passes ran."""
+        stop = stop or threading.Event()
+        watcher = self.watcher or PollingWatcher([])
+        interval = self.interval
+        while not stop.is_set() and not cancelled():
+            result = self.run_once()
+            if result.repaired or result.failed:
+                log(f"Reconcile pass repaired {', '.join(result.repaired) or 'nothing'}"
+                    + (f", failed: {', '.join(result.failed)}" if result.failed else "")
+                    + f" in {result.seconds:.1f}s")
+            interval = self.interval if not result.clean else min(interval * BACKOFF, self.max_interval)
+            if max_passes is not None and self.passes >= max_passes:
+                break
+            if watcher.wait(interval, stop):
+                interval = self.interval
+
+
+def run_reconcile(setup, settings, interval=INTERVAL, max_interval=MAX_INTERVAL, stop=None):
+    """Keep the host in the state the installer configured for settings (the cli settings mapping)."""
+    checks = build_checks(setup, settings["auth_token"], settings["address"],
+                          settings["install_path"], settings["ssh_keys_path"], settings.get("tunnels", ()))
+    watcher = default_watcher(settings["install_path"])
+    log(f"Watching for drift every {interval:g}s (up to {max_interval:g}s while nothing changes).")
+    try:
+        ReconcileDaemon(checks, watcher, interval=interval, max_interval=max_interval).run(stop)
+    finally:
+        watcher.close()
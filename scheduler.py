@@ -0,0 +1,253 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from events import StepSkipped, publish
+from journal import input_hash
+from process import raise_if_cancelled, time_limit
+
+
+# How often the waiting thread wakes up, so that signal handlers (which only run
+# on the main thread, between waits) can cancel a long step promptly
+WAIT_INTERVAL = 0.5
+
+
+class Step:
+    """
+    A unit of work in an install graph.
+
+    `func` is called with one keyword argument per name in `inputs` and must
+    return a dict containing every name in `outputs` (a step with a single
+    output may return the bare value). A step depends on the steps producing its
+    inputs, plus any step named in `after`. `key` is extra JSON-serialisable
+    data, such as an artifact version, that decides together with the inputs
+    whether a journaled step has to run again. `timeout` caps the total time the
+    commands run by the step may take, in seconds. A step with journal=False runs
+    on every run; for steps that are cheap and find out for themselves what
+    changed, such as syncing keys from a URL.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), after=(), key=None, timeout=None, journal=True):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.after = tuple(after)
+        self.key = key
+        self.timeout = timeout
+        self.journal = journal
+
+    def __repr__(self):
+        return f"Step({self.name!r})"
+
+
+class ScheduleFailed(Exception):
+    """Raised by ScheduleResult.raise_for_failure when any step failed."""
+
+    def __init__(self, result):
+        self.result = result
+        error = result.errors[result.failed[0]]
+        names = ", ".join(result.failed)
+        super().__init__(f"Step(s) failed: {names}: {type(error).__name__}: {error}")
+
+
+class ScheduleResult:
+    def __init__(self, steps, dependencies):
+        self.steps = steps
+        self.dependencies = dependencies
+        self.values = {}
+        self.started = {}
+        self.finished = {}
+        self.errors = {}
+        self.failed = []
+        self.cancelled = []
+        self.skipped = []
+        self.wall_time = 0.0
+
+    @property
+    def ok(self):
+        return not self.failed and not self.cancelled
+
+    def duration(self, name):
+        if name not in self.finished:
+            return 0.0
+        return self.finished[name] - self.started[name]
+
+    def critical_path(self):
+        """Return (step names, seconds) of the longest dependency chain that ran."""
+        best = {}
+        for name in self.steps:
+            if name not in self.finished:
+                continue
+            previous = max(
+                (best[dep] for dep in self.dependencies[name] if dep in best),
+                key=lambda item: item[1],
+                default=([], 0.0),
+            )
+            best[name] = (previous[0] + [name], previous[1] + self.duration(name))
+        return max(best.values(), key=lambda item: item[1], default=([], 0.0))
+
+    def summary(self):
+        lines = [f"Install steps finished in {self.wall_time:.1f}s"]
+        for name in self.steps:
+            if name in self.finished:
+                status = "failed" if name in self.errors else "done"
+                lines.append(f"  {name}: {status} in {self.duration(name):.1f}s")
+            elif name in self.skipped:
+                lines.append(f"  {name}: skipped, unchanged since the last run")
+            elif name in self.cancelled:
+                lines.append(f"  {name}: cancelled")
+        path, seconds = self.critical_path()
+        lines.append(f"Critical path ({seconds:.1f}s): {' -> '.join(path)}")
+        return "\n".join(lines)
+
+    def raise_for_failure(self):
+        if self.failed:
+            raise ScheduleFailed(self)
+
+
+class StepScheduler:
+    """Runs a graph of Steps on a thread pool, each as soon as its dependencies finish."""
+
+    def __init__(self, steps, max_workers=4):
+        self.steps = {step.name: step for step in steps}
+        if len(self.steps) != len(steps):
+            raise ValueError("Step names must be unique")
+        self.max_workers = max_workers
+
+    def dependencies(self, initial_names=()):
+        producers = {}
+        for step in self.steps.values():
+            for output in step.outputs:
+                if output in producers:
+                    raise ValueError(f"Output '{output}' is produced by both '{producers[output]}' and '{step.name}'")
+                producers[output] = step.name
+
+        dependencies = {}
+        for step in self.steps.values():
+            deps = set()
+            for name in step.inputs:
+                if name in producers:
+                    deps.add(producers[name])
+                elif name not in initial_names:
+                    raise ValueError(f"Step '{step.name}' needs '{name}', which nothing provides")
+            for name in step.after:
+                if name not in self.steps:
+                    raise ValueError(f"Step '{step.name}' runs after unknown step '{name}'")
+                deps.add(name)
+            dependencies[step.name] = deps
+        return dependencies
+
+    def order(self, dependencies):
+        """Return step names in a dependency-respecting order, rejecting cycles."""
+        ordered, done = [], set()
+        pending = list(self.steps)
+        while pending:
+            ready = [name for name in pending if dependencies[name] <= done]
+            if not ready:
+                raise ValueError(f"Dependency cycle between steps: {', '.join(pending)}")
+            for name in ready:
+                ordered.append(name)
+                done.add(name)
+                pending.remove(name)
+        return ordered
+
+    def run(self, initial=None, journal=None):
+        """
+        Run every step and return a ScheduleResult.
+
+        With an InstallJournal, a step whose inputs and key hash the same as
+        when it last completed is skipped and its recorded outputs are reused,
+        unless one of its dependencies actually ran in this run.
+        """
+        values = dict(initial or {})
+        dependencies = self.dependencies(values)
+        result = ScheduleResult(self.order(dependencies), dependencies)
+        result.values = values
+        lock = threading.Lock()
+
+        dependents = {name: set() for name in self.steps}
+        for name, deps in dependencies.items():
+            for dep in deps:
+                dependents[dep].add(name)
+
+        def execute(step, kwargs):
+            with lock:
+                result.started[step.name] = time.perf_counter()
+            try:
+                raise_if_cancelled()
+                with time_limit(step.timeout):
+                    returned = step.func(**kwargs)
+            finally:
+                with lock:
+                    result.finished[step.name] = time.perf_counter()
+            if len(step.outputs) == 1 and not isinstance(returned, dict):
+                returned = {step.outputs[0]: returned}
+            missing = [name for name in step.outputs if name not in (returned or {})]
+            if missing:
+                raise ValueError(f"Step '{step.name}' did not provide {', '.join(missing)}")
+            return returned or {}
+
+        def cancel(name):
+            for dependent in dependents[name]:
+                if dependent in waiting:
+                    waiting.discard(dependent)
+                    result.cancelled.append(dependent)
+                    cancel(dependent)
+
+        def skip(step, digest):
+            """Complete a step from the journal, returning False when it has to run."""
+            if journal is None or not step.journal or dependencies[step.name] & executed:
+                return False
+            outputs = journal.lookup(step.name, digest)
+            if outputs is None or any(name not in outputs for name in step.outputs):
+                return False
+            values.update({name: outputs[name] for name in step.outputs})
+            completed.add(step.name)
+            result.skipped.append(step.name)
+            publish(StepSkipped(step.name))
+            return True
+
+        def launch():
+            ready = [n for n in result.steps if n in waiting and dependencies[n] <= completed]
+            while ready:
+                for name in ready:
+                    waiting.discard(name)
+                    step = self.steps[name]
+                    kwargs = {input_name: values[input_name] for input_name in step.inputs}
+                    digests[name] = input_hash(kwargs, step.key)
+                    if not skip(step, digests[name]):
+                        running[pool.submit(execute, step, kwargs)] = name
+                # Skipped steps may have made more steps ready
+                ready = [n for n in result.steps if n in waiting and dependencies[n] <= completed]
+
+        start = time.perf_counter()
+        waiting = set(self.steps)
+        completed = set()
+        executed = set()
+        digests = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while waiting or running:
+                launch()
+                if not running:
+                    break
+                done, _ = wait(running, timeout=WAIT_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    executed.add(name)
+                    error = future.exception()
+                    if error is None:
+                        outputs = future.result()
+                        values.update(outputs)
+                        completed.add(name)
+                        if journal is not None and self.steps[name].journal:
+                            journal.record(name, digests[name], {key: outputs[key] for key in self.steps[name].outputs})
+                    else:
+                        result.errors[name] = error
+                        result.failed.append(name)
+                        if journal is not None:
+                            journal.forget(name)
+                        cancel(name)
+        result.wall_time = time.perf_counter() - start
+        return result
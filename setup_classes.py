@@ -1,235 +1,162 @@
 import subprocess
 import sys
 import os
+from archive import extract_members
+from artifacts import OPENSSH, open_artifact
+from events import log, step
+from powershell import run_powershell
+from system_state import get_system_state, update_system_state, update_service_state
+
+
+TERMINAL_SERVER_KEY = "HKLM:\\System\\CurrentControlSet\\Control\\Terminal Server"
+RDP_TCP_KEY = TERMINAL_SERVER_KEY + "\\WinStations\\RDP-Tcp"
+# Add-WindowsCapability downloads from Windows Update and can take a long time
+CAPABILITY_TIMEOUT = 30 * 60
+
+
+def ensure_sshd_service():
+    """Start sshd and make it start automatically, skipping whatever is already done."""
+    sshd = get_system_state().sshd
+    if sshd is not None and sshd.running and sshd.automatic:
+        log("sshd service is already running and set to start automatically.")
+        return
+
+    if sshd is None or not sshd.running:
+        run_powershell("Start-Service sshd")
+        update_service_state("sshd", status="Running")
+    if sshd is None or not sshd.automatic:
+        run_powershell("Set-Service -Name sshd -StartupType Automatic")
+        update_service_state("sshd", start_type="Automatic")
+
+
+def apply_rdp_settings(os_name):
+    """Write only the RDP registry values that differ from the desired state."""
+    state = get_system_state()
+    if state.rdp_enabled:
+        log(f"RDP is already enabled on {os_name}.")
+        return
+
+    log(f"Enabling RDP for {os_name}...")
+    if state.deny_ts_connections != 0:
+        run_powershell(f"Set-ItemProperty -Path '{TERMINAL_SERVER_KEY}' -Name 'fDenyTSConnections' -Value 0")
+        update_system_state(deny_ts_connections=0)
+    if state.user_authentication != 1:
+        run_powershell(f"Set-ItemProperty -Path '{RDP_TCP_KEY}' -Name 'UserAuthentication' -Value 1")
+        update_system_state(user_authentication=1)
+
+    log(f"RDP enabled successfully on {os_name}")
+
+
+def install_openssh_capability(os_name):
+    """Install the OpenSSH.Server capability unless the snapshot shows it is present."""
+    if get_system_state().openssh_installed:
+        log(f"OpenSSH is already installed on {os_name}.")
+    else:
+        log(f"Installing OpenSSH on {os_name}...")
+        run_powershell("Add-WindowsCapability -Online -Name OpenSSH.Server~~~~0.0.1.0", timeout=CAPABILITY_TIMEOUT)
+        update_system_state(openssh_capability="Installed")
+
+    ensure_sshd_service()
 
 
 class Windows11Setup:
+    @step("install_openssh")
     def install_openssh(self, ssh_keys_path):
         try:
-            # Check if OpenSSH is already installed
-            check_command = [
-                "powershell",
-                "-Command",
-                "Get-WindowsCapability -Online | Where-Object { $_.Name -like '*OpenSSH*' }",
-            ]
-
-            process = subprocess.run(
-                check_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-            )
-
-            if "Installed" in process.stdout:
-                print("OpenSSH is already installed on Windows 11.")
-                return
-
-            # Install OpenSSH
-            print("Installing OpenSSH on Windows 11...")
-            install_commands = [
-                "powershell",
-                "-Command",
-                "Add-WindowsCapability -Online -Name OpenSSH.Server~~~~0.0.1.0",
-            ]
-            subprocess.run(install_commands, check=True)
-
-            # Configure and start service
-            service_commands = [
-                "powershell",
-                "-Command",
-                "Start-Service sshd; Set-Service -Name sshd -StartupType Automatic",
-            ]
-            subprocess.run(service_commands, check=True)
-
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to install OpenSSH on Windows 11: {e}")
+            install_openssh_capability("Windows 11")
+
+        except subprocess.SubprocessError as e:
+            log(f"Failed to install OpenSSH on Windows 11: {e}")
             raise
 
     @staticmethod
+    @step("enable_rdp")
     def enable_rdp():
         try:
-            print("Enabling RDP for Windows 11...")
-            commands = [
-                [
-                    "powershell",
-                    "-Command",
-                    "Set-ItemProperty -Path 'HKLM:\\System\\CurrentControlSet\\Control\\Terminal Server' -Name 'fDenyTSConnections' -Value 0",
-                ],
-                [
-                    "powershell",
-                    "-Command",
-                    "Set-ItemProperty -Path 'HKLM:\\System\\CurrentControlSet\\Control\\Terminal Server\\WinStations\\RDP-Tcp' -Name 'UserAuthentication' -Value 1",
-                ],
-            ]
-
-            for cmd in commands:
-                subprocess.run(cmd, check=True)
-
-            print("RDP enabled successfully on Windows 11")
-
-        except subprocess.CalledProcessError as e:
-            print(f"Error enabling RDP on Windows 11: {e}")
+            apply_rdp_settings("Windows 11")
+
+        except subprocess.SubprocessError as e:
+            log(f"Error enabling RDP on Windows 11: {e}")
             raise
 
 
 class Windows10Setup:
+    @step("install_openssh")
     def install_openssh(self, ssh_keys_path):
         try:
-            # Check if OpenSSH is already installed
-            check_command = [
-                "powershell",
-                "-Command",
-                "Get-WindowsCapability -Online | Where-Object { $_.Name -like '*OpenSSH*' }",
-            ]
-
-            process = subprocess.run(
-                check_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-            )
-
-            if "Installed" in process.stdout:
-                print("OpenSSH is already installed on Windows 10.")
-                return
-
-            # Install OpenSSH
-            print("Installing OpenSSH on Windows 10...")
-            install_command = [
-                "powershell",
-                "-Command",
-                "Add-WindowsCapability -Online -Name OpenSSH.Server~~~~0.0.1.0",
-            ]
-            subprocess.run(install_command, check=True)
-
-            # Start and configure service
-            subprocess.run(
-                [
-                    "powershell",
-                    "-Command",
-                    "Start-Service sshd; Set-Service -Name sshd -StartupType Automatic",
-                ],
-                check=True,
-            )
-
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to install OpenSSH on Windows 10: {e}")
+            install_openssh_capability("Windows 10")
+
+        except subprocess.SubprocessError as e:
+            log(f"Failed to install OpenSSH on Windows 10: {e}")
             raise
 
     @staticmethod
+    @step("enable_rdp")
     def enable_rdp():
         try:
-            print("Enabling RDP for Windows 10...")
-            commands = [
-                [
-                    "powershell",
-                    "-Command",
-                    "Set-ItemProperty -Path 'HKLM:\\System\\CurrentControlSet\\Control\\Terminal Server' -Name 'fDenyTSConnections' -Value 0",
-                ],
-                [
-                    "powershell",
-                    "-Command",
-                    "Set-ItemProperty -Path 'HKLM:\\System\\CurrentControlSet\\Control\\Terminal Server\\WinStations\\RDP-Tcp' -Name 'UserAuthentication' -Value 1",
-                ],
-            ]
-
-            for cmd in commands:
-                subprocess.run(cmd, check=True)
-
-            print("RDP enabled successfully on Windows 10")
-
-        except subprocess.CalledProcessError as e:
-            print(f"Error enabling RDP on Windows 10: {e}")
+            apply_rdp_settings("Windows 10")
+
+        except subprocess.SubprocessError as e:
+            log(f"Error enabling RDP on Windows 10: {e}")
             raise
 
 
 class WindowsServer2016Setup:
+    @property
+    def openssh_path(self):
+        return os.path.join(os.environ.get("ProgramFiles", r"C:\Program Files"), "OpenSSH")
+
+    @step("install_openssh")
     def install_openssh(self, ssh_keys_path):
         try:
-            try:
-                subprocess.run(["powershell", f"mkdir {self.openssh_path}"], check=True)
-            except Exception as e:
-                print(e)
-
-            # Run both the TLS setup and the download in the same PowerShell command
-            subprocess.run(
-                [
-                    "powershell",
-                    "[Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12; "  # Set TLS protocol
-                    f"Invoke-WebRequest -Uri 'https://github.com/PowerShell/Win32-OpenSSH/releases/download/V8.6.0.0p1-Beta/OpenSSH-Win64.zip' -OutFile '{self.openssh_path}\\openssh.zip'",
-                ],
-                check=True,
-            )
-
-            # Extract the downloaded OpenSSH zip
-            subprocess.run(
-                [
-                    "powershell",
-                    f"Expand-Archive -Path '{self.openssh_path}\\openssh.zip' -DestinationPath '{self.openssh_path}\\openssh'",
-                ],
-                check=True,
-            )
-
-            # Add OpenSSH to the system PATH
-            subprocess.run(
-                [
-                    "powershell",
-                    f"setx PATH '$env:path;{self.openssh_path}\\openssh\\' -m",
-                ],
-                check=True,
-            )
-
-            # Install OpenSSH
-            subprocess.run(
-                [
-                    "powershell",
-                    f"powershell.exe -ExecutionPolicy Bypass -File '{self.openssh_path}\\openssh\\OpenSSH-Win64\\install-sshd.ps1'",
-                ],
-                check=True,
-            )
+            # The sshd service only exists once install-sshd.ps1 has run
+            if get_system_state().sshd is not None:
+                log("OpenSSH is already installed on Windows Server 2016.")
+            else:
+                self.download_and_register_openssh()
 
             # Allow inbound SSH traffic through the firewall
-            try:
-                subprocess.run(
-                    [
-                        "powershell",
-                        "New-NetFirewallRule -Name sshd -DisplayName 'OpenSSH Server (sshd)' -Enabled True -Direction Inbound -Protocol TCP -Action Allow -LocalPort 22",
-                    ],
-                    check=True,
-                )
-            except Exception as e:
-                print(e)
-
-            # Start SSH service
-            subprocess.run(["powershell", "net start sshd"], check=True)
-
-            # Set SSH service to start automatically on system restart
-            subprocess.run(
-                ["powershell", "Set-Service sshd -StartupType Automatic"], check=True
-            )
-
-            print("OpenSSH installed and configured successfully on Windows Server 2016.")
-
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to install OpenSSH on Windows Server 2016: {e}")
+            if not get_system_state().has_firewall_rule("sshd"):
+                try:
+                    run_powershell(
+                        "New-NetFirewallRule -Name sshd -DisplayName 'OpenSSH Server (sshd)' -Enabled True -Direction Inbound -Protocol TCP -Action Allow -LocalPort 22"
+                    )
+                    rules = dict(get_system_state().firewall_rules, sshd=True)
+                    update_system_state(firewall_rules=rules)
+                except Exception as e:
+                    log(e)
+
+            # Start SSH service and set it to start automatically on system restart
+            ensure_sshd_service()
+
+            log("OpenSSH installed and configured successfully on Windows Server 2016.")
+
+        except subprocess.SubprocessError as e:
+            log(f"Failed to install OpenSSH on Windows Server 2016: {e}")
             raise
 
+    def download_and_register_openssh(self):
+        # Take OpenSSH from the installer bundle, or download it through the shared
+        # HTTP client unless an earlier run already put the archive in the artifact cache.
+        # The binaries are extracted straight from the bundle or cached archive.
+        openssh_dir = os.path.join(self.openssh_path, "openssh")
+        with open_artifact(OPENSSH) as openssh_zip:
+            extract_members(openssh_zip, openssh_dir, lambda name: name.startswith("OpenSSH-Win64/"))
+
+        # Add OpenSSH to the system PATH
+        run_powershell(f"setx PATH \"$env:path;{openssh_dir}\" -m")
+
+        # Install OpenSSH (the shared session already runs with -ExecutionPolicy Bypass)
+        install_script = os.path.join(openssh_dir, "OpenSSH-Win64", "install-sshd.ps1")
+        run_powershell(f"& '{install_script}'")
+        update_service_state("sshd", status="Stopped")
+
     @staticmethod
+    @step("enable_rdp")
     def enable_rdp():
         try:
-            print("Enabling RDP for Windows Server 2016...")
-            commands = [
-                [
-                    "powershell",
-                    "-Command",
-                    "Set-ItemProperty -Path 'HKLM:\\System\\CurrentControlSet\\Control\\Terminal Server' -Name 'fDenyTSConnections' -Value 0",
-                ],
-                [
-                    "powershell",
-                    "-Command",
-                    "Set-ItemProperty -Path 'HKLM:\\System\\CurrentControlSet\\Control\\Terminal Server\\WinStations\\RDP-Tcp' -Name 'UserAuthentication' -Value 1",
-                ],
-            ]
-
-            for cmd in commands:
-                subprocess.run(cmd, check=True)
-
-            print("RDP enabled successfully on Windows Server 2016")
-
-        except subprocess.CalledProcessError as e:
-            print(f"Error enabling RDP on Windows Server 2016: {e}")
+            apply_rdp_settings("Windows Server 2016")
+
+        except subprocess.SubprocessError as e:
+            log(f"Error enabling RDP on Windows Server 2016: {e}")
             raise
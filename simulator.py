@@ -0,0 +1,487 @@
+"""
+A simulated Windows host for running the installer end to end on any machine.
+
+SimulatedHost keeps the state the installer touches in memory (capabilities,
+services, registry values, firewall rules, stored credentials) plus a real
+hosts file in a temporary SystemRoot, with ProgramFiles and ProgramData next
+to it. It answers the commands the setup steps send to PowerShell, cmdkey and
+ngrok, sleeping for latencies modelled on a real host so that timings keep
+their shape.
+
+    with LocalHTTPServer(files) as server, simulate(SimulatedHost("Windows11", root)):
+        run_installation("Windows11", ...)
+"""
+import contextlib
+import json
+import os
+import re
+import shlex
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from agent_config import read_settings
+from credentials import Credential, MemoryCredentialBackend
+from ngrok_service import parse_command_line, service_command_line
+from setup_classes import RDP_TCP_KEY, TERMINAL_SERVER_KEY
+
+
+# Typical seconds on a real host, measured on Windows 10/11 VMs
+LATENCIES = {
+    "powershell_startup": 0.8,
+    "probe": 1.5,
+    "add_capability": 45.0,
+    "service": 1.0,
+    "registry": 0.1,
+    "firewall": 0.6,
+    "install_sshd": 3.0,
+    "setx": 0.2,
+    "mkdir": 0.05,
+    "process_spawn": 0.05,
+    "cmdkey": 0.1,
+    "ngrok_service": 1.5,
+    "command": 0.02,
+}
+
+PROFILES = {
+    "Windows11": {"caption": "Microsoft Windows 11 Pro", "capabilities": True},
+    "Windows10": {"caption": "Microsoft Windows 10 Pro", "capabilities": True},
+    # Get-WindowsCapability does not exist on Server 2016; OpenSSH comes from a zip
+    "WindowsServer2016": {"caption": "Microsoft Windows Server 2016 Standard", "capabilities": False},
+}
+
+OPENSSH_CAPABILITY = "OpenSSH.Server~~~~0.0.1.0"
+
+
+class SimulatedHost:
+    """In-memory Windows host answering PowerShell, cmdkey and ngrok commands."""
+
+    def __init__(self, windows_version, root, latency_scale=1.0, latencies=None):
+        profile = PROFILES[windows_version]
+        self.windows_version = windows_version
+        self.caption = profile["caption"]
+        self.root = root
+        self.program_files = os.path.join(os.path.dirname(os.path.abspath(root)), "Program Files")
+        self.program_data = os.path.join(os.path.dirname(os.path.abspath(root)), "ProgramData")
+        self.latency_scale = latency_scale
+        self.latencies = dict(LATENCIES, **(latencies or {}))
+
+        self.capabilities = {OPENSSH_CAPABILITY: "NotPresent"} if profile["capabilities"] else None
+        self.services = {}
+        self.registry = {
+            (TERMINAL_SERVER_KEY, "fDenyTSConnections"): 1,
+            (RDP_TCP_KEY, "UserAuthentication"): 0,
+        }
+        self.registry_keys = {TERMINAL_SERVER_KEY, RDP_TCP_KEY}
+        self.firewall_rules = {}
+        self.cmdlet_errors = {}  # cmdlet name -> the non-terminating error it reports
+        self.credentials = {}
+        self.credential_backend = MemoryCredentialBackend(self.credentials)
+        self.machine_path = r"C:\Windows\system32;C:\Windows"
+        self.commands = []
+        self.processes = 0
+        self.live_tunnels = None  # tunnel names the running ngrok service brought up
+        self._lock = threading.RLock()
+
+        # setup_rdp_loopback builds the path the same way
+        self.hosts_path = os.path.join(root, r"System32\drivers\etc\hosts")
+        os.makedirs(os.path.dirname(self.hosts_path), exist_ok=True)
+        if not os.path.exists(self.hosts_path):
+            with open(self.hosts_path, "w") as f:
+                f.write("# Copyright (c) 1993-2009 Microsoft Corp.\n127.0.0.1 localhost\n")
+
+    def delay(self, name):
+        return self.latencies[name] * self.latency_scale
+
+    def _sleep(self, name):
+        seconds = self.delay(name)
+        if seconds:
+            time.sleep(seconds)
+
+    def probe(self):
+        """The JSON document PROBE_SCRIPT would print on this host."""
+        with self._lock:
+            if self.capabilities is None:
+                capability = ""
+            else:
+                capability = self.capabilities.get(OPENSSH_CAPABILITY, "NotPresent")
+            return {
+                "os_caption": self.caption,
+                "openssh_capability": capability,
+                "services": {name: dict(info) for name, info in self.services.items()},
+                "deny_ts_connections": self.registry.get((TERMINAL_SERVER_KEY, "fDenyTSConnections")),
+                "user_authentication": self.registry.get((RDP_TCP_KEY, "UserAuthentication")),
+                "firewall_rules": dict(self.firewall_rules),
+            }
+
+    def tunnels(self):
+        """What the ngrok agent's local API would report: tunnel names, or None when it is not running."""
+        with self._lock:
+            return None if self.live_tunnels is None else set(self.live_tunnels)
+
+    def hosts_entries(self):
+        with open(self.hosts_path, "r") as f:
+            return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+    # Drift: changes made behind the installer's back
+
+    def stop_service(self, name):
+        with self._lock:
+            self.services[name]["status"] = "Stopped"
+            if name == "ngrok":
+                self.live_tunnels = None
+
+    def set_registry_value(self, key, name, value):
+        with self._lock:
+            self.registry[(key, name)] = value
+
+    def fail_cmdlet(self, name, message):
+        """Make a cmdlet report a non-terminating error, as on a broken host; None clears it."""
+        with self._lock:
+            if message is None:
+                self.cmdlet_errors.pop(name, None)
+            else:
+                self.cmdlet_errors[name] = message
+
+    # PowerShell
+
+    def powershell(self, command):
+        """FakeShell handler: (returncode, stdout, stderr) for one command."""
+        with self._lock:
+            self.commands.append(command)
+            error = self.cmdlet_errors.get(command.split(" ", 1)[0])
+        if error is not None:
+            self._sleep("command")
+            return 1, "", error
+        for pattern, handler in self._POWERSHELL_COMMANDS:
+            match = re.search(pattern, command, re.S)
+            if match:
+                return handler(self, match)
+        self._sleep("command")
+        return 1, "", f"The term '{command.split()[0]}' is not recognized by the simulated host"
+
+    def _ps_probe(self, match):
+        self._sleep("probe")
+        return 0, json.dumps(self.probe()), ""
+
+    def _ps_add_capability(self, match):
+        if self.capabilities is None:
+            self._sleep("command")
+            return 1, "", "Add-WindowsCapability : The term 'Add-WindowsCapability' is not recognized"
+        self._sleep("add_capability")
+        with self._lock:
+            self.capabilities[match.group(1)] = "Installed"
+            self.services.setdefault("sshd", {"status": "Stopped", "start_type": "Manual"})
+        return 0, "", ""
+
+    def _ps_start_service(self, match):
+        self._sleep("service")
+        with self._lock:
+            service = self.services.get(match.group(1))
+            if service is None:
+                return 1, "", f"Cannot find any service with service name '{match.group(1)}'."
+            service["status"] = "Running"
+        return 0, "", ""
+
+    def _ps_set_service(self, match):
+        self._sleep("service")
+        with self._lock:
+            service = self.services.get(match.group(1))
+            if service is None:
+                return 1, "", f"Cannot find any service with service name '{match.group(1)}'."
+            service["start_type"] = match.group(2)
+        return 0, "", ""
+
+    def _ps_set_item_property(self, match):
+        self._sleep("registry")
+        with self._lock:
+            if match.group(1) not in self.registry_keys:
+                return 1, "", f"Set-ItemProperty : Cannot find path '{match.group(1)}' because it does not exist."
+            self.registry[(match.group(1), match.group(2))] = int(match.group(3))
+        return 0, "", ""
+
+    def _ps_firewall_rule(self, match):
+        self._sleep("firewall")
+        with self._lock:
+            if match.group(1) in self.firewall_rules:
+                return 1, "", "New-NetFirewallRule : Cannot create a file when that file already exists."
+            self.firewall_rules[match.group(1)] = True
+        return 0, "", ""
+
+    def _ps_mkdir(self, match):
+        self._sleep("mkdir")
+        return 0, "", ""
+
+    def _ps_setx(self, match):
+        self._sleep("setx")
+        with self._lock:
+            self.machine_path = match.group(1).replace("$env:path", self.machine_path)
+        return 0, "SUCCESS: Specified value was saved.", ""
+
+    def _ps_install_sshd(self, match):
+        self._sleep("install_sshd")
+        if not os.path.exists(match.group(1)):
+            return 1, "", f"The term '{match.group(1)}' is not recognized"
+        with self._lock:
+            self.services.setdefault("sshd", {"status": "Stopped", "start_type": "Manual"})
+        return 0, "[SC] SetServiceObjectSecurity SUCCESS", ""
+
+    _POWERSHELL_COMMANDS = [
+        (r"ConvertTo-Json", _ps_probe),
+        (r"Add-WindowsCapability -Online -Name (\S+)", _ps_add_capability),
+        (r"^Start-Service (\w+)", _ps_start_service),
+        (r"^Set-Service -Name (\w+) -StartupType (\w+)", _ps_set_service),
+        (r"^Set-ItemProperty -Path '([^']+)' -Name '(\w+)' -Value (\d+)", _ps_set_item_property),
+        (r"^New-NetFirewallRule -Name (\w+)", _ps_firewall_rule),
+        (r"^mkdir ", _ps_mkdir),
+        (r'^setx PATH "([^"]*)" -m', _ps_setx),
+        (r"^& '([^']*install-sshd\.ps1)'", _ps_install_sshd),
+    ]
+
+    # Child processes (process.set_runner)
+
+    def run(self, args, timeout=None, on_line=None):
+        """Stand-in for process.stream_process handling cmdkey and ngrok service commands."""
+        argv = shlex.split(args) if isinstance(args, str) else [str(arg) for arg in args]
+        with self._lock:
+            self.processes += 1
+            self.commands.append(subprocess.list2cmdline(argv))
+        self._sleep("process_spawn")
+
+        program = os.path.basename(argv[0]).lower() if argv else ""
+        if program == "cmdkey":
+            returncode, stdout = self._cmdkey(argv[1:])
+        elif program == "ngrok.exe" or program == "ngrok":
+            returncode, stdout = self._ngrok(argv[1:], argv[0])
+        else:
+            returncode, stdout = 1, f"'{argv[0] if argv else ''}' is not recognized by the simulated host\n"
+
+        if on_line is not None:
+            for line in stdout.splitlines():
+                on_line(line)
+        return subprocess.CompletedProcess(argv, returncode, stdout, "")
+
+    def _cmdkey(self, args):
+        self._sleep("cmdkey")
+        options = {}
+        for arg in args:
+            name, _, value = arg.lstrip("/").partition(":")
+            options[name.lower()] = value
+        with self._lock:
+            if "list" in options:
+                lines = ["", "Currently stored credentials:", ""]
+                for credential in self.credentials.values():
+                    lines += [f"    Target: LegacyGeneric:target={credential.target}", "    Type: Generic",
+                              f"    User: {credential.user}", ""]
+                return 0, "\n".join(lines) + "\n"
+            if "generic" in options:
+                target = options["generic"]
+                self.credentials[target.lower()] = Credential(target, options.get("user", ""), options.get("pass"))
+                return 0, "CMDKEY: Credential added successfully.\n"
+        return 1, "CMDKEY: The command line parameters are incorrect.\n"
+
+    def _ngrok(self, args, binary="ngrok.exe"):
+        if args[:1] != ["service"] or len(args) < 2:
+            return 1, "ERROR: unknown command\n"
+        self._sleep("ngrok_service")
+        with self._lock:
+            service = self.services.get("ngrok")
+            if args[1] == "install":
+                if service is not None:
+                    return 1, "ERROR: service ngrok already exists\n"
+                config = args[args.index("--config") + 1] if "--config" in args[:-1] else ""
+                self.services["ngrok"] = {"status": "Stopped", "start_type": "Automatic",
+                                          "path_name": service_command_line(binary, config)}
+            elif args[1] in ("start", "restart"):
+                if service is None:
+                    return 1, "ERROR: service ngrok is not installed\n"
+                service["status"] = "Running"
+                _, config = parse_command_line(service["path_name"])
+                self.live_tunnels = set((read_settings(config) or {}).get("tunnels") or {})
+            elif args[1] == "stop":
+                if service is None:
+                    return 1, "ERROR: service ngrok is not installed\n"
+                service["status"] = "Stopped"
+                self.live_tunnels = None
+            elif args[1] == "uninstall":
+                self.services.pop("ngrok", None)
+            else:
+                return 1, f"ERROR: unknown service command {args[1]}\n"
+        return 0, ""
+
+
+@contextlib.contextmanager
+def simulate(host, max_sessions=1):
+    """
+    Point the installer at a SimulatedHost: its PowerShell sessions, child
+    processes, credential store, ngrok agent API, SystemRoot, ProgramFiles and
+    ProgramData. Everything is restored on exit.
+    """
+    from credentials import set_credential_backend
+    from ngrok_service import NgrokServiceControl, set_service_control
+    from powershell import FakeShell, PowerShellExecutor, set_executor
+    from process import set_runner
+    from system_state import invalidate_system_state
+
+    shell = FakeShell(host.powershell, startup_delay=host.delay("powershell_startup"))
+    previous_executor = set_executor(PowerShellExecutor(shell, max_sessions=max_sessions))
+    previous_runner = set_runner(host.run)
+    previous_backend = set_credential_backend(host.credential_backend)
+    previous_control = set_service_control(NgrokServiceControl(tunnel_probe=host.tunnels))
+    previous_environ = {name: os.environ.get(name) for name in ("SystemRoot", "ProgramFiles", "ProgramData")}
+    os.environ["SystemRoot"] = host.root
+    os.environ["ProgramFiles"] = host.program_files
+    os.environ["ProgramData"] = host.program_data
+    invalidate_system_state()
+    try:
+        yield shell
+    finally:
+        set_executor(previous_executor)
+        set_runner(previous_runner)
+        set_credential_backend(previous_backend)
+        set_service_control(previous_control)
+        for name, value in previous_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        invalidate_system_state()
+
+
+class LocalHTTPServer:
+    """
+    A loopback HTTP/1.1 server standing in for the artifact hosts.
+
+    `files` maps URL paths to local file paths. Byte ranges, keep-alive, added
+    latency, a one-off connection drop after `fail_after` bytes and error
+    statuses for the first requests (`fail_statuses`, e.g. [503, 503]) can be
+    switched on to exercise the download code. With `report_size=False` no
+    Content-Length is sent and each response ends by closing the connection.
+    """
+
+    def __init__(self, files, ranges=True, latency=0.0, fail_after=None, fail_statuses=(), report_size=True):
+        self.files = dict(files)
+        self.ranges = ranges
+        self.report_size = report_size
+        self.latency = latency
+        self.fail_after = fail_after
+        self.fail_statuses = list(fail_statuses)
+        self.requests = 0
+        self.connections = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def url(self, path):
+        return self.base_url + path
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, requests=0, connections=0, sent=0):
+        with self._lock:
+            self.requests += requests
+            self.connections += connections
+            self.bytes_sent += sent
+
+    def _take_status(self):
+        with self._lock:
+            return self.fail_statuses.pop(0) if self.fail_statuses else None
+
+    def _take_failure(self):
+        with self._lock:
+            fail_after, self.fail_after = self.fail_after, None
+            return fail_after
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                server._count(connections=1)
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self._serve(send_body=False)
+
+            def do_GET(self):
+                self._serve(send_body=True)
+
+            def _serve(self, send_body):
+                server._count(requests=1)
+                if server.latency:
+                    time.sleep(server.latency)
+                status = server._take_status()
+                if status is not None:
+                    self.send_response(status)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                path = server.files.get(self.path)
+                if path is None:
+                    self.send_error(404)
+                    return
+                size = os.path.getsize(path)
+                start, end = 0, size - 1
+                range_header = self.headers.get("Range")
+                if server.ranges and range_header and range_header.startswith("bytes="):
+                    first, _, last = range_header[6:].partition("-")
+                    start = int(first) if first else 0
+                    end = min(int(last), size - 1) if last else size - 1
+                    if start >= size:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{size}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                else:
+                    self.send_response(200)
+                if server.ranges:
+                    self.send_header("Accept-Ranges", "bytes")
+                if server.report_size:
+                    self.send_header("Content-Length", str(end - start + 1))
+                else:
+                    self.send_header("Connection", "close")
+                    self.close_connection = True
+                self.send_header("ETag", f'"{size}-{int(os.path.getmtime(path))}"')
+                self.end_headers()
+                if send_body:
+                    self._send_file(path, start, end - start + 1)
+
+            def _send_file(self, path, offset, length):
+                fail_after = server._take_failure()
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    while length > 0:
+                        chunk = f.read(min(64 * 1024, length))
+                        if fail_after is not None and fail_after <= len(chunk):
+                            self.wfile.write(chunk[:fail_after])
+                            server._count(sent=fail_after)
+                            self.close_connection = True
+                            return
+                        self.wfile.write(chunk)
+                        server._count(sent=len(chunk))
+                        length -= len(chunk)
+                        if fail_after is not None:
+                            fail_after -= len(chunk)
+
+        return Handler
@@ -0,0 +1,155 @@
+import json
+import subprocess
+import threading
+from dataclasses import dataclass, field, replace
+from typing import Dict, Optional
+
+from events import log
+from powershell import run_powershell
+
+
+# Collects the OS caption, the OpenSSH capability, the sshd and ngrok services,
+# the RDP registry values and the sshd firewall rule in a single PowerShell call.
+# Stored credentials are not part of it: credentials.py reads the Credential
+# Manager directly, which is cheaper than any probe. Each probe is isolated so
+# that one missing cmdlet (for example Get-WindowsCapability on Windows Server
+# 2016) does not hide the others.
+PROBE_SCRIPT = r"""
+$state = [ordered]@{}
+try { $state.os_caption = (Get-CimInstance -ClassName Win32_OperatingSystem).Caption } catch { $state.os_caption = '' }
+try {
+    $cap = Get-WindowsCapability -Online -Name 'OpenSSH.Server*' -ErrorAction Stop | Select-Object -First 1
+    $state.openssh_capability = if ($cap) { [string]$cap.State } else { 'NotPresent' }
+} catch { $state.openssh_capability = '' }
+$services = @{}
+foreach ($name in @('sshd', 'ngrok')) {
+    $svc = Get-Service -Name $name -ErrorAction SilentlyContinue
+    if ($svc) {
+        $path = (Get-CimInstance -ClassName Win32_Service -Filter "Name='$name'" -ErrorAction SilentlyContinue).PathName
+        $services[$name] = @{ status = [string]$svc.Status; start_type = [string]$svc.StartType; path_name = [string]$path }
+    }
+}
+$state.services = $services
+$ts = Get-ItemProperty -Path 'HKLM:\System\CurrentControlSet\Control\Terminal Server' -ErrorAction SilentlyContinue
+$state.deny_ts_connections = if ($ts) { $ts.fDenyTSConnections } else { $null }
+$rdp = Get-ItemProperty -Path 'HKLM:\System\CurrentControlSet\Control\Terminal Server\WinStations\RDP-Tcp' -ErrorAction SilentlyContinue
+$state.user_authentication = if ($rdp) { $rdp.UserAuthentication } else { $null }
+$rules = @{}
+foreach ($rule in @(Get-NetFirewallRule -Name 'sshd' -ErrorAction SilentlyContinue)) { $rules[$rule.Name] = ([string]$rule.Enabled -eq 'True') }
+$state.firewall_rules = $rules
+$state | ConvertTo-Json -Compress -Depth 4
+"""
+
+
+@dataclass(frozen=True)
+class ServiceState:
+    status: str = ""
+    start_type: str = ""
+    path_name: str = ""  # the service command line (binary and arguments)
+
+    @property
+    def running(self):
+        return self.status == "Running"
+
+    @property
+    def automatic(self):
+        return self.start_type == "Automatic"
+
+
+@dataclass(frozen=True)
+class SystemState:
+    """
+    Snapshot of the services, registry values and firewall rules the installer
+    touches (not stored credentials, see PROBE_SCRIPT). Empty fields mean unknown.
+    """
+
+    os_caption: str = ""
+    openssh_capability: str = ""
+    services: Dict[str, ServiceState] = field(default_factory=dict)
+    deny_ts_connections: Optional[int] = None
+    user_authentication: Optional[int] = None
+    firewall_rules: Dict[str, bool] = field(default_factory=dict)
+
+    @property
+    def openssh_installed(self):
+        return self.openssh_capability == "Installed"
+
+    @property
+    def sshd(self):
+        return self.services.get("sshd")
+
+    @property
+    def sshd_ready(self):
+        return self.sshd is not None and self.sshd.running and self.sshd.automatic
+
+    @property
+    def rdp_enabled(self):
+        return self.deny_ts_connections == 0 and self.user_authentication == 1
+
+    def has_firewall_rule(self, name):
+        return self.firewall_rules.get(name, False)
+
+    @classmethod
+    def from_probe(cls, data):
+        services = {
+            name: ServiceState(status=info.get("status") or "", start_type=info.get("start_type") or "",
+                               path_name=info.get("path_name") or "")
+            for name, info in (data.get("services") or {}).items()
+        }
+        return cls(
+            os_caption=data.get("os_caption") or "",
+            openssh_capability=data.get("openssh_capability") or "",
+            services=services,
+            deny_ts_connections=data.get("deny_ts_connections"),
+            user_authentication=data.get("user_authentication"),
+            firewall_rules=dict(data.get("firewall_rules") or {}),
+        )
+
+
+_state = None
+_lock = threading.Lock()
+
+
+def probe_system_state():
+    """Collect a fresh SystemState in one PowerShell round trip."""
+    try:
+        output = run_powershell(PROBE_SCRIPT, stream=False).stdout.strip()
+        return SystemState.from_probe(json.loads(output) if output else {})
+    except (subprocess.CalledProcessError, ValueError) as e:
+        log(f"Could not probe system state, every step will run: {e}")
+        return SystemState()
+
+
+def get_system_state(refresh=False):
+    """Return the cached SystemState, probing the host on first use."""
+    global _state
+    with _lock:
+        if _state is None or refresh:
+            _state = probe_system_state()
+        return _state
+
+
+def update_system_state(**changes):
+    """Record changes made by a setup step in the cached snapshot."""
+    global _state
+    with _lock:
+        _state = replace(_state or SystemState(), **changes)
+        return _state
+
+
+def update_service_state(name, **changes):
+    """Record a change to one service in the cached snapshot."""
+    global _state
+    with _lock:
+        current = _state or SystemState()
+        services = dict(current.services)
+        services[name] = replace(services.get(name) or ServiceState(), **changes)
+        _state = replace(current, services=services)
+        return _state
+
+
+def invalidate_system_state():
+    """Drop the cached snapshot so the next read probes the host again."""
+    global _state
+    with _lock:
+        _state = None
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# The installer is a set of flat top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def quiet_log():
+    """Keep the install log out of the test output."""
+    from events import LogMessage, bus
+
+    lines = []
+
+    def record(event):
+        lines.append(event.text)
+
+    bus.subscribe(record, LogMessage)
+    yield lines
+    bus.unsubscribe(record)
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+import artifact_cache
+from artifact_cache import ArtifactCache
+
+
+@pytest.fixture
+def hashes(monkeypatch):
+    calls = []
+    sha256_of = artifact_cache.sha256_of
+
+    def counting(path):
+        calls.append(path)
+        return sha256_of(path)
+
+    monkeypatch.setattr(artifact_cache, "sha256_of", counting)
+    return calls
+
+
+def put_bytes(cache, tmp_path, url, data):
+    source = tmp_path / "download.tmp"
+    source.write_bytes(data)
+    return cache.put(url, str(source))
+
+
+def test_hits_are_not_hashed_again(tmp_path, hashes):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    path = put_bytes(cache, tmp_path, "https://example.com/a.zip", b"a" * 1000)
+    hashes.clear()
+    assert cache.get("https://example.com/a.zip") == path
+    assert cache.get("https://example.com/a.zip") == path
+    assert hashes == []
+
+
+def test_changed_object_is_hashed_and_discarded(tmp_path, hashes, quiet_log):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    path = put_bytes(cache, tmp_path, "https://example.com/a.zip", b"a" * 1000)
+    with open(path, "wb") as f:
+        f.write(b"b" * 1000)
+    os.utime(path, ns=(0, 0))
+    hashes.clear()
+    assert cache.get("https://example.com/a.zip") is None
+    assert hashes == [path]
+    assert not os.path.exists(path)
+
+
+def test_entry_without_mtime_is_hashed_once(tmp_path, hashes):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    put_bytes(cache, tmp_path, "https://example.com/a.zip", b"a" * 1000)
+    index = cache.entries()
+    del index["https://example.com/a.zip"]["mtime_ns"]
+    cache._write_index(index)
+    hashes.clear()
+    cache.get("https://example.com/a.zip")
+    cache.get("https://example.com/a.zip")
+    assert len(hashes) == 1
+
+
+def test_opened_object_survives_eviction_by_another_installer(tmp_path):
+    root = str(tmp_path / "cache")
+    first, second = ArtifactCache(root, max_bytes=1500), ArtifactCache(root, max_bytes=1500)
+    put_bytes(first, tmp_path, "https://example.com/a.zip", b"a" * 1000)
+    with first.get("https://example.com/a.zip", opened=True) as f:
+        put_bytes(second, tmp_path, "https://example.com/b.zip", b"b" * 1000)
+        assert "https://example.com/a.zip" not in second.entries()
+        assert f.read() == b"a" * 1000
+
+
+def test_fetch_opened_downloads_once(tmp_path):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    downloads = []
+
+    def download(dest):
+        downloads.append(dest)
+        with open(dest, "wb") as f:
+            f.write(b"zip")
+
+    for _ in range(2):
+        with cache.fetch("https://example.com/a.zip", download, opened=True) as f:
+            assert f.read() == b"zip"
+    assert len(downloads) == 1
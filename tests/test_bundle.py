@@ -0,0 +1,84 @@
+import os
+import zipfile
+
+import pytest
+
+import artifacts
+from artifact_cache import ArtifactCache
+from archive import extract_members
+from bundle import BUNDLE_ENV, BUNDLE_NAME, Bundle, BundleError, build_bundle, find_bundle
+from simulator import LocalHTTPServer
+
+
+NGROK_EXE = os.urandom(256 * 1024)
+
+
+@pytest.fixture
+def upstream(tmp_path, quiet_log):
+    ngrok_zip = tmp_path / "ngrok.zip"
+    with zipfile.ZipFile(ngrok_zip, "w") as archive:
+        archive.writestr("ngrok.exe", NGROK_EXE)
+    with LocalHTTPServer({"/ngrok.zip": str(ngrok_zip)}) as server:
+        artifacts.override_url(artifacts.NGROK, server.url("/ngrok.zip"))
+        artifacts.set_cache(ArtifactCache(str(tmp_path / "cache")))
+        try:
+            yield server, str(ngrok_zip)
+        finally:
+            artifacts.override_url(artifacts.NGROK, None)
+            artifacts.set_cache(None)
+
+
+@pytest.fixture
+def pack(tmp_path, upstream):
+    server, ngrok_zip = upstream
+    path = str(tmp_path / BUNDLE_NAME)
+    build_bundle(path, {"ngrok": (ngrok_zip, server.url("/ngrok.zip"))})
+    return path
+
+
+def install_ngrok(bundle, dest):
+    previous = artifacts.set_bundle(bundle)
+    try:
+        with artifacts.open_artifact(artifacts.NGROK) as ngrok_zip:
+            extract_members(ngrok_zip, dest, ["ngrok.exe"])
+    finally:
+        artifacts.set_bundle(previous)
+    with open(os.path.join(dest, "ngrok.exe"), "rb") as f:
+        return f.read()
+
+
+def test_valid_pack_is_read_without_downloading(tmp_path, upstream, pack):
+    server, _ = upstream
+    with Bundle(pack) as bundle:
+        assert install_ngrok(bundle, str(tmp_path / "out")) == NGROK_EXE
+    assert server.requests == 0
+
+
+def test_corrupt_entry_falls_back_to_download(tmp_path, upstream, pack):
+    server, _ = upstream
+    with Bundle(pack) as bundle:
+        entry = bundle.entries["ngrok"]
+    with open(pack, "r+b") as f:
+        f.seek(entry["offset"] + entry["size"] // 2)
+        f.write(b"corrupt!")
+    with Bundle(pack) as bundle:
+        with pytest.raises(BundleError):
+            bundle.view("ngrok")
+        assert install_ngrok(bundle, str(tmp_path / "out")) == NGROK_EXE
+    assert server.bytes_sent == os.path.getsize(upstream[1])
+
+
+def test_invalid_pack_is_ignored(tmp_path, monkeypatch, pack, quiet_log):
+    with open(pack, "r+b") as f:
+        f.truncate(os.path.getsize(pack) - 4)
+    with pytest.raises(BundleError):
+        Bundle(pack)
+    monkeypatch.setenv(BUNDLE_ENV, pack)
+    assert find_bundle() is None
+    assert any("ignoring it" in line for line in quiet_log)
+
+
+def test_pinned_hash_must_match_the_manifest(pack):
+    with Bundle(pack) as bundle:
+        with pytest.raises(BundleError):
+            bundle.view("ngrok", "0" * 64)
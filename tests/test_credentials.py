@@ -0,0 +1,54 @@
+import pytest
+
+from credentials import Credential, MemoryCredentialBackend, get_credential_backend, set_credential_backend
+from hosts_file import default_hosts_path
+from utils import RDP_CREDENTIAL_TARGET, setup_rdp_loopback
+
+
+def test_targets_are_case_insensitive():
+    backend = MemoryCredentialBackend()
+    backend.write(Credential("TERMSRV/Host", "user", "secret"))
+    assert backend.read("termsrv/host") == Credential("TERMSRV/Host", "user", "secret")
+    backend.delete("TERMSRV/HOST")
+    assert backend.read("TERMSRV/Host") is None
+
+
+def test_upsert_writes_only_what_differs():
+    backend = MemoryCredentialBackend()
+    backend.write(Credential("a", "user", "secret"))
+    backend.write(Credential("b", "user", "secret"))
+    written = backend.upsert_many([
+        Credential("a", "user", "secret"),  # unchanged
+        Credential("b", "admin", "secret"),  # user changed
+        Credential("c", "user", "secret"),  # new
+    ])
+    assert written == ["b", "c"]
+    assert backend.read("b").user == "admin"
+
+
+def test_upsert_without_password_keeps_the_stored_one():
+    backend = MemoryCredentialBackend()
+    backend.write(Credential("a", "user", "secret"))
+    assert backend.upsert_many([Credential("a", "user")]) == []
+    assert backend.upsert_many([Credential("a", "user", "other")]) == ["a"]
+
+
+@pytest.fixture
+def host_backend(tmp_path, monkeypatch):
+    monkeypatch.setenv("SystemRoot", str(tmp_path))
+    with open(default_hosts_path(), "w") as f:
+        f.write("127.0.0.1 localhost\n")
+    backend = MemoryCredentialBackend()
+    previous = set_credential_backend(backend)
+    yield backend
+    set_credential_backend(previous)
+
+
+def test_loopback_credential_is_written_once(host_backend, quiet_log):
+    setup_rdp_loopback()
+    assert get_credential_backend().read(RDP_CREDENTIAL_TARGET) is not None
+    calls = host_backend.calls
+    setup_rdp_loopback()
+    # The second run only reads the stored credential
+    assert host_backend.calls == calls + 1
+    assert any("já existe" in line for line in quiet_log)
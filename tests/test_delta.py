@@ -0,0 +1,87 @@
+import os
+import subprocess
+
+import pytest
+
+import delta
+import utils
+from artifact_cache import CacheLockTimeout
+from delta import DeltaError, swap_binary, update_ngrok
+from ngrok_service import MemoryServiceControl
+
+
+@pytest.fixture
+def binaries(tmp_path):
+    ngrok_path = tmp_path / "ngrok.exe"
+    new_path = tmp_path / "ngrok.exe.new"
+    ngrok_path.write_bytes(b"old")
+    new_path.write_bytes(b"new")
+    return str(ngrok_path), str(new_path)
+
+
+@pytest.fixture
+def control(binaries):
+    return MemoryServiceControl(installed=True, running=True, binary_path=binaries[0])
+
+
+def test_swap_restarts_the_service(binaries, control):
+    swap_binary(*binaries, control=control)
+    assert open(binaries[0], "rb").read() == b"new"
+    assert not os.path.exists(binaries[0] + ".old")
+    assert control.calls == ["stop", "start"] and control.status.running
+
+
+def test_failed_stop_starts_the_service_again(binaries, control, monkeypatch):
+    stop = control.stop
+
+    def stop_then_time_out(ngrok_path):
+        stop(ngrok_path)
+        raise subprocess.TimeoutExpired(["ngrok", "service", "stop"], 30)
+
+    monkeypatch.setattr(control, "stop", stop_then_time_out)
+    with pytest.raises(subprocess.TimeoutExpired):
+        swap_binary(*binaries, control=control)
+    assert open(binaries[0], "rb").read() == b"old"
+    assert control.status.running
+
+
+def test_failed_rollback_start_keeps_the_first_error(binaries, control, monkeypatch, quiet_log):
+    errors = iter([subprocess.CalledProcessError(1, "first start"), subprocess.CalledProcessError(1, "second start")])
+
+    def start(ngrok_path):
+        raise next(errors)
+
+    monkeypatch.setattr(control, "start", start)
+    with pytest.raises(subprocess.CalledProcessError) as raised:
+        swap_binary(*binaries, control=control)
+    assert raised.value.cmd == "first start"
+    assert any("second start" in line for line in quiet_log)
+    assert open(binaries[0], "rb").read() == b"old"
+
+
+@pytest.fixture
+def index(monkeypatch, binaries):
+    index = {"target": {"sha256": "0" * 64, "size": 3}, "archive": None, "deltas": {}}
+    monkeypatch.setattr(delta, "fetch_index", lambda url, fetcher=None: index)
+    return index
+
+
+def test_cache_lock_timeout_is_a_delta_error(binaries, control, index, monkeypatch, quiet_log):
+    def locked(archive, new_path):
+        raise CacheLockTimeout("cache is locked")
+
+    monkeypatch.setattr(delta, "_extract_full", locked)
+    with pytest.raises(DeltaError, match="cache is locked"):
+        update_ngrok(os.path.dirname(binaries[0]), "http://example.invalid/index.json", control=control)
+    monkeypatch.setattr(utils, "update_ngrok", lambda install_path: update_ngrok(install_path, "x", control=control))
+    assert utils.update_installed_ngrok(os.path.dirname(binaries[0])) is None
+    assert open(binaries[0], "rb").read() == b"old"
+
+
+def test_command_timeout_keeps_the_installed_version(binaries, control, monkeypatch, quiet_log):
+    def time_out(install_path):
+        raise subprocess.TimeoutExpired(["ngrok", "service", "start"], 30)
+
+    monkeypatch.setattr(utils, "update_ngrok", time_out)
+    assert utils.update_installed_ngrok(os.path.dirname(binaries[0])) is None
+    assert any("keeping the installed version" in line for line in quiet_log)
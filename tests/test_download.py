@@ -0,0 +1,43 @@
+import hashlib
+
+import pytest
+
+from download import download_file
+from simulator import LocalHTTPServer
+
+DATA = bytes(range(256)) * 1024
+
+
+@pytest.fixture
+def server(tmp_path):
+    source = tmp_path / "ngrok.zip"
+    source.write_bytes(DATA)
+    with LocalHTTPServer({"/ngrok.zip": str(source)}, report_size=False) as server:
+        yield server
+
+
+def test_complete_part_without_size_is_finished(server, tmp_path, quiet_log):
+    dest = str(tmp_path / "out.zip")
+    with open(dest + ".part", "wb") as f:
+        f.write(DATA)
+    download_file(server.url("/ngrok.zip"), dest, sha256=hashlib.sha256(DATA).hexdigest(), retries=1)
+    assert open(dest, "rb").read() == DATA
+    assert server.bytes_sent == 0
+
+
+def test_partial_part_without_size_is_resumed(server, tmp_path, quiet_log):
+    dest = str(tmp_path / "out.zip")
+    with open(dest + ".part", "wb") as f:
+        f.write(DATA[:1000])
+    download_file(server.url("/ngrok.zip"), dest, sha256=hashlib.sha256(DATA).hexdigest(), retries=1)
+    assert open(dest, "rb").read() == DATA
+    assert server.bytes_sent == len(DATA) - 1000
+
+
+def test_stale_part_longer_than_the_file_is_discarded(server, tmp_path, quiet_log):
+    dest = str(tmp_path / "out.zip")
+    with open(dest + ".part", "wb") as f:
+        f.write(DATA + b"left over from another release")
+    download_file(server.url("/ngrok.zip"), dest, sha256=hashlib.sha256(DATA).hexdigest(), retries=1)
+    assert open(dest, "rb").read() == DATA
+    assert not quiet_log
@@ -0,0 +1,17 @@
+import asyncio
+import json
+import shlex
+import sys
+
+from fleet import CommandTransport
+
+
+def test_command_template_carries_the_settings(tmp_path):
+    out = tmp_path / "argv.json"
+    script = "import json, sys; json.dump(sys.argv[1:], open(sys.argv[1], 'w'))"
+    template = (f"{shlex.quote(sys.executable)} -c {shlex.quote(script)} {shlex.quote(str(out))} "
+                "{host} --auth-token {auth_token} --address {address}")
+    transport = CommandTransport(template, timeout=60)
+    settings = {"auth_token": "s3cret", "address": "1.tcp.ngrok.io:20000"}
+    assert asyncio.run(transport.install("host-1", settings)) == 0
+    assert json.loads(out.read_text())[1:] == ["host-1", "--auth-token", "s3cret", "--address", "1.tcp.ngrok.io:20000"]
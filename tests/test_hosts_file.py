@@ -0,0 +1,47 @@
+import os
+import stat
+
+import hosts_file
+from hosts_file import update_hosts_file
+
+HOSTS = b"# Copyright (c) 1993-2009 Microsoft Corp.\r\n127.0.0.1 localhost\r\n"
+
+
+def write_hosts(tmp_path, mode):
+    path = tmp_path / "hosts"
+    path.write_bytes(HOSTS)
+    os.chmod(path, mode)
+    return str(path)
+
+
+def test_permissions_are_kept(tmp_path):
+    path = write_hosts(tmp_path, 0o640)
+    update_hosts_file(path, add=[("127.0.0.2", "procesure")])
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    assert open(path, "rb").read() == HOSTS + b"127.0.0.2 procesure\r\n"
+    assert os.listdir(tmp_path) == ["hosts"]
+
+
+def test_read_only_file_is_written_and_stays_read_only(tmp_path):
+    path = write_hosts(tmp_path, 0o444)
+    update_hosts_file(path, add=[("127.0.0.2", "procesure")])
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o444
+    assert b"127.0.0.2 procesure" in open(path, "rb").read()
+
+
+def test_falls_back_to_writing_in_place(tmp_path, monkeypatch):
+    path = write_hosts(tmp_path, 0o444)
+    inode = os.stat(path).st_ino
+
+    def refuse(source, dest):
+        raise PermissionError(13, "Access is denied", dest)
+
+    monkeypatch.setattr(hosts_file, "_copy_security", refuse)
+    update_hosts_file(path, add=[("127.0.0.2", "procesure")])
+    assert os.stat(path).st_ino == inode
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o444
+    assert open(path, "rb").read() == HOSTS + b"127.0.0.2 procesure\r\n"
+    assert os.listdir(tmp_path) == ["hosts"]
+
+    update_hosts_file(path, remove=[("127.0.0.2", "procesure")])
+    assert open(path, "rb").read() == HOSTS
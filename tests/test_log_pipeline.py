@@ -0,0 +1,46 @@
+import threading
+
+from log_pipeline import LogPipeline
+
+
+def test_lines_are_batched_in_order(tmp_path):
+    pipeline = LogPipeline(spill_path=str(tmp_path / "install.log"), batch_size=2)
+    pipeline.write("one\ntwo\nthr")
+    pipeline.write("ee\n")
+    assert [line.split("] ", 1)[1] for line in pipeline.drain()] == ["one", "two"]
+    assert [line.split("] ", 1)[1] for line in pipeline.drain()] == ["three"]
+    assert pipeline.drain() == []
+
+
+def test_queue_is_bounded_and_reports_dropped_lines(tmp_path):
+    spill_path = str(tmp_path / "install.log")
+    pipeline = LogPipeline(spill_path=spill_path, max_visible_lines=100, batch_size=1000)
+    pipeline.write("".join(f"line {i}\n" for i in range(250)))
+    assert pipeline.pending() == 101
+    lines = pipeline.drain()
+    assert f"150 lines not shown, the full log is in {spill_path}" in lines[0]
+    assert lines[1].endswith("line 150") and lines[-1].endswith("line 249")
+    assert pipeline.pending() == 0 and pipeline.drain() == []
+    pipeline.close()
+    assert len(open(spill_path, encoding="utf-8").read().splitlines()) == 250
+
+
+def test_concurrent_writers_account_for_every_line(tmp_path):
+    pipeline = LogPipeline(spill_path=str(tmp_path / "install.log"), max_visible_lines=50, batch_size=10)
+    shown, dropped = [], []
+
+    def writer(n):
+        for i in range(500):
+            pipeline.write(f"{n}-{i}\n")
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads) or pipeline.pending():
+        for line in pipeline.drain():
+            if "lines not shown" in line:
+                dropped.append(int(line.split("... ", 1)[1].split()[0]))
+            else:
+                shown.append(line)
+    pipeline.close()
+    assert len(shown) + sum(dropped) == 2000
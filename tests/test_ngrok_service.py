@@ -0,0 +1,126 @@
+import json
+import os
+import subprocess
+
+import pytest
+
+from ngrok_service import (
+    INSTALL, NONE, REINSTALL, RESTART, START, STAMP_NAME, MemoryServiceControl, NgrokServiceError, plan_service,
+    reconcile_service,
+)
+
+
+def write_config(path, tunnels=("ssh",), region="eu"):
+    with open(path, "w") as f:
+        f.write(f"version: 2\nregion: {region}\ntunnels:\n")
+        for name in tunnels:
+            f.write(f"  {name}:\n    proto: tcp\n    addr: 22\n")
+
+
+@pytest.fixture
+def paths(tmp_path):
+    ngrok_path = str(tmp_path / "ngrok.exe")
+    config_path = str(tmp_path / "agent.yml")
+    write_config(config_path)
+    return ngrok_path, config_path
+
+
+def reconcile(control, paths, **kwargs):
+    return reconcile_service(*paths, control=control, timeout=1.0, poll_interval=0.01, **kwargs)
+
+
+def stamp(config_path):
+    with open(os.path.join(os.path.dirname(config_path), STAMP_NAME)) as f:
+        return json.load(f)["config_hash"]
+
+
+def test_fresh_host_installs_and_starts(paths):
+    control = MemoryServiceControl()
+    assert reconcile(control, paths).action == INSTALL
+    assert control.calls == ["install", "start"]
+    assert control.status.running and control.status.binary_path == paths[0]
+    assert stamp(paths[1])
+
+
+def test_running_current_config_does_nothing(paths):
+    control = MemoryServiceControl()
+    reconcile(control, paths)
+    control.calls.clear()
+    assert reconcile(control, paths).action == NONE
+    assert control.calls == []
+
+
+def test_stopped_service_is_started(paths):
+    control = MemoryServiceControl()
+    reconcile(control, paths)
+    control.stop(paths[0])
+    control.calls.clear()
+    assert reconcile(control, paths).action == START
+    assert control.calls == ["start"]
+
+
+def test_changed_config_restarts(paths):
+    control = MemoryServiceControl()
+    reconcile(control, paths)
+    before = stamp(paths[1])
+    write_config(paths[1], tunnels=("ssh", "rdp"))
+    control.calls.clear()
+    assert reconcile(control, paths).action == RESTART
+    assert control.calls == ["restart"]
+    assert stamp(paths[1]) != before
+
+
+def test_formatting_only_change_does_not_restart(paths):
+    control = MemoryServiceControl()
+    reconcile(control, paths)
+    with open(paths[1], "a") as f:
+        f.write("# a comment\n")
+    assert reconcile(control, paths).action == NONE
+
+
+def test_service_installed_elsewhere_is_reinstalled(paths, tmp_path):
+    control = MemoryServiceControl(installed=True, running=True, binary_path=str(tmp_path / "old" / "ngrok.exe"),
+                                   config_path=paths[1])
+    assert reconcile(control, paths).action == REINSTALL
+    assert control.calls == ["stop", "uninstall", "install", "start"]
+    assert control.status.binary_path == paths[0]
+
+
+def test_tunnels_down_plans_a_restart_only_when_asked(paths):
+    reconcile(MemoryServiceControl(), paths)
+    # Same config and stamp, but this service has not brought any tunnel up
+    control = MemoryServiceControl(installed=True, running=True, binary_path=paths[0], config_path=paths[1])
+    assert plan_service(*paths, control=control).action == NONE
+    assert plan_service(*paths, control=control, check_tunnels=True).action == RESTART
+    assert reconcile(control, paths, check_tunnels=True).action == RESTART
+    assert control.tunnels() == {"ssh"}
+
+
+def test_waits_for_tunnels(paths):
+    control = MemoryServiceControl(tunnel_polls=3)
+    reconcile(control, paths)
+    assert control.tunnels() == {"ssh"}
+
+
+def test_tunnels_that_never_come_up_fail(paths):
+    control = MemoryServiceControl(tunnel_polls=1000)
+    with pytest.raises(NgrokServiceError, match="did not come up"):
+        reconcile_service(*paths, control=control, timeout=0.05, poll_interval=0.01)
+
+
+def test_failed_command_raises_and_leaves_no_stamp(paths, monkeypatch):
+    control = MemoryServiceControl()
+
+    def refuse(ngrok_path):
+        raise subprocess.CalledProcessError(1, ["ngrok", "service", "start"])
+
+    monkeypatch.setattr(control, "start", refuse)
+    with pytest.raises(NgrokServiceError, match="Could not install"):
+        reconcile(control, paths)
+    assert not os.path.exists(os.path.join(os.path.dirname(paths[1]), STAMP_NAME))
+
+
+def test_missing_config_is_an_error(paths):
+    os.remove(paths[1])
+    with pytest.raises(NgrokServiceError, match="No usable ngrok configuration"):
+        reconcile(MemoryServiceControl(), paths)
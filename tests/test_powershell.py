@@ -0,0 +1,110 @@
+import subprocess
+import threading
+import time
+
+import pytest
+
+from powershell import FakeShell, PowerShellExecutor, PowerShellSession, decode_command, encode_command, encode_result
+
+
+def test_command_round_trips_through_the_frame():
+    command = "Write-Output 'it''s'\n$x = \"two\nlines\""
+    line = encode_command("PSFRAMEabc", command)
+    assert line.endswith("\n") and "\n" not in line[:-1]
+    assert decode_command(line) == ("PSFRAMEabc", command)
+
+
+def test_decode_ignores_unframed_lines():
+    assert decode_command("Write-Output hello\n") is None
+
+
+def test_session_returns_output_error_and_status(quiet_log):
+    shell = FakeShell(lambda command: (3, "out line 1\nout line 2", "something failed"))
+    session = PowerShellSession(shell)
+    try:
+        result = session.run("Get-Thing", check=False)
+    finally:
+        session.close()
+    assert (result.returncode, result.stdout, result.stderr) == (3, "out line 1\nout line 2", "something failed")
+    assert result.tail == ["out line 1", "out line 2"]
+
+
+def test_nonzero_status_raises_when_checked(quiet_log):
+    session = PowerShellSession(FakeShell(lambda command: (1, "", "Cannot find any service")))
+    try:
+        with pytest.raises(subprocess.CalledProcessError) as failure:
+            session.run("Start-Service nope")
+    finally:
+        session.close()
+    assert failure.value.returncode == 1
+    assert failure.value.stderr == "Cannot find any service"
+
+
+def test_output_that_looks_like_a_frame_marker_is_kept(quiet_log):
+    # Only the per-call token ends a section; another token's markers are plain output
+    fake = encode_result("PSFRAMEother", 0, "inner", "")
+    session = PowerShellSession(FakeShell(lambda command: (0, fake, "")))
+    try:
+        result = session.run("Write-Output $fake")
+    finally:
+        session.close()
+    assert result.returncode == 0
+    assert result.stdout == fake
+
+
+def test_executor_reuses_one_session(quiet_log):
+    shell = FakeShell(lambda command: (0, command, ""))
+    executor = PowerShellExecutor(shell, max_sessions=1)
+    try:
+        outputs = [executor.run(f"Write-Output {i}").stdout for i in range(5)]
+    finally:
+        executor.close()
+    assert outputs == [f"Write-Output {i}" for i in range(5)]
+    assert shell.spawn_count == 1
+    assert shell.commands == outputs
+
+
+def test_executor_caps_concurrent_sessions(quiet_log):
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def handler(command):
+        with lock:
+            active.append(command)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(command)
+        return 0, "", ""
+
+    shell = FakeShell(handler)
+    executor = PowerShellExecutor(shell, max_sessions=2)
+    threads = [threading.Thread(target=executor.run, args=(f"cmd {i}",)) for i in range(6)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        executor.close()
+    assert max(peak) == 2
+    assert shell.spawn_count == 2
+
+
+def test_timeout_kills_the_session_and_the_next_command_gets_a_fresh_one(quiet_log):
+    shell = FakeShell(lambda command: (time.sleep(2) if command == "slow" else None) or (0, "ok", ""))
+    session = PowerShellSession(shell)
+    try:
+        with pytest.raises(subprocess.TimeoutExpired):
+            session.run("slow", timeout=0.2)
+        assert session.run("fast").stdout == "ok"
+    finally:
+        session.close()
+    assert shell.spawn_count == 2
+
+
+def test_wrapper_fails_on_non_terminating_errors_but_not_on_native_stderr():
+    line = encode_command("PSFRAMEabc", "Start-Service sshd")
+    assert "if ($_.FullyQualifiedErrorId -notlike 'NativeCommandError*') { $__ec = 1 }" in line
+    assert "if ($__ec -eq 0 -and $LASTEXITCODE) { $__ec = $LASTEXITCODE }" in line
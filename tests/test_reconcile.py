@@ -0,0 +1,58 @@
+import os
+import types
+
+import pytest
+
+import reconcile
+import system_state
+from system_state import ServiceState, SystemState, get_system_state, invalidate_system_state, update_system_state
+
+STOPPED_SSHD = ServiceState(status="Stopped", start_type="Automatic")
+
+
+@pytest.fixture
+def native(monkeypatch):
+    """Take the Windows branch of probe_state, with a canned native probe."""
+    fake_os = types.ModuleType("os")
+    fake_os.__dict__.update(vars(os))
+    fake_os.name = "nt"
+    monkeypatch.setattr(reconcile, "os", fake_os)
+    probed = []
+
+    def probe_system_state():
+        probed.append(True)
+        return SystemState(os_caption="Microsoft Windows 11 Pro", openssh_capability="Installed",
+                           services={"sshd": STOPPED_SSHD}, firewall_rules={"sshd": True})
+
+    monkeypatch.setattr(system_state, "probe_system_state", probe_system_state)
+    native_state = SystemState(services={"sshd": STOPPED_SSHD}, deny_ts_connections=0, user_authentication=1)
+    monkeypatch.setattr(reconcile, "probe_native_state", lambda: native_state)
+    invalidate_system_state()
+    yield probed
+    invalidate_system_state()
+
+
+def test_native_probe_keeps_capability_and_firewall(native):
+    update_system_state(os_caption="Microsoft Windows Server 2016", openssh_capability="Installed",
+                        firewall_rules={"sshd": True})
+    state = reconcile.probe_state()
+    assert native == []
+    assert state is get_system_state()
+    assert state.openssh_installed and state.has_firewall_rule("sshd")
+    assert state.os_caption == "Microsoft Windows Server 2016"
+    assert state.sshd == STOPPED_SSHD and state.rdp_enabled
+
+
+def test_first_native_probe_fills_the_rest_through_powershell(native):
+    state = reconcile.probe_state()
+    assert native == [True]
+    assert state.openssh_installed and state.has_firewall_rule("sshd")
+    reconcile.probe_state()
+    assert native == [True]
+
+
+def test_missing_sshd_probes_everything_again(native, monkeypatch):
+    update_system_state(openssh_capability="Installed", firewall_rules={"sshd": True})
+    monkeypatch.setattr(reconcile, "probe_native_state", lambda: SystemState())
+    reconcile.probe_state()
+    assert native == [True]
@@ -1,33 +1,25 @@
 import os
 import sys
 import subprocess
-import requests
-import yaml
 from pathlib import Path
-import zipfile
+from agent_config import CONFIG_NAME, AgentConfig, ConfigError, Tunnel, ssh_tunnel, write_config
+from archive import extract_members
+from artifacts import NGROK, open_artifact
+from authorized_keys import KeySourceError, default_target, split_sources, sync_authorized_keys
+from credentials import Credential, CredentialError, get_credential_backend
+from delta import CURRENT, DELTA, DeltaError, delta_index_url, update_ngrok
+from events import log, step
+from hosts_file import default_hosts_path, update_hosts_file
+from ngrok_service import INSTALL, NONE, NgrokServiceError, reconcile_service
+from windows_version import detect_windows_version
 
 
 def get_windows_version():
     """Detect Windows version and return version info."""
     try:
-        output = subprocess.check_output(
-            [
-                "powershell",
-                "Get-CimInstance -ClassName Win32_OperatingSystem | Select-Object Caption",
-            ],
-            text=True,
-        )
-
-        if "Windows 10" in output:
-            return "Windows10"
-        elif "Windows 11" in output:
-            return "Windows11"
-        elif "Windows Server 2016" in output:
-            return "WindowsServer2016"
-        else:
-            raise ValueError(f"Unsupported Windows version detected: {output}")
+        return detect_windows_version()
     except subprocess.CalledProcessError as e:
-        print(f"Error detecting Windows version: {e}")
+        log(f"Error detecting Windows version: {e}")
         sys.exit(1)
 
 
@@ -37,159 +29,191 @@ def check_admin_privileges():
         import ctypes
         return ctypes.windll.shell32.IsUserAnAdmin() != 0
     except Exception:
-        print("Error checking admin privileges")
+        log("Error checking admin privileges")
         return False
 
 
+@step("download_ngrok")
 def download_ngrok(install_path):
     """Download and install ngrok on Windows."""
-    ngrok_url = "https://bin.equinox.io/c/bNyj1mQVY4c/ngrok-stable-windows-amd64.zip"
-    ngrok_zip = "ngrok.zip"
+    ngrok_exe_path = os.path.join(install_path, "ngrok.exe")
+    if os.path.exists(ngrok_exe_path):
+        if delta_index_url():
+            update_installed_ngrok(install_path)
+        else:
+            log(f"ngrok is already installed at {ngrok_exe_path}.")
+        return ngrok_exe_path
 
     try:
         # Ensure ngrok directory exists
         Path(install_path).mkdir(parents=True, exist_ok=True)
 
-        # Download ngrok
-        print("Downloading procesure agent...")
-        response = requests.get(ngrok_url)
-        response.raise_for_status()  # Raise an error for bad HTTP status
-        with open(ngrok_zip, "wb") as f:
-            f.write(response.content)
-
-        # Extract ngrok
-        print("Extracting ngrok...")
-        with zipfile.ZipFile(ngrok_zip, "r") as zip_ref:
-            zip_ref.extractall(install_path)
+        # Take ngrok from the installer bundle, the local artifact cache or a download
+        log("Downloading procesure agent...")
+        with open_artifact(NGROK) as ngrok_zip:
+            # Extract only ngrok.exe, straight from the bundle or cached archive
+            log("Extracting ngrok...")
+            extract_members(ngrok_zip, install_path, ["ngrok.exe"])
 
-        # Delete the zip file
-        print("Cleaning up temporary files...")
-        os.remove(ngrok_zip)
+        log("Ngrok setup completed successfully.")
 
-        print("Ngrok setup completed successfully.")
-
-        ngrok_exe_path = os.path.join(install_path, "ngrok.exe")
         return ngrok_exe_path
 
     except Exception as e:
-        # Clean up zip file if it exists, even if there was an error
-        if os.path.exists(ngrok_zip):
-            try:
-                os.remove(ngrok_zip)
-            except Exception:
-                pass  # Ignore cleanup errors
-        print(f"Error downloading ngrok: {e}")
+        log(f"Error downloading ngrok: {e}")
         sys.exit(1)
 
 
-def setup_ngrok_service(ngrok_path):
-    """Set up ngrok as a Windows service using the specified configuration file."""
+def update_installed_ngrok(install_path):
+    """Update ngrok.exe to the release named by the delta index; the installed one is kept on failure."""
+    try:
+        result = update_ngrok(install_path)
+    except (DeltaError, OSError, subprocess.SubprocessError) as e:
+        log(f"Could not update ngrok, keeping the installed version: {e}")
+        return None
+    if result.action == CURRENT:
+        log("ngrok is already the latest version.")
+    elif result.action == DELTA:
+        log(f"ngrok updated from a {result.downloaded} byte delta in {result.seconds:.1f}s.")
+    else:
+        log(f"ngrok updated from the full download in {result.seconds:.1f}s.")
+    return result
+
+
+@step("setup_ngrok_service")
+def setup_ngrok_service(ngrok_path, config_path=None):
+    """
+    Bring the ngrok service in line with the configuration file, installing,
+    starting or restarting it only when needed, and wait for its tunnels.
+    """
+    config_path = config_path or os.path.join(os.path.dirname(ngrok_path), CONFIG_NAME)
     try:
-        # Command to install ngrok service with the given configuration file
-        config_path = os.path.join(os.path.dirname(ngrok_path), "agent.yml")
-        service_command = [ngrok_path, "service", "install", "--config", config_path]
-        start_command = [ngrok_path, "service", "start"]
+        plan = reconcile_service(ngrok_path, config_path)
+    except NgrokServiceError as e:
+        log(f"Error setting up ngrok service: {e}")
+        raise
 
-        # Run the ngrok service installation command
-        subprocess.run(service_command, check=True)
-        subprocess.run(start_command, check=True)
+    if plan.action == NONE:
+        log("ngrok service is already running the current configuration.")
+    elif plan.action == INSTALL:
+        log("ngrok service has been installed, started and configured.")
+    else:
+        log(f"ngrok service: {plan.action} done ({plan.reason}).")
 
-        print("ngrok service has been installed, started and configured.")
 
-    except subprocess.CalledProcessError as e:
-        print(f"Error setting up ngrok service: {e}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        sys.exit(1)
+def available_key_sources(ssh_keys_path):
+    """The key sources in ssh_keys_path that are URLs or exist locally."""
+    return [source for source in split_sources(ssh_keys_path)
+            if source.lower().startswith(("http://", "https://")) or os.path.exists(source)]
+
+
+@step("sync_ssh_keys")
+def sync_ssh_keys(ssh_keys_path):
+    """
+    Apply the public keys in ssh_keys_path (key files, directories or URLs,
+    separated by ';') to administrators_authorized_keys, adding and revoking
+    only what changed since the last sync.
+    """
+    sources = available_key_sources(ssh_keys_path)
+    if not sources:
+        log(f"No SSH keys found at {ssh_keys_path}, leaving the authorized keys alone.")
+        return
+
+    target = default_target()
+    try:
+        result = sync_authorized_keys(target, sources)
+    except (OSError, KeySourceError, subprocess.SubprocessError) as e:
+        log(f"Error syncing SSH keys to {target}: {e}")
+        raise
+    if result.changed:
+        log(f"SSH keys synced to {target}: {result.summary()}")
+    else:
+        log(f"SSH keys in {target} are already up to date ({result.total} key(s)).")
+
 
+def build_agent_config(authtoken, ssh_domain, tunnels=()):
+    """The validated AgentConfig for the SSH tunnel plus any extra tunnels."""
+    return AgentConfig(
+        authtoken=authtoken,
+        tunnels=(ssh_tunnel(ssh_domain),) + tuple(
+            tunnel if isinstance(tunnel, Tunnel) else Tunnel.from_dict(tunnel) for tunnel in tunnels or ()
+        ),
+    ).validate()
 
-def create_ngrok_config(authtoken, ssh_domain, install_path):
-    """Create ngrok configuration file."""
-    config = {
-        "version": "3",
-        "agent": {
-            "authtoken": authtoken
-        },
-        "tunnels": {
-            "ssh": {
-                "proto": "tcp",
-                "addr": 22,
-                "remote_addr": ssh_domain
-            }
-        }
-    }
 
+@step("create_ngrok_config")
+def create_ngrok_config(authtoken, ssh_domain, install_path, tunnels=()):
+    """
+    Create the ngrok configuration file with the SSH tunnel plus any extra
+    tunnels (Tunnel objects or settings mappings).
+
+    The file is only rewritten when its content changes.
+    """
     try:
-        # Create directory if it doesn't exist
-        os.makedirs(install_path, exist_ok=True)
-        
-        # Use install_path for config file
-        config_path = os.path.join(install_path, "agent.yml")
-        
-        # Use PyYAML to write the config file in YAML format
-        with open(config_path, "w") as f:
-            yaml.safe_dump(config, f, default_flow_style=False)
-        print(f"ngrok configuration saved at {config_path}")
+        config = build_agent_config(authtoken, ssh_domain, tunnels)
+
+        config_path = os.path.join(install_path, CONFIG_NAME)
+        result = write_config(config_path, config)
+        if not result.changed:
+            log(f"ngrok configuration at {config_path} is already up to date.")
+        elif result.restart_required:
+            log(f"ngrok configuration saved at {config_path}")
+        else:
+            log(f"ngrok configuration at {config_path} rewritten in canonical form, settings unchanged.")
         return config_path
+    except ConfigError as e:
+        log(f"Invalid ngrok configuration: {e}")
+        raise
     except IOError as e:
-        print(f"Error writing ngrok configuration: {e}")
+        log(f"Error writing ngrok configuration: {e}")
         raise
     except Exception as e:
-        print(f"Unexpected error creating ngrok configuration: {e}")
+        log(f"Unexpected error creating ngrok configuration: {e}")
         raise
 
 
+# O alias e a credencial RDP criados por setup_rdp_loopback
+RDP_ALIAS_IP = '127.0.0.2'
+RDP_ALIAS_NAME = 'procesure'
+RDP_CREDENTIAL_TARGET = f"TERMSRV/{RDP_ALIAS_IP}"
+
+
+@step("setup_rdp_loopback")
 def setup_rdp_loopback():
     """
     Configura o arquivo hosts e cria credenciais RDP automáticas para 127.0.0.2 procesure,
     com usuário e senha padrão (user/password), localizando dinamicamente o caminho do arquivo hosts.
     """
     # Valores fixos
-    alias_ip = '127.0.0.2'
-    alias_nome = 'procesure'
+    alias_ip = RDP_ALIAS_IP
+    alias_nome = RDP_ALIAS_NAME
     alias_entry = f"{alias_ip} {alias_nome}"
     usuario = 'user'
     senha = 'password'
 
-    # Localiza dinamicamente o arquivo hosts
-    system_root = os.environ.get('SystemRoot', r'C:\Windows')
-    hosts_path = os.path.join(system_root, r'System32\drivers\etc\hosts')
-
     # Verifica e atualiza o arquivo hosts
     try:
-        alias_exists = False
-        if os.path.exists(hosts_path):
-            with open(hosts_path, 'r') as hosts_file:
-                alias_exists = alias_entry in hosts_file.read()
-
-        if alias_exists:
-            print(f"Alias '{alias_entry}' já existe no arquivo hosts.")
+        diff = update_hosts_file(default_hosts_path(), add=[(alias_ip, alias_nome)])
+        if diff.changed:
+            log(f"Alias '{alias_entry}' adicionado ao arquivo hosts com sucesso!")
         else:
-            # Adiciona o alias ao arquivo hosts
-            with open(hosts_path, 'a') as hosts_file:
-                hosts_file.write(f'\n{alias_entry}\n')
-            print(f"Alias '{alias_entry}' adicionado ao arquivo hosts com sucesso!")
+            log(f"Alias '{alias_entry}' já existe no arquivo hosts.")
     except PermissionError:
-        print("Erro: Permissão negada. Execute o script como administrador.")
+        log("Erro: Permissão negada. Execute o script como administrador.")
         return
     except Exception as e:
-        print(f"Erro ao verificar ou modificar o arquivo hosts: {e}")
+        log(f"Erro ao verificar ou modificar o arquivo hosts: {e}")
         return
 
-    # Verifica e cria credenciais RDP
+    # Verifica e cria credenciais RDP com uma leitura direta do Credential Manager
+    alvo = RDP_CREDENTIAL_TARGET
     try:
-        result = subprocess.run(
-            f'cmdkey /list', shell=True, capture_output=True, text=True
-        )
-        if f"TERMSRV/{alias_ip}" in result.stdout:
-            print(f"Credencial RDP para TERMSRV/{alias_ip} já existe.")
+        escritas = get_credential_backend().upsert_many([Credential(alvo, usuario, senha)])
+        if escritas:
+            log(f"Credenciais RDP criadas com sucesso! (Usuário: {usuario}, Senha: {senha})")
         else:
-            # Cria credenciais para RDP automático
-            comando_rdp = f'cmdkey /generic:TERMSRV/{alias_ip} /user:{usuario} /pass:{senha}'
-            subprocess.run(comando_rdp, shell=True, check=True)
-            print(f"Credenciais RDP criadas com sucesso! (Usuário: {usuario}, Senha: {senha})")
-    except subprocess.CalledProcessError as e:
-        print(f"Erro ao criar credenciais RDP: {e}")
+            log(f"Credencial RDP para {alvo} já existe.")
+    except CredentialError as e:
+        log(f"Erro ao criar credenciais RDP: {e}")
     except Exception as e:
-        print(f"Erro inesperado ao verificar ou criar credenciais RDP: {e}")
\ No newline at end of file
+        log(f"Erro inesperado ao verificar ou criar credenciais RDP: {e}")
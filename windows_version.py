@@ -0,0 +1,95 @@
+import functools
+import sys
+from collections import namedtuple
+
+from system_state import get_system_state
+
+
+# What a probe learned about the OS; any field may be None when the probe cannot tell
+VersionInfo = namedtuple("VersionInfo", ["build", "is_server", "caption"])
+
+WINDOWS_11_FIRST_BUILD = 22000
+WINDOWS_10_FIRST_BUILD = 10240
+SERVER_BUILDS = {
+    14393: "WindowsServer2016",
+}
+
+VER_NT_WORKSTATION = 1
+CURRENT_VERSION_KEY = r"SOFTWARE\Microsoft\Windows NT\CurrentVersion"
+
+
+def probe_platform():
+    """Read the build number and product type straight from the running interpreter."""
+    getwindowsversion = getattr(sys, "getwindowsversion", None)
+    if getwindowsversion is None:
+        return None
+    version = getwindowsversion()
+    return VersionInfo(version.build, version.product_type != VER_NT_WORKSTATION, None)
+
+
+def probe_registry():
+    """Read the CurrentVersion registry values."""
+    try:
+        import winreg
+    except ImportError:
+        return None
+    try:
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, CURRENT_VERSION_KEY) as key:
+            build = int(winreg.QueryValueEx(key, "CurrentBuildNumber")[0])
+            installation_type = winreg.QueryValueEx(key, "InstallationType")[0]
+            product_name = winreg.QueryValueEx(key, "ProductName")[0]
+    except (OSError, ValueError):
+        return None
+    # ProductName still says "Windows 10" on Windows 11, so only the build is trusted
+    return VersionInfo(build, installation_type == "Server", product_name)
+
+
+def probe_wmi():
+    """Fall back to the Win32_OperatingSystem caption collected by the state probe."""
+    caption = get_system_state().os_caption
+    if not caption:
+        return None
+    return VersionInfo(None, "Server" in caption, caption)
+
+
+DEFAULT_PROBES = (probe_platform, probe_registry, probe_wmi)
+
+
+def classify(info):
+    """Map a VersionInfo to a setup key, or None when the OS is not supported."""
+    if info.build is not None:
+        if info.is_server:
+            return SERVER_BUILDS.get(info.build)
+        if info.build >= WINDOWS_11_FIRST_BUILD:
+            return "Windows11"
+        if info.build >= WINDOWS_10_FIRST_BUILD:
+            return "Windows10"
+        return None
+
+    caption = info.caption or ""
+    if "Windows 10" in caption:
+        return "Windows10"
+    elif "Windows 11" in caption:
+        return "Windows11"
+    elif "Windows Server 2016" in caption:
+        return "WindowsServer2016"
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def detect_windows_version(probes=DEFAULT_PROBES):
+    """
+    Return the setup key for this host, trying the cheapest probe first.
+
+    The first probe that returns anything decides; later probes only run when an
+    earlier one cannot tell. The result is memoized per probe tuple.
+    """
+    for probe in probes:
+        info = probe()
+        if info is None:
+            continue
+        version = classify(info)
+        if version is None:
+            raise ValueError(f"Unsupported Windows version detected: {info}")
+        return version
+    raise ValueError("Could not detect the Windows version")